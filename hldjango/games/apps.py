@@ -19,6 +19,7 @@ class GamesConfig(AppConfig):
         # run at startup
         logDirPath = settings.BASE_DIR / "jrlogs/"
         jrfuncs.setLogFileDir(str(logDirPath))
+        jrfuncs.setLogQuietMode(settings.JR_LOGQUIET)
 
 
 
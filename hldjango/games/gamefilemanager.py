@@ -3,14 +3,19 @@
 # python modules
 import os
 import datetime
+import hashlib
+import json
+import time
 
 # django modules
 from django.conf import settings
+from django.urls import reverse
 
 # helpers
 from lib.jr import jrfuncs, jrdfuncs
 from lib.jr.jrfuncs import jrprint
 from lib.jr.jrfilefinder import JrFileFinder
+from lib.jr.jrblobstore import JrBlobStore
 
 
 
@@ -40,6 +45,12 @@ GameFileTypeDbFieldChoices = [
     (EnumGameFileTypeName_VersionedGame, "Versioned game text file"),
     (EnumGameFileTypeName_Debug, "Debug file"),
 ]
+
+# cache of directory manifests (see GameFileManager.getDirectoryManifest), by directory path, shared by all GameFileManager instances in this process
+moduleDirectoryManifestCache = {}
+
+# game file types whose files are served by the games.views.GameFileServeView
+ServedGameFileTypes = [EnumGameFileTypeName_DraftBuild, EnumGameFileTypeName_PreferredBuild, EnumGameFileTypeName_Debug, EnumGameFileTypeName_Published]
 # ---------------------------------------------------------------------------
 
 
@@ -74,6 +85,13 @@ def calculateAbsoluteMediaPathForRelativePath(relativePath):
 def calcGamePathIdPart(game):
     return jrdfuncs.resolveSubDirName(game.subdirname, game.pk)
 
+def getArtifactStore():
+    return JrBlobStore(jrfuncs.canonicalFilePath(str(settings.JR_DIR_ARTIFACTSTORE)))
+
+def releaseUnusedArtifacts():
+    # delete stored artifacts that no game file links to anymore (e.g. after a deleted game's directory is removed); returns count deleted
+    return getArtifactStore().releaseUnusedBlobs()
+
 
 
 
@@ -117,45 +135,103 @@ class GameFileManager:
         # 1. files as represented by GameFile model entries in the database; this would be especially important if we need to store extra data with a file; or if we are using some distributed cloud based file serving
         # 2. files on a local drive, which we dont have to keep track of other than doing a file searching
         # different game types might be stored differently?
-        return self.buildFileListFromLocalDrivePath(gameFileTypeName)
+        # this comes from the cached directory manifest, so it is cheap enough for page renders; code about to change files should use buildFileListFromLocalDrivePath
+        return list(self.getDirectoryManifest(gameFileTypeName)["fileList"])
 
 
     def buildFileListFromLocalDrivePath(self, gameFileTypeName):
+        # scan the directory now (one stat per file)
         dirPath = self.getDirectoryPathForGameType(gameFileTypeName)
-        urlBase = self.getBaseUrlPathForGameType(gameFileTypeName)
         #
         flist = []
         if (not jrfuncs.directoryExists(dirPath)):
             return flist
-        for fileName in os.listdir(dirPath):
+        for dirEntry in os.scandir(dirPath):
             # should we filter on extension?
             if (True):
-                filePath = os.path.join(dirPath, fileName)
-                url = urlBase + "/" + fileName
+                fileStat = dirEntry.stat()
                 # use mtime modification time to get original creation date on file copy
-                fileTimestamp = os.path.getmtime(filePath)
-                fileDateTime = datetime.datetime.fromtimestamp(fileTimestamp)
-                fileDateString = jrfuncs.getNiceDateTimeCompact(fileDateTime)
-                fileSizeBytes = os.path.getsize(filePath)
-                fileSizeNiceStr = jrfuncs.niceFileSizeStr(fileSizeBytes)
-                fileEntry = {
-                    "name": fileName,
-                    "path": filePath,
-                    "comment": "",
-                    "url": url,
-                    "fileTimestamp": fileTimestamp,
-                    "fileDateTime": fileDateTime,
-                    "fileDateString": fileDateString,
-                    "fileSizeBytes": fileSizeBytes,
-                    "fileSizeNiceStr": fileSizeNiceStr,
-                    }
-                flist.append(fileEntry)
+                flist.append(self.makeFileEntry(gameFileTypeName, dirEntry.name, fileStat.st_mtime, fileStat.st_size))
         #
         #jrprint("buildFileListFromLocalDrivePath -> game {} type {} = path: {}; found {} files.".format(self.game.name, gameFileTypeName, dirPath, len(flist)))
         #
         return flist
 
 
+    def makeFileEntry(self, gameFileTypeName, fileName, fileTimestamp, fileSizeBytes):
+        # everything but the name, time and size is derived, so entries can be remade from a saved manifest without touching the disk
+        filePath = os.path.join(self.getDirectoryPathForGameType(gameFileTypeName), fileName)
+        url = self.getFileUrlForGameType(gameFileTypeName, fileName, self.getBaseUrlPathForGameType(gameFileTypeName))
+        fileDateTime = datetime.datetime.fromtimestamp(fileTimestamp)
+        fileDateString = jrfuncs.getNiceDateTimeCompact(fileDateTime)
+        fileSizeNiceStr = jrfuncs.niceFileSizeStr(fileSizeBytes)
+        fileEntry = {
+            "name": fileName,
+            "path": filePath,
+            "comment": "",
+            "url": url,
+            "fileTimestamp": fileTimestamp,
+            "fileDateTime": fileDateTime,
+            "fileDateString": fileDateString,
+            "fileSizeBytes": fileSizeBytes,
+            "fileSizeNiceStr": fileSizeNiceStr,
+            }
+        return fileEntry
+
+
+    # directory manifests; the file list of a game type directory cached in memory (per process) and on disk, keyed by the directory mtime
+    # anything that adds, deletes or renames files changes the directory mtime; in memory we only recheck that every JR_FILEMANIFEST_RECHECKSECS, so page renders in between cost no file system calls
+    # code that writes into a directory calls invalidateFileList so the change shows at once in this process
+    def getDirectoryManifest(self, gameFileTypeName):
+        dirPath = self.getDirectoryPathForGameType(gameFileTypeName)
+        timeNow = time.time()
+        manifest = moduleDirectoryManifestCache.get(dirPath, None)
+        if (manifest is not None) and (timeNow - manifest["timeChecked"] < settings.JR_FILEMANIFEST_RECHECKSECS):
+            return manifest
+        # stat the directory BEFORE scanning, so a change during the scan just means we scan again next time
+        try:
+            dirMtimeNs = os.stat(dirPath).st_mtime_ns
+        except OSError:
+            dirMtimeNs = None
+        if (manifest is None) and (dirMtimeNs is not None):
+            manifest = self.loadDirectoryManifestFromDisk(gameFileTypeName)
+        if (manifest is None) or (manifest["dirMtimeNs"] != dirMtimeNs):
+            manifest = {"dirMtimeNs": dirMtimeNs, "fileList": self.buildFileListFromLocalDrivePath(gameFileTypeName)}
+            if (dirMtimeNs is not None):
+                self.saveDirectoryManifestToDisk(gameFileTypeName, manifest)
+        manifest["timeChecked"] = timeNow
+        moduleDirectoryManifestCache[dirPath] = manifest
+        return manifest
+
+    def getDirectoryManifestFilePath(self, gameFileTypeName):
+        filePath = "/".join([self.getBaseDirectoryPathForGame(), "_manifests", "files_{}.json".format(gameFileTypeName)])
+        return filePath
+
+    def loadDirectoryManifestFromDisk(self, gameFileTypeName):
+        filePath = self.getDirectoryManifestFilePath(gameFileTypeName)
+        try:
+            savedManifest = jrfuncs.loadJsonFromFile(filePath, True)
+        except Exception:
+            return None
+        fileList = [self.makeFileEntry(gameFileTypeName, name, fileTimestamp, fileSizeBytes) for [name, fileTimestamp, fileSizeBytes] in savedManifest["files"]]
+        return {"dirMtimeNs": savedManifest["dirMtimeNs"], "fileList": fileList}
+
+    def saveDirectoryManifestToDisk(self, gameFileTypeName, manifest):
+        filePath = self.getDirectoryManifestFilePath(gameFileTypeName)
+        savedManifest = {"dirMtimeNs": manifest["dirMtimeNs"], "files": [[fileEntry["name"], fileEntry["fileTimestamp"], fileEntry["fileSizeBytes"]] for fileEntry in manifest["fileList"]]}
+        try:
+            jrfuncs.createDirForFullFilePathIfMissing(filePath)
+            # write then rename, since another process may be reading it
+            jrfuncs.saveTxtToFile(filePath + ".tmp", json.dumps(savedManifest))
+            os.replace(filePath + ".tmp", filePath)
+        except OSError as e:
+            jrprint("Warning: failed to save directory manifest '{}': {}.".format(filePath, e))
+
+    def invalidateFileList(self, gameFileTypeName):
+        moduleDirectoryManifestCache.pop(self.getDirectoryPathForGameType(gameFileTypeName), None)
+        jrfuncs.deleteFilePathIfExists(self.getDirectoryManifestFilePath(gameFileTypeName))
+
+
     def buildFileListFromDb(self, gameFileTypeName):
         # build list from database
         return []
@@ -177,6 +253,9 @@ class GameFileManager:
             filePath = fileEntry["path"]
             #jrprint("ATTN: deleteAllFilesForGameTypeOnLocalDrive deleting file '{}'.".format(filePath))
             jrfuncs.deleteFilePathIfExists(filePath)
+        # and let go of the stored artifacts they linked to
+        self.releaseArtifactsForGameType(gameFileTypeName)
+        self.invalidateFileList(gameFileTypeName)
 
     def deleteAllFilesForGameTypeInDb(self, gameFileTypeName):
         # delete all the files of the game file type
@@ -188,6 +267,7 @@ class GameFileManager:
 
     def notifyNewFileCreatedForGameType(self, gameFileTypeName, filePath, extraFields):
         # a new file was created; we might here add a db entry OR create an auxiliary file with extraFields, OR do nothing
+        self.invalidateFileList(gameFileTypeName)
         jrprint("notifyNewFileCreatedForGameType ->  file added to game {} of type {} with path '{}' and fields: {}.".format(self.game.name, gameFileTypeName, filePath, extraFields))
 
 
@@ -199,6 +279,16 @@ class GameFileManager:
         filePath = jrfuncs.canonicalFilePath(filePath)
         return filePath
 
+    def getStoryParseCacheFilePath(self):
+        # incremental parse cache for this game (see HlParser.parseStoryTextIncremental); lives beside the build directories, keyed by story build version
+        filePath = "/".join([self.getBaseDirectoryPathForGame(), "_parsecache", "storyParse_{}.pickle".format(settings.JR_STORYBUILDVERSION)])
+        return filePath
+
+    def getBuildLogFilePath(self, buildMode):
+        # log output (jrprint/jrlog) of the most recent build of this mode (see jrfuncs.addBuildLogFile); lives beside the build directories so it is not zipped or published
+        filePath = "/".join([self.getBaseDirectoryPathForGame(), "_buildlogs", "build_{}.log".format(buildMode)])
+        return filePath
+
     def getBaseDirectoryPathForGameWithExplicitSubdir(self, subdirname):
         gameId = jrdfuncs.resolveSubDirName(subdirname, self.game.pk)
         filePath = "/".join([str(settings.MEDIA_ROOT), "games", gameId])
@@ -235,6 +325,13 @@ class GameFileManager:
         return urlPath
 
 
+    def getFileUrlForGameType(self, gameFileTypeName, fileName, urlBase):
+        if (gameFileTypeName in ServedGameFileTypes):
+            # built files go through the file serving view (range requests, etags) rather than plain media urls
+            return reverse("gameFileServe", kwargs={"slug": self.game.slug, "gameFileType": gameFileTypeName, "fileName": fileName})
+        return urlBase + "/" + fileName
+
+
     def prepareEmptyFileDirectoryForGameType(self, gameFileTypeName):
         # delete any files in directory, create directory if needed
         self.deleteAllFilesForGameType(gameFileTypeName)
@@ -255,6 +352,85 @@ class GameFileManager:
 
 
 
+    def calcImageSetHash(self):
+        # hash of the names, sizes and modification times of the images a build can use (this game's uploads and the shared images)
+        h = hashlib.new("sha256")
+        for dirPath in [self.getDirectoryPathForGameType(EnumGameFileTypeName_StoryUpload), self.getSharedImageDirectory()]:
+            if (not jrfuncs.directoryExists(dirPath)):
+                continue
+            h.update(dirPath.encode())
+            for dirEntry in sorted(os.scandir(dirPath), key=lambda entry: entry.name):
+                if (dirEntry.is_file()):
+                    fileStat = dirEntry.stat()
+                    h.update("{}|{}|{}\n".format(dirEntry.name, fileStat.st_size, fileStat.st_mtime_ns).encode())
+        return h.hexdigest()
+
+
+
+    # artifact store; the files of a game type directory are hard links into it, with a manifest of fileName -> sha256 kept beside the game directories
+    def getArtifactStore(self):
+        return getArtifactStore()
+
+    def getArtifactManifestFilePath(self, gameFileTypeName):
+        filePath = "/".join([self.getBaseDirectoryPathForGame(), "_artifacts", "manifest_{}.json".format(gameFileTypeName)])
+        return filePath
+
+    def loadArtifactManifest(self, gameFileTypeName):
+        filePath = self.getArtifactManifestFilePath(gameFileTypeName)
+        if (not jrfuncs.pathExists(filePath)):
+            return {}
+        return jrfuncs.loadJsonFromFile(filePath, True)
+
+    def saveArtifactManifest(self, gameFileTypeName, manifest):
+        filePath = self.getArtifactManifestFilePath(gameFileTypeName)
+        jrfuncs.createDirForFullFilePathIfMissing(filePath)
+        jrfuncs.saveTxtToFile(filePath, json.dumps(manifest, indent=2))
+
+    def storeFilesForGameTypeAsArtifacts(self, gameFileTypeName):
+        # move the files of this game type into the artifact store (unchanged ones dedupe to the same blob), leaving hard links in place; returns the manifest
+        artifactStore = self.getArtifactStore()
+        manifestPrevious = self.loadArtifactManifest(gameFileTypeName)
+        manifest = {}
+        dirPath = self.getDirectoryPathForGameType(gameFileTypeName)
+        if (jrfuncs.directoryExists(dirPath)):
+            for dirEntry in os.scandir(dirPath):
+                # only regular files (not e.g. a working directory left behind by a failed build)
+                if (not dirEntry.is_file()):
+                    continue
+                hexHash = manifestPrevious.get(dirEntry.name, None)
+                if (hexHash is None) or (not artifactStore.isLinkedToBlob(dirEntry.path, hexHash)):
+                    hexHash = artifactStore.ingestFile(dirEntry.path)
+                manifest[dirEntry.name] = hexHash
+        self.saveArtifactManifest(gameFileTypeName, manifest)
+        # linking to an existing blob changes the file times
+        self.invalidateFileList(gameFileTypeName)
+        # blobs that only the previous files linked to
+        for hexHash in set(manifestPrevious.values()).difference(manifest.values()):
+            artifactStore.releaseBlob(hexHash)
+        return manifest
+
+    def getArtifactHashForFile(self, gameFileTypeName, fileName):
+        # sha256 of a file of this game type if it is (still) linked to its stored artifact, else None
+        hexHash = self.loadArtifactManifest(gameFileTypeName).get(fileName, None)
+        if (hexHash is None):
+            return None
+        filePath = self.getDirectoryPathForGameType(gameFileTypeName) + "/" + fileName
+        if (not self.getArtifactStore().isLinkedToBlob(filePath, hexHash)):
+            return None
+        return hexHash
+
+    def releaseArtifactsForGameType(self, gameFileTypeName):
+        # called after the files of this game type were deleted; deletes blobs nothing else links to
+        manifest = self.loadArtifactManifest(gameFileTypeName)
+        if (len(manifest)==0):
+            return
+        artifactStore = self.getArtifactStore()
+        for hexHash in set(manifest.values()):
+            artifactStore.releaseBlob(hexHash)
+        jrfuncs.deleteFilePathIfExists(self.getArtifactManifestFilePath(gameFileTypeName))
+
+
+
     # helper to clear out directories before building in them
     def deleteFilesInBuildListDirectories(self, buildList):
         uniqueGameTypesToBuild = []
@@ -281,7 +457,7 @@ class GameFileManager:
             raise Exception("The source directory to copy from does not exist: '{}'.".format(fromDir))
         
         # source file list
-        fromFileFile = self.buildFileList(fromGameType)
+        fromFileFile = self.buildFileListFromLocalDrivePath(fromGameType)
         if (len(fromFileFile)==0):
             raise Exception("No files found in source directory to copy from does: '{}'.".format(fromDir)) 
 
@@ -289,20 +465,32 @@ class GameFileManager:
         toDir = self.getDirectoryPathForGameType(toGameType)
         self.prepareEmptyFileDirectoryForGameType(toGameType)
 
-        # ok now copy files
+        # ok now copy files; these are just new hard links to the stored artifacts (falling back to a real copy for anything not in the store)
+        artifactStore = self.getArtifactStore()
+        fromManifest = self.storeFilesForGameTypeAsArtifacts(fromGameType)
+        toManifest = {}
         fileCopyCount = 0
+        fileLinkCount = 0
         for fileEntry in fromFileFile:
             filePathSource = fileEntry["path"]
             fileName = os.path.basename(filePathSource)
+            hexHash = fromManifest.get(fileName, None)
             fileExt = os.path.splitext(fileName)[1]
             if (fileExt==".zip"):
                 # for zip file we do a substitue in filename
                 fileName = fileName.replace(fromGameType, toGameType)
             filePathDest = os.path.join(toDir, fileName)
-            jrfuncs.copyFilePath(filePathSource, filePathDest)
+            if (hexHash is not None) and (artifactStore.hasBlob(hexHash)):
+                artifactStore.linkBlobTo(hexHash, filePathDest)
+                toManifest[fileName] = hexHash
+                fileLinkCount += 1
+            else:
+                jrfuncs.copyFilePath(filePathSource, filePathDest)
             fileCopyCount += 1
+        self.saveArtifactManifest(toGameType, toManifest)
+        self.invalidateFileList(toGameType)
         
-        resultMessage = "Successfully copied ({}) files from {} to {}.".format(fileCopyCount, fromGameType, toGameType)
+        resultMessage = "Successfully copied ({}) files from {} to {} ({} linked from the artifact store).".format(fileCopyCount, fromGameType, toGameType, fileLinkCount)
         return resultMessage
 
 
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.3 on 2026-10-17 03:35
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0031_alter_game_subdirname'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='game',
+            index=models.Index(fields=['owner', 'isPublic'], name='game_owner_ispublic_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gamefile',
+            index=models.Index(fields=['game', 'gameFileType'], name='gamefile_game_type_idx'),
+        ),
+    ]
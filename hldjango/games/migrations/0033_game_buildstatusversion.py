@@ -0,0 +1,18 @@
+# Generated by Django 5.0.3 on 2026-10-17 03:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('games', '0032_game_gamefile_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='buildStatusVersion',
+            field=models.PositiveIntegerField(default=0, help_text='Version of the build status fields'),
+        ),
+    ]
@@ -16,7 +16,7 @@ from lib.jr import jrdfuncs
 from lib.jr import jrfuncs
 from lib.jr.jrfuncs import jrprint
 from lib.hl.hlparser import fastExtractSettingsDictionary
-from lib.hl.hltasks import queueTaskBuildStoryPdf, publishGameFiles, isTaskCanceled, cancelPreviousQueuedTask
+from lib.hl.hltasks import makeTaskBuildStoryPdf, enqueueTask, isBuildRequestUpToDate, publishGameFiles, isTaskCanceled, isTaskWaitingInQueue, cancelPreviousQueuedTask
 
 # helpers
 from . import gamefilemanager
@@ -138,6 +138,8 @@ class Game(models.Model):
     buildResultsJson = models.TextField(help_text="All build results as json string", default="", blank=True)
     buildResultsJsonField = models.JSONField(help_text="All build results as json", default=dict, blank=True) # , encoder=DjangoJSONEncoder, decoder=DjangoJSONEncoder)
     #buildResultsJsonField = models.JSONField(help_text="All build results as json", default=dict, blank=True, encoder=DjangoJSONEncoder, decoder=DjangoJSONEncoder)
+    # bumped on every save of the build status fields, so a save working from stale build results can tell (see saveBuildStatus)
+    buildStatusVersion = models.PositiveIntegerField(help_text="Version of the build status fields", default=0)
 
 
 
@@ -156,6 +158,23 @@ class Game(models.Model):
     #outOfDatePublished = models.BooleanField(help_text="Published document set is out of date")
     #
 
+    # fields shown in game lists; listing querysets load only these (never the game text or build results)
+    GameListFieldNames = ["id", "slug", "name", "title", "summary", "isPublic", "owner"]
+    # large fields that pages only showing game info, files and build status do not need
+    GameDetailDeferredFieldNames = ["text", "lastBuildLog", "buildResultsJson", "settingsStatus"]
+    # fields written by builds and publishing, only ever through saveBuildStatus; a normal save of the game (e.g. an edit) leaves them alone
+    # (except lastBuildLog right after setSettingStatus wrote the settings parse result into it)
+    GameBuildStatusFieldNames = ["buildResultsJsonField", "buildResultsJson", "buildStatusVersion", "leadStats", "publishDate", "lastBuildLog"]
+    # how many times saveBuildStatus retries when someone else saved build status in the meantime
+    GameBuildStatusSaveTries = 10
+
+
+    class Meta:
+        indexes = [
+            # user game lists filter on owner and isPublic
+            models.Index(fields=["owner", "isPublic"], name="game_owner_ispublic_idx"),
+        ]
+
 
 
 
@@ -167,12 +186,29 @@ class Game(models.Model):
         except Game.DoesNotExist:
             return None
 
+    @staticmethod
+    def getListQuerySet():
+        # games for list pages, loading only the fields the list shows
+        return Game.objects.only(*Game.GameListFieldNames).order_by("title", "id")
+
+    @staticmethod
+    def getDetailQuerySet():
+        # games for pages that show game info and files (with the owner joined in), without the big text fields
+        return Game.objects.select_related("owner").defer(*Game.GameDetailDeferredFieldNames)
+
     def __str__(self):
         return "{} ({})".format(self.title, self.name)
 
     def get_absolute_url(self):
         return reverse("gameDetail", kwargs={"slug": self.slug})
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the slug and name as loaded, so save can skip making the slug unique again when neither changed
+        instance.loadedSlugAndName = [instance.__dict__.get("slug"), instance.__dict__.get("name")]
+        return instance
+
     # override clean to parse hash
     def clean(self):
         # called automatically on edit
@@ -199,19 +235,37 @@ class Game(models.Model):
     
     # override save to set slug
     def save(self, **kwargs):
-        if (self.slug is None) or (self.slug==""):
-            # default new slug value based on name; used for NEW game or when we reset it to blank if user changes self.name
-            slugStr = self.name
-        else:
-            # start with previous value of slug!
-            slugStr = self.slug
-        # dont let slugname confuse our url paths
-        if (slugStr.lower() in ["file","new"]):
-            slugStr += "game"
+        updateFields = kwargs.get("update_fields", None)
+        if (updateFields is None) and (not self._state.adding):
+            # never write the build status fields from here; a build finishing while this instance was loaded would otherwise lose its results (see saveBuildStatus)
+            deferredFieldNames = self.get_deferred_fields()
+            updateFields = [field.name for field in self._meta.concrete_fields if (not field.primary_key) and (field.name not in Game.GameBuildStatusFieldNames) and (field.attname not in deferredFieldNames)]
+            if (hasattr(self,"flagSaveSettingsStatusLog") and self.flagSaveSettingsStatusLog):
+                updateFields.append("lastBuildLog")
+            kwargs["update_fields"] = updateFields
         #
-        jrdfuncs.jrdUniquifySlug(self, slugStr)
+        if (updateFields is not None) and ("slug" not in updateFields) and ("name" not in updateFields):
+            # slug is not being saved
+            pass
+        elif (self.slug) and (getattr(self, "loadedSlugAndName", None) == [self.slug, self.name]):
+            # unchanged since loaded, so still unique; no need for the uniqueness queries
+            pass
+        else:
+            if (self.slug is None) or (self.slug==""):
+                # default new slug value based on name; used for NEW game or when we reset it to blank if user changes self.name
+                slugStr = self.name
+            else:
+                # start with previous value of slug!
+                slugStr = self.slug
+            # dont let slugname confuse our url paths
+            if (slugStr.lower() in ["file","new"]):
+                slugStr += "game"
+            #
+            jrdfuncs.jrdUniquifySlug(self, slugStr)
         # call super class
         super(Game, self).save(**kwargs)
+        self.loadedSlugAndName = [self.slug, self.name]
+        self.flagSaveSettingsStatusLog = False
 
         # after we have saved an object (and assigned it a pk); check if we should save versionedText
         if (hasattr(self,"flagSaveVersionedGameText") and self.flagSaveVersionedGameText):
@@ -302,6 +356,8 @@ class Game(models.Model):
             self.lastBuildLog = "ERROR while parsing game text settings: " + msg
         else:
             self.lastBuildLog = "Game text settings parsed: " + msg
+        # set this non-db field which we will check for when we save
+        self.flagSaveSettingsStatusLog = True
 
 
 
@@ -332,6 +388,35 @@ class Game(models.Model):
         allResultsObj[gameFileTypeStr] = resultObject
         self.setBuildResultsAsObject(allResultsObj)
 
+    def saveBuildStatus(self, gameFileTypeStrs, extraFieldNames=[], mergeFunc=None):
+        # save the build results of the given build modes (only pass the ones actually changed), plus any other fields named (e.g. lastBuildLog), and nothing else of the row
+        # the update only goes through if no one else has saved build status since this instance loaded it (buildStatusVersion unchanged);
+        # otherwise (e.g. another mode's build finished meanwhile) we reload the stored build results, put ours back on top and try again
+        # for our modes, mergeFunc(game, storedResults, ourResults) decides what to write over results someone else stored meanwhile; by default ours replace them
+        # (right for the build task, which owns the status of its mode while it runs)
+        ourResults = {}
+        for gameFileTypeStr in gameFileTypeStrs:
+            ourResults[gameFileTypeStr] = self.getBuildResults(gameFileTypeStr)
+        for tryIndex in range(0, Game.GameBuildStatusSaveTries):
+            for gameFileTypeStr, buildResults in ourResults.items():
+                if (tryIndex > 0) and (mergeFunc is not None):
+                    buildResults = mergeFunc(self, self.getBuildResults(gameFileTypeStr), buildResults)
+                self.setBuildResults(gameFileTypeStr, buildResults)
+            updateValues = {
+                "buildResultsJsonField": self.getBuildResultsAsObject(),
+                "buildStatusVersion": self.buildStatusVersion + 1,
+                }
+            for fieldName in extraFieldNames:
+                updateValues[fieldName] = getattr(self, fieldName)
+            rowCount = Game.objects.filter(pk=self.pk, buildStatusVersion=self.buildStatusVersion).update(**updateValues)
+            if (rowCount == 1):
+                self.buildStatusVersion += 1
+                return
+            # stale; get what is stored now (raises Game.DoesNotExist if the game was deleted)
+            self.refresh_from_db(fields=["buildResultsJsonField", "buildStatusVersion"])
+        raise Exception("Failed to save build status for game pk={}; it kept being changed by others.".format(self.pk))
+
+
     def getBuildResults(self, gameFileTypeStr):
         # update appropriate model field with data and hash of build
         allResultsObj = self.getBuildResultsAsObject()
@@ -461,8 +546,8 @@ class Game(models.Model):
             buildModeNice = "draft pdf set build"
         elif ("cancelBuildTasks" in request.POST):
             # cancel all queued builds
-            retv = self.cancelAllPendingBuilds(request)
-            self.save()
+            canceledGameFileTypes = self.cancelAllPendingBuilds(request)
+            self.saveBuildStatus(canceledGameFileTypes, [], mergeCanceledBuildResults)
             return
         elif ("publish" in request.POST):
             # publish request
@@ -471,30 +556,47 @@ class Game(models.Model):
             raise Exception("Unspecified build mode.")
 
         # build options
-        requestOptions = {"buildMode": buildMode}
+        requestOptions = {"buildMode": buildMode, "ownerPk": self.owner_id}
 
         # do the build (queued or immediate)
         result = None
 
+        # coalesce repeated requests; a build still waiting in the queue builds whatever the text is when it runs, so there is no need for another
+        if (self.isBuildWaitingInQueue(buildMode)):
+            jrdfuncs.addFlashMessage(request, "A {} for game '{}' is already queued; it will build the latest text.".format(buildModeNice, self.name), False)
+            return
+
+        # nothing that goes into the build (text, build options, images, options files) has changed since the last successful one, so its files are still good
+        if (isBuildRequestUpToDate(self, buildMode)):
+            jrdfuncs.addFlashMessage(request, "Nothing has changed since the last {} for game '{}'; its files are up to date.".format(buildModeNice, self.name), False)
+            return
+
         # delete any PREVIOUSLY QUEUED job for THIS build
         self.cancelPendingBuildIfPresent(request, buildMode)
 
+        # the task is made (with its id) before it is queued, so the queued status saved below already names it, and nothing has to be saved after queueing
+        # (which could overwrite the status of a task that started right away)
+        buildTask = makeTaskBuildStoryPdf(self.pk, requestOptions, buildMode)
+
         # i think we need to set this before we queue task so it doesnt see old build reesults if it runs immediately
         buildResultsPrevious = self.getBuildResults(buildMode)
         #
         buildResults = {
                 "queueStatus": Game.GameQueueStatusEnum_Queued,
                 "buildDateQueued": timezone.now().timestamp(),
+                "taskType": "huey",
+                "taskId": buildTask.id,
             }
         self.copyLastBuildResultsTo(buildResultsPrevious, buildResults)
         self.setBuildResults(buildMode, buildResults)
         # we better save to db so that task queue db sees this is if it checks right away
-        self.save()
+        # if a previous build of this mode saved meanwhile, keep its last build info
+        self.saveBuildStatus([buildMode], [], mergeQueuedBuildResults)
 
         # this will QUEUE or run immediately the game build if neeed
         # but note that right now we are saving the entire TEXT in the function call queue, alternatively we could avoid passing text and grab it only when build triggers
         # ATTN: eventually move all this to the function that actually builds
-        taskRetv = queueTaskBuildStoryPdf(self.pk, requestOptions)
+        taskRetv = enqueueTask(buildTask)
         result = taskRetv.get()
 
         # send to detail view with flash message
@@ -503,20 +605,8 @@ class Game(models.Model):
             message = "Result of {} for game '{}': {}.".format(buildModeNice, self.name, result)
             # no need to save since the queutask will save
         else:
-            # queued
+            # queued (status was saved above)
             message = "Generation of {} for game '{}' has been queued for delayed build.".format(buildModeNice, self.name)
-            # we are queueing, so update status.. should we reload in case it changed?
-            buildResults = {
-                "queueStatus": Game.GameQueueStatusEnum_Queued,
-                "buildDateQueued": timezone.now().timestamp(),
-                "taskType": "huey",
-                "taskId": taskRetv.id,
-                }
-            # copy over last build results that are important
-            self.copyLastBuildResultsTo(buildResultsPrevious, buildResults)
-            self.setBuildResults(buildMode, buildResults)
-            #
-            self.save()
 
         jrdfuncs.addFlashMessage(request, message, False)
 
@@ -633,6 +723,7 @@ class Game(models.Model):
         encoding = "utf-8"
         jrfuncs.createDirIfMissing(directoryPath)
         jrfuncs.saveTxtToFile(fullFilePath, self.text)
+        gameFileManager.invalidateFileList(gameFileType)
 
 
 
@@ -662,15 +753,32 @@ class Game(models.Model):
         return retv
 
 
+    def isBuildWaitingInQueue(self, gameFileType):
+        buildResults = self.getBuildResults(gameFileType)
+        queueStatus = jrfuncs.getDictValueOrDefault(buildResults, "queueStatus", None)
+        isCanceled = jrfuncs.getDictValueOrDefault(buildResults,"canceled", False)
+        if (queueStatus != Game.GameQueueStatusEnum_Queued) or (isCanceled):
+            return False
+        taskType = jrfuncs.getDictValueOrDefault(buildResults, "taskType", None)
+        taskId = jrfuncs.getDictValueOrDefault(buildResults, "taskId", None)
+        return isTaskWaitingInQueue(taskType, taskId)
+
+
     def cancelAllPendingBuilds(self, request):
+        # returns the list of game file types whose build results were changed (marked canceled); caller saves those
         canceledTaskCount = 0
+        changedGameFileTypes = []
         allResultsObj = self.getBuildResultsAsObject()
         for gameFileType, buildResults in allResultsObj.items():
+            wasCanceled = jrfuncs.getDictValueOrDefault(buildResults, "canceled", False)
             retv = self.cancelPendingBuildIfPresent(request, gameFileType)
             if (retv):
                 canceledTaskCount += 1
+            if (not wasCanceled) and (jrfuncs.getDictValueOrDefault(self.getBuildResults(gameFileType), "canceled", False)):
+                changedGameFileTypes.append(gameFileType)
         if (canceledTaskCount==0):
             jrdfuncs.addFlashMessage(request, "No queued tasks to cancel.", True)
+        return changedGameFileTypes
 
 
 
@@ -681,6 +789,7 @@ class Game(models.Model):
         buildResults["lastBuildDateStart"] = lastBuildDateStart
         buildResults["lastBuildVersion"] = lastBuildVersion
         buildResults["lastBuildVersionDate"] = lastBuildVersionDate
+        buildResults["lastBuildFingerprint"] = jrfuncs.getDictValueOrDefault(buildResultsPrevious, "lastBuildFingerprint", "")
 
 
 
@@ -798,6 +907,14 @@ class GameFile(models.Model):
 
 
 
+    class Meta:
+        indexes = [
+            # file lists and counts filter on game (and file type)
+            models.Index(fields=["game", "gameFileType"], name="gamefile_game_type_idx"),
+        ]
+
+
+
     # helpers
     @staticmethod
     def get_or_none(**kwargs):
@@ -849,3 +966,21 @@ def calculateTextHashWithVersion(text):
     h.update(text.encode())
     hashValue = h.hexdigest() + "_" + settings.JR_STORYBUILDVERSION
     return hashValue
+
+
+
+# merge functions for Game.saveBuildStatus, deciding what to write for a mode whose build results someone else saved meanwhile
+
+def mergeQueuedBuildResults(game, storedResults, ourResults):
+    # we are queueing a new build; it replaces whatever status is stored, but the last build info must come from the newest stored results
+    # (a build of this mode may have finished meanwhile, with a new lastBuildFingerprint)
+    mergedResults = dict(ourResults)
+    game.copyLastBuildResultsTo(storedResults, mergedResults)
+    return mergedResults
+
+def mergeCanceledBuildResults(game, storedResults, ourResults):
+    # we marked a queued task canceled; only applies if the stored status is still about that same task waiting in the queue
+    # otherwise it started running, finished, or a new build was queued, and the stored status is newer than ours
+    if (storedResults.get("taskId", None) == ourResults.get("taskId", None)) and (storedResults.get("queueStatus", None) == Game.GameQueueStatusEnum_Queued):
+        return ourResults
+    return storedResults
@@ -3,6 +3,7 @@ from django import template
 from django.template.defaultfilters import stringfilter
 from django.db.models import Q
 from django.utils import timezone
+from django.utils.html import escape
 
 # user imports
 from ..models import Game
@@ -17,6 +18,7 @@ import datetime
 from lib.jr import jrfuncs
 from lib.jr.jrfuncs import jrprint
 from lib.jr import jrdfuncs
+from lib.jr import jrtiming
 
 
 # register template tags / functions
@@ -37,11 +39,11 @@ def userGameList(userPk, requestingUser):
       # they are viewing their own, so show NonPublic
       flagShowNonPublic = True
 
-  #
+  # only the listed fields (not the game text)
   if (flagShowNonPublic):
-    games = Game.objects.filter(Q(owner=userPk))
+    games = Game.getListQuerySet().filter(Q(owner=userPk))
   else:
-    games = Game.objects.filter(Q(owner=userPk) & Q(isPublic=True))
+    games = Game.getListQuerySet().filter(Q(owner=userPk) & Q(isPublic=True))
   #
   game_list = games
   return {"game_list": game_list, "flagShowNonPublic": flagShowNonPublic}
@@ -51,10 +53,10 @@ def userGameList(userPk, requestingUser):
 
 
 @register.inclusion_tag('games/templateInclusionFileUrlList.html')
-def fileUrlList(requestingUser, gamePk, gameFileTypeName, optionStr):
+def fileUrlList(requestingUser, game, gameFileTypeName, optionStr):
   """Build a list of files for a specific game of a specific type, with urls
   :param: requestingUser - user making the request; currently ignores
-  :param: gamePk - the game pk
+  :param: game - the game instance already loaded by the view (so including this several times on a page does not query the game again)
   :param: gameFileTypeName - the name of the game type  
   :return: list of gfiles with their urls
   """
@@ -67,15 +69,10 @@ def fileUrlList(requestingUser, gamePk, gameFileTypeName, optionStr):
   if ("noInfo" in optionStrList):
     options["noInfo"] = True
 
-  # get game
-  game = Game.objects.get(pk=gamePk)
-  if (game is None):
-      raise Exception("Failed to find game pk={}.".format(gamePk))
-
   # show NonPublic?
   flagShowNonPublic = False
   if (requestingUser.is_authenticated):
-    if (requestingUser.pk == game.owner):
+    if (requestingUser.pk == game.owner_id):
       # they are viewing their own, so show NonPublic
       flagShowNonPublic = True
 
@@ -118,6 +115,10 @@ def formatBuildResultsForHtmlList(game, buildResults):
     durationBuild = calcNiceDurationStringForBuildResult(buildResults, "buildDateStart", "buildDateEnd")
     listItems.append({"key": "Total time in queue", "label": durationQueued})
     listItems.append({"key": "Actual time to build", "label": durationBuild})
+    # where that time went
+    buildTimings = jrfuncs.getDictValueOrDefault(buildResults, "buildTimings", None)
+    if (buildTimings is not None):
+      listItems.append({"key": "Build time breakdown", "label": formatBuildTimingsAsHtml(buildTimings)})
   else:
     # incomplete queue
     statusStr = jrdfuncs.lookupDjangoChoiceLabel(queueStatus, Game.GameQueueStatusEnum)
@@ -207,6 +208,23 @@ def formatDictListAsHtmlList(listItems):
 
 
 
+def formatBuildTimingsAsHtml(buildTimings):
+  # nested list of the build stage timing tree (see lib/jr/jrtiming.py); stages under 1% of the total are left out
+  lines = jrtiming.formatTimingTreeLines(buildTimings, None, 0, buildTimings["secs"] * 0.01)
+  retHtml = ""
+  prevDepth = -1
+  for [depth, text] in lines:
+    if (depth > prevDepth):
+      retHtml += "<ul>" * (depth - prevDepth)
+    else:
+      retHtml += "</li></ul>" * (prevDepth - depth) + "</li>"
+    retHtml += "<li>" + escape(text)
+    prevDepth = depth
+  retHtml += "</li></ul>" * (prevDepth + 1)
+  return retHtml
+
+
+
 def calcNiceDurationStringForBuildResult(buildResults, startKeyName, endKeyName):
   startTimestamp = jrfuncs.getDictValueOrDefault(buildResults, startKeyName, None)
   endTimestamp = jrfuncs.getDictValueOrDefault(buildResults, endKeyName, None)
@@ -1,3 +1,443 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.template import Context, Template
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+# python modules
+import os
+import tempfile
+import shutil
+import sys
+import time
+
+# user modules
+from .models import Game, mergeCanceledBuildResults, mergeQueuedBuildResults
+from . import gamefilemanager
+from .gamefilemanager import GameFileManager
+from lib.hl.benchmarks.benchutils import makeBenchmarkParser, quietOutput, BenchmarkGameFileManager
+from lib.hl.benchmarks.benchcasebook import makeSyntheticCasebookText
+
 
 # Create your tests here.
+
+
+# query count regression tests for the game list and detail pages
+# the number of queries must not grow with the number of games on a page or the number of file lists on a game page,
+# and the game text (which can be the size of a whole casebook) must never be loaded for them
+
+class GamePageQueryCountTests(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.mediaRoot = tempfile.mkdtemp(prefix="hlgametests")
+        cls.mediaSettings = override_settings(MEDIA_ROOT=cls.mediaRoot)
+        cls.mediaSettings.enable()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.mediaSettings.disable()
+        shutil.rmtree(cls.mediaRoot, ignore_errors=True)
+
+    def setUp(self):
+        self.owner = get_user_model().objects.create_user(username="author", password="password")
+
+    def makeGames(self, count, isPublic=True):
+        games = []
+        for index in range(0, count):
+            game = Game(name="game{}".format(len(Game.objects.all())), title="Game", summary="Summary", text="# lead\nsome text\n" * 1000, isPublic=isPublic, isErrorInSettings=False, owner=self.owner)
+            game.save()
+            games.append(game)
+        return games
+
+    def assertNoGameTextQueried(self, capturedQueries):
+        for query in capturedQueries:
+            self.assertNotIn('"text"', query["sql"])
+
+
+    def testGameListQueryCount(self):
+        # one query to count games for the paginator and one for the page, however many games there are
+        self.makeGames(3)
+        with CaptureQueriesContext(connection) as capturedQueries:
+            response = self.client.get(reverse("gameHome"))
+        self.assertEqual(response.status_code, 200)
+        queryCount = len(capturedQueries)
+        self.assertNoGameTextQueried(capturedQueries)
+        #
+        self.makeGames(10)
+        with self.assertNumQueries(queryCount):
+            response = self.client.get(reverse("gameHome"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context["game_list"]), 13)
+        self.assertEqual(queryCount, 2)
+
+
+    @override_settings(JR_GAMELIST_PAGESIZE=5)
+    def testGameListPagination(self):
+        self.makeGames(7)
+        response = self.client.get(reverse("gameHome"))
+        self.assertTrue(response.context["is_paginated"])
+        self.assertEqual(len(response.context["game_list"]), 5)
+        response = self.client.get(reverse("gameHome") + "?page=2")
+        self.assertEqual(len(response.context["game_list"]), 2)
+
+
+    def testGameDetailQueryCount(self):
+        # the game (joined with its owner) once, and the count of its uploaded files
+        [game] = self.makeGames(1)
+        with CaptureQueriesContext(connection) as capturedQueries:
+            response = self.client.get(reverse("gameDetail", kwargs={"slug": game.slug}))
+        self.assertEqual(response.status_code, 200)
+        self.assertNoGameTextQueried(capturedQueries)
+        self.assertEqual(len(capturedQueries), 2)
+
+
+    def testGameGenerateQueryCount(self):
+        # the owner's build page has four file lists; they share the game the view loaded
+        [game] = self.makeGames(1, isPublic=False)
+        self.client.force_login(self.owner)
+        # first request loads the session and user
+        self.client.get(reverse("gameGenerate", kwargs={"slug": game.slug}))
+        with CaptureQueriesContext(connection) as capturedQueries:
+            response = self.client.get(reverse("gameGenerate", kwargs={"slug": game.slug}))
+        self.assertEqual(response.status_code, 200)
+        self.assertNoGameTextQueried(capturedQueries)
+        # session, user, game
+        self.assertEqual(len(capturedQueries), 3)
+
+
+    def testGameFileServeQueryCount(self):
+        # pdf viewers send many range requests per document; each is one game lookup, without the text
+        [game] = self.makeGames(1)
+        gameFileManager = GameFileManager(game)
+        dirPath = gameFileManager.getDirectoryPathForGameType(gamefilemanager.EnumGameFileTypeName_Published)
+        os.makedirs(dirPath, exist_ok=True)
+        with open(dirPath + "/game.pdf", "wb") as outFile:
+            outFile.write(b"0123456789")
+        url = reverse("gameFileServe", kwargs={"slug": game.slug, "gameFileType": gamefilemanager.EnumGameFileTypeName_Published, "fileName": "game.pdf"})
+        with CaptureQueriesContext(connection) as capturedQueries:
+            response = self.client.get(url, HTTP_RANGE="bytes=2-5")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response.streaming_content), b"2345")
+        self.assertNoGameTextQueried(capturedQueries)
+        self.assertEqual(len(capturedQueries), 1)
+
+
+    def testGameFileServeOnlyPublishedForOthers(self):
+        # the build directories of a public game are still private to its owner
+        [game] = self.makeGames(1)
+        gameFileManager = GameFileManager(game)
+        dirPath = gameFileManager.getDirectoryPathForGameType(gamefilemanager.EnumGameFileTypeName_Debug)
+        os.makedirs(dirPath, exist_ok=True)
+        with open(dirPath + "/game.pdf", "wb") as outFile:
+            outFile.write(b"debug")
+        url = reverse("gameFileServe", kwargs={"slug": game.slug, "gameFileType": gamefilemanager.EnumGameFileTypeName_Debug, "fileName": "game.pdf"})
+        response = self.client.get(url)
+        self.assertIn(response.status_code, [302, 403])
+        self.client.force_login(self.owner)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), b"debug")
+
+
+    def testUserGameListQueryCount(self):
+        self.makeGames(5)
+        self.makeGames(2, isPublic=False)
+        template = Template("{% load gametemplatetags %}{% userGameList ownerPk requestingUser %}")
+        with CaptureQueriesContext(connection) as capturedQueries:
+            html = template.render(Context({"ownerPk": self.owner.pk, "requestingUser": AnonymousUser()}))
+        self.assertEqual(html.count('class="gameEntry"'), 5)
+        self.assertNoGameTextQueried(capturedQueries)
+        self.assertEqual(len(capturedQueries), 1)
+
+
+
+
+# build status saves only write the build status fields, and do not lose updates made by others meanwhile
+
+class GameBuildStatusSaveTests(TestCase):
+
+    def setUp(self):
+        self.owner = get_user_model().objects.create_user(username="author", password="password")
+        self.game = Game(name="game", title="Game", text="original text", isPublic=False, isErrorInSettings=False, owner=self.owner)
+        self.game.save()
+
+    def testBuildStatusSaveKeepsNewerText(self):
+        # a build loaded the game, then the author edited the text before the build finished
+        buildGame = Game.objects.get(pk=self.game.pk)
+        authorGame = Game.objects.get(pk=self.game.pk)
+        authorGame.text = "newer text"
+        authorGame.save()
+        buildGame.setBuildResults("buildDraft", {"queueStatus": Game.GameQueueStatusEnum_Completed})
+        buildGame.lastBuildLog = "built"
+        buildGame.saveBuildStatus(["buildDraft"], ["lastBuildLog"])
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual(game.text, "newer text")
+        self.assertEqual(game.lastBuildLog, "built")
+        self.assertEqual(game.getBuildResults("buildDraft")["queueStatus"], Game.GameQueueStatusEnum_Completed)
+
+    def testStaleBuildStatusSaveKeepsOtherResults(self):
+        # two builds of different modes, each working from the build results as they were when it started
+        draftGame = Game.objects.get(pk=self.game.pk)
+        debugGame = Game.objects.get(pk=self.game.pk)
+        draftGame.setBuildResults("buildDraft", {"queueStatus": Game.GameQueueStatusEnum_Completed})
+        draftGame.saveBuildStatus(["buildDraft"])
+        debugGame.setBuildResults("buildDebug", {"queueStatus": Game.GameQueueStatusEnum_Errored})
+        debugGame.saveBuildStatus(["buildDebug"])
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual(game.getBuildResults("buildDraft")["queueStatus"], Game.GameQueueStatusEnum_Completed)
+        self.assertEqual(game.getBuildResults("buildDebug")["queueStatus"], Game.GameQueueStatusEnum_Errored)
+        self.assertEqual(game.buildStatusVersion, 2)
+
+    def testStaleCancelKeepsNewerStatusOfSameMode(self):
+        # the web request marks a queued build canceled just as the worker starts running it
+        cancelGame = Game.objects.get(pk=self.game.pk)
+        workerGame = Game.objects.get(pk=self.game.pk)
+        cancelGame.setBuildResults("buildDraft", {"queueStatus": Game.GameQueueStatusEnum_Aborted, "canceled": True, "taskId": "task1"})
+        workerGame.setBuildResults("buildDraft", {"queueStatus": Game.GameQueueStatusEnum_Running, "taskId": "task1"})
+        workerGame.saveBuildStatus(["buildDraft"])
+        cancelGame.saveBuildStatus(["buildDraft"], [], mergeCanceledBuildResults)
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual(game.getBuildResults("buildDraft")["queueStatus"], Game.GameQueueStatusEnum_Running)
+
+    def testStaleQueueKeepsNewerLastBuild(self):
+        # a new build is queued while the previous build of the same mode finishes
+        queueGame = Game.objects.get(pk=self.game.pk)
+        workerGame = Game.objects.get(pk=self.game.pk)
+        workerGame.setBuildResults("buildDraft", {"queueStatus": Game.GameQueueStatusEnum_Completed, "lastBuildFingerprint": "newer", "lastBuildDateStart": 2})
+        workerGame.saveBuildStatus(["buildDraft"])
+        queueGame.setBuildResults("buildDraft", {"queueStatus": Game.GameQueueStatusEnum_Queued, "taskId": "task2", "lastBuildFingerprint": "older", "lastBuildDateStart": 1})
+        queueGame.saveBuildStatus(["buildDraft"], [], mergeQueuedBuildResults)
+        buildResults = Game.objects.get(pk=self.game.pk).getBuildResults("buildDraft")
+        self.assertEqual(buildResults["queueStatus"], Game.GameQueueStatusEnum_Queued)
+        self.assertEqual(buildResults["taskId"], "task2")
+        self.assertEqual(buildResults["lastBuildFingerprint"], "newer")
+
+    def testGameSaveKeepsBuildResults(self):
+        # the author saves an edit made on an instance loaded before a build finished
+        authorGame = Game.objects.get(pk=self.game.pk)
+        buildGame = Game.objects.get(pk=self.game.pk)
+        buildGame.setBuildResults("buildDraft", {"queueStatus": Game.GameQueueStatusEnum_Completed})
+        buildGame.lastBuildLog = "built"
+        buildGame.saveBuildStatus(["buildDraft"], ["lastBuildLog"])
+        authorGame.text = "newer text"
+        authorGame.save()
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertEqual(game.text, "newer text")
+        self.assertEqual(game.getBuildResults("buildDraft")["queueStatus"], Game.GameQueueStatusEnum_Completed)
+        self.assertEqual(game.lastBuildLog, "built")
+
+    def testGameSaveKeepsSettingsStatusLog(self):
+        # an edit that parses the game settings again does write its result into the log
+        mediaRoot = tempfile.mkdtemp(prefix="hlgametests")
+        self.addCleanup(shutil.rmtree, mediaRoot, True)
+        game = Game.objects.get(pk=self.game.pk)
+        game.text = "newer text"
+        game.clean()
+        with override_settings(MEDIA_ROOT=mediaRoot):
+            game.save()
+        game = Game.objects.get(pk=self.game.pk)
+        self.assertTrue(game.lastBuildLog.startswith("ERROR while parsing game text settings") or game.lastBuildLog.startswith("Game text settings parsed"))
+
+    def testSaveSkipsSlugQueriesWhenUnchanged(self):
+        game = Game.objects.get(pk=self.game.pk)
+        game.summary = "changed"
+        # just the update
+        with self.assertNumQueries(1):
+            game.save()
+        game.name = "renamed"
+        game.slug = ""
+        game.save()
+        self.assertEqual(Game.objects.get(pk=self.game.pk).slug, "renamed")
+
+
+
+
+# background pdflatex compiles (HlParser.generatePdflatexAsync and runBuildList with latexCompileWorkers), against a stub pdflatex on PATH
+# the stub writes a pdf and aux file for the document, except for documents containing "hlteststall" which it never finishes
+
+stubPdflatexScript = """#!{}
+import sys, os, time
+args = sys.argv[1:]
+if ("--version" in args):
+    print("pdfTeX stub")
+    sys.exit(0)
+if ("-ini" in args):
+    sys.exit(1)
+outDir = [arg.split("=", 1)[1] for arg in args if arg.startswith("-output-directory=")][0]
+texFilePath = args[-1]
+with open(texFilePath, encoding="utf-8") as inFile:
+    text = inFile.read()
+if ("hlteststall" in text):
+    time.sleep(60)
+baseName = os.path.splitext(os.path.basename(texFilePath))[0]
+for extension in ["pdf", "aux"]:
+    with open(os.path.join(outDir, baseName + "." + extension), "w") as outFile:
+        outFile.write("stub")
+print("Output written on " + baseName + ".pdf")
+"""
+
+
+class PdflatexCompileTests(SimpleTestCase):
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp(prefix="hlpdflatextests")
+        binDir = self.workDir + "/bin"
+        os.makedirs(binDir)
+        stubFilePath = binDir + "/pdflatex.exe"
+        with open(stubFilePath, "w") as outFile:
+            outFile.write(stubPdflatexScript.format(sys.executable))
+        os.chmod(stubFilePath, 0o755)
+        self.oldPath = os.environ["PATH"]
+        os.environ["PATH"] = binDir + os.pathsep + self.oldPath
+
+    def tearDown(self):
+        os.environ["PATH"] = self.oldPath
+        shutil.rmtree(self.workDir, ignore_errors=True)
+
+    def makeParser(self, extraOptions={}, renderOptions={}):
+        options = {"latexFormatCacheDir": self.workDir + "/formats", "latexCompileWorkers": 2}
+        options.update(extraOptions)
+        parser = makeBenchmarkParser(options)
+        parser.jroptions.dataDict["options"]["renderOptions"].update(renderOptions)
+        parser.calculatedRenderOptions = None
+        self.addCleanup(parser.shutdownPdflatexCompileExecutor)
+        return parser
+
+    def makeLatexFile(self, name, text):
+        filePath = "{}/{}.latex".format(self.workDir, name)
+        with open(filePath, "w", encoding="utf-8") as outFile:
+            outFile.write(text)
+        return filePath
+
+    def testWait(self):
+        parser = self.makeParser()
+        with quietOutput():
+            jobs = [parser.generatePdflatexAsync(self.makeLatexFile("doc{}".format(i), "text"), True) for i in range(3)]
+            results = [job.wait() for job in jobs]
+        self.assertEqual([result["errored"] for result in results], [False, False, False])
+        for i in range(3):
+            self.assertTrue(os.path.isfile("{}/doc{}.pdf".format(self.workDir, i)))
+        self.assertEqual(parser.getBuildErrorCount(), 0)
+
+    def testCancel(self):
+        parser = self.makeParser()
+        with quietOutput():
+            job = parser.generatePdflatexAsync(self.makeLatexFile("stall", "hlteststall"), True)
+            # let the stub start, so that cancel has to kill it
+            timeStart = time.time()
+            while (job.process is None) and (time.time() - timeStart < 10):
+                time.sleep(0.05)
+            job.cancel()
+            result = job.wait(20)
+        self.assertTrue(result["errored"])
+        self.assertTrue(result["canceled"])
+        self.assertFalse(result["timedOut"])
+        self.assertLess(time.time() - timeStart, 20)
+        self.assertGreater(parser.getBuildErrorCount(), 0)
+
+    def testTimeout(self):
+        parser = self.makeParser(renderOptions={"latexTimeout": 1})
+        with quietOutput():
+            job = parser.generatePdflatexAsync(self.makeLatexFile("stall", "hlteststall"), True)
+            result = job.wait(20)
+        self.assertTrue(result["errored"])
+        self.assertTrue(result["timedOut"])
+        self.assertFalse(result["canceled"])
+
+    def testBuildListCompilesInBackground(self):
+        buildList = [
+            {"label": "onecol", "gameName": "test", "format": "pdf", "paperSize": "LETTER", "layout": "onecol", "variant": "normal", "gameFileType": "buildDraft", "fontSize": "10pt", "paperSizeLatex": "letter", "doubleSided": False, "columns": 1, "solo": False, "suffix": "_onecol"},
+            {"label": "twocol", "gameName": "test", "format": "pdf", "paperSize": "LETTER", "layout": "twocol", "variant": "normal", "gameFileType": "buildDraft", "fontSize": "10pt", "paperSizeLatex": "letter", "doubleSided": False, "columns": 2, "solo": False, "suffix": "_twocol"},
+            {"label": "zip", "gameName": "test", "variant": "zip", "layout": None, "gameFileType": "buildDraft"},
+            ]
+        parser = self.makeParser({"gameFileManager": BenchmarkGameFileManager(self.workDir + "/build"), "buildList": buildList})
+        with quietOutput():
+            parser.parseStoryTextIntoBlocks(makeSyntheticCasebookText(10), "test")
+            success = parser.runBuildList(False)
+        self.assertTrue(success, parser.getBuildLog())
+        generatedFileNames = [os.path.basename(filePath) for filePath in parser.getGeneratedFileList()]
+        # pdfs in build list order, then the zip made after both compiles finished
+        self.assertEqual(generatedFileNames[0:2], ["test_onecol.pdf", "test_twocol.pdf"])
+        self.assertTrue(generatedFileNames[2].endswith(".zip"))
+        self.assertIsNone(parser.pdflatexCompileExecutor)
+
+
+
+
+# rendering a section's lead markdown in one batch (markdownBatch render option) must give the same document as rendering lead by lead
+
+class MarkdownBatchRenderTests(SimpleTestCase):
+
+    def renderLeadsText(self, markdownBatch, storyText):
+        workDir = tempfile.mkdtemp(prefix="hlbatchtests")
+        self.addCleanup(shutil.rmtree, workDir, True)
+        parser = makeBenchmarkParser({"chapterSaveDir": workDir})
+        renderOptions = parser.jroptions.dataDict["options"]["renderOptions"]
+        renderOptions["compileLatex"] = False
+        renderOptions["markdownBatch"] = markdownBatch
+        parser.calculatedRenderOptions = None
+        parser.hlMarkdown.renderCache = None
+        # count how often each lead's markdown is assembled
+        buildCounts = {}
+        buildLeadMarkdownText = parser.buildLeadMarkdownText
+        def countingBuildLeadMarkdownText(lead, *args):
+            buildCounts[lead["properties"]["id"]] = buildCounts.get(lead["properties"]["id"], 0) + 1
+            return buildLeadMarkdownText(lead, *args)
+        parser.buildLeadMarkdownText = countingBuildLeadMarkdownText
+        with quietOutput():
+            parser.parseStoryTextIntoBlocks(storyText, "test")
+            parser.processHeadBlocks()
+            parser.processLeads()
+            parser.renderLeads({"suffix": "", "mode": "normal"}, False)
+        self.assertEqual(parser.getBuildErrorCount(), 0, parser.getBuildLog())
+        [outFilePath] = [dirEntry.path for dirEntry in os.scandir(workDir) if dirEntry.name.endswith(".latex")]
+        with open(outFilePath, encoding="utf-8") as inFile:
+            return [inFile.read(), buildCounts]
+
+    def testBatchMatchesLeadByLead(self):
+        storyText = makeSyntheticCasebookText(30)
+        [textSingle, buildCountsSingle] = self.renderLeadsText(False, storyText)
+        [textBatch, buildCountsBatch] = self.renderLeadsText(True, storyText)
+        self.assertEqual(textBatch, textSingle)
+        # the batch's lead text is used as is, not assembled again by renderLead
+        self.assertGreater(len(buildCountsBatch), 1)
+        self.assertEqual(set(buildCountsBatch.values()), {1})
+
+
+
+
+# the artifact store keeps one read only blob per distinct built file; blobs no game file links to anymore are swept up
+
+class ArtifactStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        self.workDir = tempfile.mkdtemp(prefix="hlartifacttests")
+        self.addCleanup(shutil.rmtree, self.workDir, True)
+        self.storeSettings = override_settings(JR_DIR_ARTIFACTSTORE=self.workDir + "/artifacts")
+        self.storeSettings.enable()
+        self.addCleanup(self.storeSettings.disable)
+
+    def writeFile(self, fileName, data):
+        filePath = self.workDir + "/" + fileName
+        with open(filePath, "wb") as outFile:
+            outFile.write(data)
+        return filePath
+
+    def testReleaseUnusedArtifacts(self):
+        artifactStore = gamefilemanager.getArtifactStore()
+        keptFilePath = self.writeFile("kept.pdf", b"kept")
+        deletedFilePath = self.writeFile("deleted.pdf", b"deleted")
+        keptHash = artifactStore.ingestFile(keptFilePath)
+        deletedHash = artifactStore.ingestFile(deletedFilePath)
+        self.assertTrue(artifactStore.isLinkedToBlob(keptFilePath, keptHash))
+        # the linked file shares the blob's read only permissions
+        self.assertEqual(os.stat(keptFilePath).st_mode & 0o222, 0)
+        os.remove(deletedFilePath)
+        self.assertEqual(gamefilemanager.releaseUnusedArtifacts(), 1)
+        self.assertTrue(artifactStore.hasBlob(keptHash))
+        self.assertFalse(artifactStore.hasBlob(deletedHash))
@@ -1,7 +1,7 @@
 from django.urls import path
 
 from .views import GameListView, GameDetailView, GameCreateView, GameEditView, GameDeleteView, GameGenerateView, GamePlayView
-from .views import GameCreateFileView, GameFilesListView, GameFilesReconcileView, GameVersionFileListView
+from .views import GameCreateFileView, GameFilesListView, GameFilesReconcileView, GameFilesZipView, GameFileServeView, GameVersionFileListView
 from .views import GameFileDetailView, GameFileEditView, GameFileDeleteView, GameChangeDirView
 #
 
@@ -27,6 +27,8 @@ urlpatterns = [
     path("game/<slug:slug>/files/", GameFilesListView.as_view(), name="gameFileList"),
     path("game/<slug:slug>/files/new/", GameCreateFileView.as_view(), name="gameFileCreate"),
     path("game/<slug:slug>/files/reconcile/", GameFilesReconcileView.as_view(), name="gameFileReconcile"),
+    path("game/<slug:slug>/files/zip/<str:gameFileType>/", GameFilesZipView.as_view(), name="gameFilesZip"),
+    path("game/<slug:slug>/files/get/<str:gameFileType>/<str:fileName>", GameFileServeView.as_view(), name="gameFileServe"),
 
     #
     # game/ new filelist related
@@ -4,7 +4,8 @@ from django.urls import reverse, reverse_lazy
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin, PermissionRequiredMixin
 from django.shortcuts import get_object_or_404
 from django.contrib import messages
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse, Http404
+from django.conf import settings
 
 
 # python modules
@@ -16,6 +17,7 @@ from .models import Game, GameFile
 from .forms import GameFileMultipleUploadForm, GameFormForEdit, GameFormForCreate, GameFormForChangeDir
 from . import gamefilemanager
 from lib.jr import jrdfuncs
+from lib.jr import jrzip
 
 
 
@@ -35,6 +37,22 @@ def viewAddGameFileListCountToContext(gameViewInstance, context):
     context['gameFileListCount'] = gameFileListCount
 
 
+class GameDetailQueryMixin:
+    # for game views that show game info, files and build status
+    # on GET the game is loaded without its big text fields (see Game.getDetailQuerySet), and only once per request, since test_func, get and get_context_data all ask for it
+    def get_queryset(self):
+        if (self.request.method in ["GET", "HEAD"]):
+            return Game.getDetailQuerySet()
+        return super().get_queryset()
+
+    def get_object(self, queryset=None):
+        if (queryset is not None):
+            return super().get_object(queryset)
+        if (not hasattr(self, "cachedGameObject")):
+            self.cachedGameObject = super().get_object()
+        return self.cachedGameObject
+
+
 
 
 # Games
@@ -43,8 +61,15 @@ class GameListView(ListView):
     model = Game
     template_name = "games/gameList.html"
 
+    def get_paginate_by(self, queryset):
+        return settings.JR_GAMELIST_PAGESIZE
 
-class GameDetailView(UserPassesTestMixin, DetailView):
+    def get_queryset(self):
+        # only the fields the list shows (not the game text)
+        return Game.getListQuerySet()
+
+
+class GameDetailView(GameDetailQueryMixin, UserPassesTestMixin, DetailView):
     model = Game
     template_name = "games/gameDetail.html"
 
@@ -227,7 +252,7 @@ class GameDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
 
 
 
-class GameVersionFileListView(LoginRequiredMixin, UserPassesTestMixin, DetailView):
+class GameVersionFileListView(GameDetailQueryMixin, LoginRequiredMixin, UserPassesTestMixin, DetailView):
     model = Game
     template_name = "games/gameVersionFileList.html"
 
@@ -245,7 +270,7 @@ class GameVersionFileListView(LoginRequiredMixin, UserPassesTestMixin, DetailVie
 
 
 
-class GameGenerateView(LoginRequiredMixin, UserPassesTestMixin, DetailView):
+class GameGenerateView(GameDetailQueryMixin, LoginRequiredMixin, UserPassesTestMixin, DetailView):
     model = Game
     template_name = "games/gameGeneratedFileList.html"
 
@@ -335,6 +360,64 @@ class GameFilesListView(LoginRequiredMixin, UserPassesTestMixin, ListView):
 
 
 
+class GameFilesZipView(GameDetailQueryMixin, UserPassesTestMixin, DetailView):
+    # streams a zip of all the files of one game file type (e.g. buildDraft), made on the fly without writing it to disk
+    model = Game
+    zippableGameFileTypes = [gamefilemanager.EnumGameFileTypeName_StoryUpload, gamefilemanager.EnumGameFileTypeName_DraftBuild, gamefilemanager.EnumGameFileTypeName_PreferredBuild, gamefilemanager.EnumGameFileTypeName_Debug, gamefilemanager.EnumGameFileTypeName_Published]
+
+    def test_func(self):
+        # owner can zip any of their file types; anyone can zip the published files of a public game
+        obj = self.get_object()
+        gameFileType = self.kwargs["gameFileType"]
+        return (obj.owner == self.request.user) or ((obj.isPublic) and (gameFileType == gamefilemanager.EnumGameFileTypeName_Published))
+
+    def get(self, request, *args, **kwargs):
+        game = self.get_object()
+        gameFileType = self.kwargs["gameFileType"]
+        if (gameFileType not in self.zippableGameFileTypes):
+            raise Http404("Unknown game file type.")
+        gameFileManager = gamefilemanager.GameFileManager(game)
+        dirPath = gameFileManager.getDirectoryPathForGameType(gameFileType)
+        if (not os.path.isdir(dirPath)):
+            raise Http404("No files.")
+        entryList = jrzip.makeDirectoryZipEntryList(dirPath)
+        response = StreamingHttpResponse(jrzip.iterZipChunks(entryList), content_type="application/zip")
+        response["Content-Disposition"] = 'attachment; filename="{}_{}.zip"'.format(game.slug, gameFileType)
+        return response
+
+
+
+
+
+class GameFileServeView(GameDetailQueryMixin, UserPassesTestMixin, DetailView):
+    # serves one built file (pdf, zip) of a game with range requests, etags and conditional gets (see jrdfuncs.serveFileWithRanges)
+    model = Game
+
+    def test_func(self):
+        # owner can get any of their served file types; anyone can get the published files of a public game (like GameFilesZipView)
+        obj = self.get_object()
+        gameFileType = self.kwargs["gameFileType"]
+        return (obj.owner == self.request.user) or ((obj.isPublic) and (gameFileType == gamefilemanager.EnumGameFileTypeName_Published))
+
+    def get(self, request, *args, **kwargs):
+        game = self.get_object()
+        gameFileType = self.kwargs["gameFileType"]
+        fileName = self.kwargs["fileName"]
+        if (gameFileType not in gamefilemanager.ServedGameFileTypes) or (fileName != os.path.basename(fileName)) or (fileName.startswith(".")):
+            raise Http404("File not found.")
+        gameFileManager = gamefilemanager.GameFileManager(game)
+        filePath = gameFileManager.getDirectoryPathForGameType(gameFileType) + "/" + fileName
+        if (not os.path.isfile(filePath)):
+            raise Http404("File not found.")
+        # a strong etag from the content hash when the file is in the artifact store
+        hexHash = gameFileManager.getArtifactHashForFile(gameFileType, fileName)
+        etag = None if (hexHash is None) else '"{}"'.format(hexHash)
+        return jrdfuncs.serveFileWithRanges(request, filePath, etag, fileName.endswith(".zip"), settings.JR_FILESERVE_OFFLOAD, str(settings.MEDIA_ROOT), settings.JR_FILESERVE_XACCELPREFIX)
+
+
+
+
+
 class GameFilesReconcileView(LoginRequiredMixin, UserPassesTestMixin, DetailView):
     # helper view to reconcile all uploaded files for a game
     model = GameFile
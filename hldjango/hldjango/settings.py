@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 from pathlib import Path
+import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -157,6 +158,18 @@ STATIC_URL = "static/"
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 
+# build queue topology (see hltasks.queueTaskBuildStoryPdf)
+# worker processes (default one per two cpus, since latex and rendering are cpu bound and each build also compiles in the background, see JR_LATEXCOMPILEWORKERS); can be set in the environment of the consumer
+JR_BUILDQUEUEWORKERS = int(os.environ.get("JR_BUILDQUEUEWORKERS", "0")) or max(1, (os.cpu_count() or 1) // 2)
+# higher priority builds are taken off the queue first, so a quick preferred build isn't stuck behind someone's draft set
+JR_BUILDQUEUEPRIORITIES = {"buildPreferred": 20, "buildDebug": 20, "buildDraft": 0}
+# max builds running at once for one user (0 for no limit); extra ones wait in the queue, retried every JR_BUILDQUEUEUSERRETRYDELAY seconds
+JR_BUILDQUEUEUSERLIMIT = 2
+JR_BUILDQUEUEUSERRETRYDELAY = 15
+# a user's build slot older than this (seconds) is assumed to have been left behind by a killed worker
+JR_BUILDQUEUESLOTTIMEOUT = 2 * 60 * 60
+
+
 # see https://huey.readthedocs.io/en/latest/django.html
 HUEY = {
     "huey_class": "huey.SqliteHuey",  # Huey implementation to use.
@@ -171,8 +184,8 @@ HUEY = {
     "utc": True,  # Use UTC for all times internally.
     "connection": {},
     "consumer": {
-        "workers": 1,
-        "worker_type": "thread",
+        "workers": JR_BUILDQUEUEWORKERS,
+        "worker_type": "process",
         "initial_delay": 0.1,  # Smallest polling interval, same as -d.
         "backoff": 1.15,  # Exponential backoff using this rate, -b.
         "max_delay": 10.0,  # Max possible polling interval, -m.
@@ -281,6 +294,24 @@ DELETE_USER_GAMEFOLDER_METHOD = "rename"
 JR_STORYBUILDVERSION = "v1"
 JR_MAXUPLOADGAMEFILESIZE = 10000000
 JR_DIR_SHAREDIMAGES = MEDIA_ROOT / "shared/images"
+# content addressed store of built files; game build/published directories hard link into it (see lib/jr/jrblobstore.py)
+JR_DIR_ARTIFACTSTORE = MEDIA_ROOT / "artifacts"
+# hour of the day (utc) to delete artifacts no game file links to anymore (see hltasks.periodicTaskReleaseUnusedArtifacts)
+JR_ARTIFACTSWEEPHOUR = 4
+# built game files are served by games.views.GameFileServeView; set to "xsendfile" (apache) or "xaccel" (nginx) to let the web server send the bytes
+# for xaccel, JR_FILESERVE_XACCELPREFIX is an internal nginx location aliased to MEDIA_ROOT
+JR_FILESERVE_OFFLOAD = None
+JR_FILESERVE_XACCELPREFIX = "/protected_media/"
+# games per page on the game list
+JR_GAMELIST_PAGESIZE = 50
+# how often (seconds) a cached game file list rechecks its directory mtime (see GameFileManager.getDirectoryManifest)
+JR_FILEMANIFEST_RECHECKSECS = 2
+# how many pdflatex compiles of one build run at once (threads in the build worker, see HlParser.runBuildList); the variants still render one after another,
+# each compiling in the background while the next renders; 1 compiles each one right after rendering it
+# sized with the queue so that queue workers x compile workers <= cpu count
+JR_LATEXCOMPILEWORKERS = max(1, min(4, (os.cpu_count() or 1) // JR_BUILDQUEUEWORKERS))
+# quiet logging drops the per lead / per file progress messages (jrfuncs.jrprintVerbose) from console and log files
+JR_LOGQUIET = not DEBUG
 
 
 # now override with any secret settings
@@ -1,12 +1,6 @@
 # see https://huey.readthedocs.io/en/latest/imports.html for evilness
+# see https://huey.readthedocs.io/en/latest/django.html
 
-# heury scheduler
-from huey import SqliteHuey
-
-# custom settings
-JR_BypassHuey = True
-
-
-# Globally instantiate the heuy task scheduler helper object (this will be referred to via commandline tool so needs to be module global)
-# see https://huey.readthedocs.io/en/latest/guide.html
-huey = SqliteHuey(filename='./hueyHl.db', immediate=JR_BypassHuey)
+# the one huey task scheduler object for the site, created by djhuey from settings.HUEY (storage, immediate mode, consumer workers)
+# hltasks registers its tasks on it and hueymain runs the consumer for it, so they always agree on which queue they are talking to
+from huey.contrib.djhuey import HUEY as huey
@@ -1,13 +1,14 @@
 # see https://huey.readthedocs.io/en/latest/imports.html for evilness
-from hueyconfig import huey
-from lib.hl.hltasks import queueTaskBuildStoryPdf
+# consumer entry point: python hueymain.py [run_huey options, e.g. --workers 2]
+# worker count/type and polling come from settings.HUEY["consumer"], command line options override them
 
 # python modules
 import sys
 import os
 
-# copied from huey_consumer.py
-from huey.bin import huey_consumer
+# django
+import django
+from django.core.management import call_command
 
 # user modules
 from lib.jr import jrfuncs
@@ -21,10 +22,9 @@ jrfuncs.setLogFileDir(logdir)
 
 if __name__ == '__main__':
     print("Trying to start up huey consumer..")
-    if sys.version_info >= (3, 8) and sys.platform == 'darwin':
-        import multiprocessing
-        try:
-            multiprocessing.set_start_method('fork')
-        except RuntimeError:
-            pass
-    huey_consumer.consumer_main()
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "hldjango.settings")
+    django.setup()
+    # the shared huey instance and the tasks registered on it (run_huey also autodiscovers tasks modules)
+    from hueyconfig import huey
+    from lib.hl.hltasks import queueTaskBuildStoryPdf
+    call_command("run_huey", *sys.argv[1:])
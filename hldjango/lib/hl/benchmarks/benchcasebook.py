@@ -0,0 +1,119 @@
+# generator of synthetic casebooks (story text) of configurable size for the benchmarks
+# the text is deterministic for a given set of arguments, so timings are comparable across commits
+#
+# a casebook has an options block, a setup lead defining tags, a cover and summary, then for each day a section of leads
+# leads link to each other with golead/goleadback, gain and require tags, check days, have markdown, and some start inline chains
+# plus document leads (doc.*) and hint leads (hint.cond.*) for the tags
+#
+# usage (from the hldjango directory), to write one out for a look:
+#   python -m lib.hl.benchmarks.benchcasebook --leads 1000 --out casebook.txt
+
+# python modules
+import random
+import argparse
+
+
+
+
+# ---------------------------------------------------------------------------
+sentenceSubjects = ['The inspector', 'A nervous clerk', 'The landlady', 'Your partner', 'A street vendor', 'The coroner', 'An old sailor', 'The night watchman']
+sentenceVerbs = ['mentions', 'denies knowing about', 'points you toward', 'is worried about', 'remembers', 'hands you a note about', 'laughs at', 'whispers about']
+sentenceObjects = ['the missing ledger', 'a torn photograph', 'the harbor warehouse', 'a locked strongbox', 'the late train', 'a broken pocket watch', 'the pawn shop', 'an unsigned letter']
+
+
+def makeSentence(rng):
+    return '{} {} {}.'.format(rng.choice(sentenceSubjects), rng.choice(sentenceVerbs), rng.choice(sentenceObjects))
+
+
+def makeParagraph(rng, sentenceCount):
+    return ' '.join([makeSentence(rng) for i in range(0, sentenceCount)])
+
+
+def calcLeadId(leadIndex, dayCount, leadCount):
+    # leads are spread evenly over the days; ids look like "D<day>-<number>" so each day gets its own section
+    # (and never collide with the directory style "<section>-<number>" ids handed out to inline leads)
+    leadsPerDay = max(1, (leadCount + dayCount - 1) // dayCount)
+    return 'D{}-{}'.format(leadIndex // leadsPerDay + 1, leadIndex % leadsPerDay + 1)
+
+
+def makeSyntheticCasebookText(leadCount, dayCount=3, tagCount=50, docCount=None, hintCount=None, inlineEvery=10, seed=1):
+    # returns story text with leadCount normal leads (plus docs, hints and a few special leads)
+    rng = random.Random(seed)
+    dayCount = max(1, min(dayCount, leadCount))
+    tagCount = max(1, tagCount)
+    if (docCount is None):
+        docCount = max(1, leadCount // 20)
+    if (hintCount is None):
+        hintCount = max(1, leadCount // 20)
+    hintCount = min(hintCount, tagCount)
+    leadIds = [calcLeadId(leadIndex, dayCount, leadCount) for leadIndex in range(0, leadCount)]
+    #
+    parts = []
+    parts.append('# options\n{"info": {"name": "synthetic casebook", "title": "The Synthetic Case", "version": "1.0", "date": "benchmark"}}\n\n')
+    parts.append('# setup\n')
+    # the tags that have hint leads are defined by those
+    for tagIndex in range(hintCount, tagCount):
+        parts.append('{{definetag(id=cond.T{}, comment="clue {}")}}\n'.format(tagIndex, tagIndex))
+    parts.append('\n# cover: The Synthetic Case\n{}\n\n'.format(makeParagraph(rng, 3)))
+    parts.append('# summary: Case summary\n{}\n\n'.format(makeParagraph(rng, 4)))
+    #
+    for leadIndex, leadId in enumerate(leadIds):
+        day = int(leadId.split('-')[0][1:])
+        lines = []
+        lines.append('# {}: {}, day {}'.format(leadId, rng.choice(sentenceObjects).capitalize(), day))
+        lines.append(makeParagraph(rng, rng.randint(2, 6)))
+        # links
+        nextId = leadIds[(leadIndex + 1) % leadCount]
+        otherId = leadIds[rng.randint(0, leadCount-1)]
+        lines.append('If you want to follow up, $golead({}); otherwise you could try $goleadback({}).'.format(nextId, otherId))
+        # tags
+        tagIndex = rng.randint(0, tagCount-1)
+        lines.append('{{gaintag(cond.T{})}}'.format(tagIndex))
+        if (leadIndex % 3 == 0):
+            requiredTagIndex = rng.randint(0, tagCount-1)
+            lines.append('{{requiretag(cond.T{})}}'.format(requiredTagIndex))
+            lines.append('{{hastag(cond.T{})}} **You recall** the earlier clue. {{otherwise()}} Nothing comes to mind.'.format(requiredTagIndex))
+        # days
+        if (day > 1) and (leadIndex % 4 == 1):
+            lines.append('{{beforeday({})}} It is still early in the case. {{otherwise()}} Time is running out.'.format(day + 1))
+        # markdown
+        if (leadIndex % 5 == 2):
+            lines.append('\n- {}\n- *{}*\n\n> "{}" says the **witness**.\n'.format(makeSentence(rng), makeSentence(rng), makeSentence(rng)))
+        # inline chain (an inline lead that itself starts another)
+        if (inlineEvery > 0) and (leadIndex % inlineEvery == inlineEvery - 1):
+            lines.append('{{inline(label="search the {}")}}'.format(rng.choice(sentenceObjects)))
+            lines.append(makeParagraph(rng, 2))
+            lines.append('{inlineback(label="look closer")}')
+            lines.append(makeParagraph(rng, 1))
+            lines.append('{end()}')
+            lines.append('{end()}')
+        # mention a document now and then
+        if (leadIndex % 7 == 3):
+            lines.append('You find $golead(doc.D{}).'.format(rng.randint(0, docCount-1)))
+        parts.append('\n'.join(lines) + '\n\n')
+    #
+    for docIndex in range(0, docCount):
+        parts.append('# doc.D{}: Document {}\n{}\n\n'.format(docIndex, docIndex, makeParagraph(rng, 3)))
+    for hintIndex in range(0, hintCount):
+        parts.append('# hint.cond.T{}: Hint for clue {}\n{}\n{{autohint()}}\n\n'.format(hintIndex, hintIndex, makeParagraph(rng, 2)))
+    return ''.join(parts)
+# ---------------------------------------------------------------------------
+
+
+
+
+# ---------------------------------------------------------------------------
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Write out a synthetic casebook.')
+    argParser.add_argument('--leads', type=int, default=1000)
+    argParser.add_argument('--days', type=int, default=3)
+    argParser.add_argument('--tags', type=int, default=50)
+    argParser.add_argument('--seed', type=int, default=1)
+    argParser.add_argument('--out', default='casebook.txt')
+    args = argParser.parse_args()
+    #
+    text = makeSyntheticCasebookText(args.leads, args.days, args.tags, seed=args.seed)
+    with open(args.out, 'w', encoding='utf-8') as outFile:
+        outFile.write(text)
+    print('Wrote {} characters to {}.'.format(len(text), args.out))
+# ---------------------------------------------------------------------------
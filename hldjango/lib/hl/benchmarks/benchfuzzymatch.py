@@ -0,0 +1,92 @@
+# benchmark of the HlApi approximate name/address matcher
+# compares latency and result agreement of the trigram shortlist matcher (findLeadRowSimilarByNameOrAddress)
+# against the original exhaustive SequenceMatcher sweep (findLeadRowSimilarByNameOrAddressSweep)
+#
+# usage (from the hldjango directory):
+#   python -m lib.hl.benchmarks.benchfuzzymatch [--queries 200] [--dataversion v2]
+
+# imports
+from lib.hl import hlapi
+from lib.hl.benchmarks.benchutils import quietOutput, timeCall
+
+# python modules
+import os
+import random
+import argparse
+
+
+
+
+# ---------------------------------------------------------------------------
+def perturbText(rng, txt):
+    # simulate an author typing a name slightly differently than the directory
+    choice = rng.randint(0, 4)
+    if (choice==0) and (len(txt)>4):
+        # drop a character
+        pos = rng.randint(0, len(txt)-1)
+        return txt[0:pos] + txt[pos+1:]
+    if (choice==1) and (len(txt)>4):
+        # swap two neighbouring characters
+        pos = rng.randint(0, len(txt)-2)
+        return txt[0:pos] + txt[pos+1] + txt[pos] + txt[pos+2:]
+    if (choice==2):
+        # different case and punctuation
+        return txt.lower().replace('.', '').replace(',', '')
+    if (choice==3) and (' ' in txt):
+        # drop the last word
+        return txt.rsplit(' ', 1)[0]
+    return 'The ' + txt
+
+
+def makeQueries(api, queryCount, seed):
+    rng = random.Random(seed)
+    rows = [row for leadRows in api.leads.values() for row in leadRows]
+    queries = []
+    for i in range(0, queryCount):
+        row = rng.choice(rows)
+        field = 'dName' if (rng.randint(0, 1)==0) else 'address'
+        queries.append(perturbText(rng, row['properties'][field]))
+    return queries
+
+
+def runFuzzyMatchBenchmark(dataDir, queryCount, seed):
+    api = hlapi.HlApi(dataDir, {'enabled': True, 'disableSlowSearch': False})
+    with quietOutput():
+        api.loadLeads()
+        [result, timeIndex] = timeCall(api.getFuzzyIndex)
+    queries = makeQueries(api, queryCount, seed)
+    #
+    timeSweep = 0
+    timeIndexed = 0
+    agreeCount = 0
+    scoreAgreeCount = 0
+    for query in queries:
+        [sweepResult, elapsed] = timeCall(api.findLeadRowSimilarByNameOrAddressSweep, query)
+        timeSweep += elapsed
+        [indexedResult, elapsed] = timeCall(api.findLeadRowSimilarByNameOrAddress, query)
+        timeIndexed += elapsed
+        if (sweepResult[0] is indexedResult[0]):
+            agreeCount += 1
+        if (abs(sweepResult[2] - indexedResult[2]) < 1e-9):
+            scoreAgreeCount += 1
+    return {'rows': len(api.getFuzzyIndex()['rows']), 'queries': len(queries), 'indexBuild': timeIndex, 'sweepPerQuery': timeSweep / len(queries), 'indexedPerQuery': timeIndexed / len(queries), 'sameRow': agreeCount, 'sameScore': scoreAgreeCount}
+# ---------------------------------------------------------------------------
+
+
+
+
+# ---------------------------------------------------------------------------
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Benchmark approximate lead directory matching.')
+    argParser.add_argument('--queries', type=int, default=200)
+    argParser.add_argument('--seed', type=int, default=1)
+    argParser.add_argument('--dataversion', default='v2')
+    args = argParser.parse_args()
+    #
+    dataDir = os.path.abspath(os.path.dirname(os.path.dirname(__file__))) + '/hldata/' + args.dataversion
+    stats = runFuzzyMatchBenchmark(dataDir, args.queries, args.seed)
+    print('{} directory rows, {} queries; trigram index built in {:.3f}s'.format(stats['rows'], stats['queries'], stats['indexBuild']))
+    print('sweep:   {:.2f} ms/query'.format(stats['sweepPerQuery'] * 1000))
+    print('indexed: {:.2f} ms/query ({:.0f}x faster)'.format(stats['indexedPerQuery'] * 1000, stats['sweepPerQuery'] / max(stats['indexedPerQuery'], 1e-9)))
+    print('agreement: same row {}/{}, same score {}/{}'.format(stats['sameRow'], stats['queries'], stats['sameScore'], stats['queries']))
+# ---------------------------------------------------------------------------
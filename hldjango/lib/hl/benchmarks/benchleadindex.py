@@ -0,0 +1,63 @@
+# benchmark of lead lookup cost as the number of leads grows
+# compares the indexed HlParser.findLeadById against the original linear scan
+#
+# usage (from the hldjango directory):
+#   python -m lib.hl.benchmarks.benchleadindex [--counts 100,1000,5000,20000] [--linear]
+
+# imports
+from lib.hl.benchmarks.benchutils import makeBenchmarkParser, quietOutput, timeCall
+
+# python modules
+import argparse
+
+
+
+
+# ---------------------------------------------------------------------------
+def makeLeadChainText(leadCount, tagCount=50):
+    # each lead links to the next one and gains a tag, so every lead exercises golead lookups
+    parts = ['# options\n{"info": {"name": "lead index benchmark"}}\n', '# setup\n']
+    for tagIndex in range(0, tagCount):
+        parts.append('{{definetag(id=cond.T{})}}\n'.format(tagIndex))
+    for leadIndex in range(0, leadCount):
+        nextIndex = (leadIndex + 1) % leadCount
+        parts.append('# {}-{}: Lead {}\nSome text for this lead; now go to $golead({}-{}).\n{{gaintag(id=cond.T{})}}\n'.format(leadIndex // 100 + 1, leadIndex % 100, leadIndex, nextIndex // 100 + 1, nextIndex % 100, leadIndex % tagCount))
+    return ''.join(parts)
+
+
+def useLinearScan(parser):
+    # swap in the original unindexed lookup for comparison
+    def findLeadByIdLinear(leadId, flagCheckRenderId):
+        if (type(leadId) is not str):
+            return leadId
+        return parser.findLeadByIdLinearScan(parser.canonicalLeadId(leadId), flagCheckRenderId)
+    parser.findLeadById = findLeadByIdLinear
+
+
+def runLeadIndexBenchmark(leadCount, flagLinear):
+    parser = makeBenchmarkParser()
+    if (flagLinear):
+        useLinearScan(parser)
+    text = makeLeadChainText(leadCount)
+    with quietOutput():
+        [result, timeParse] = timeCall(parser.parseStoryTextIntoBlocks, text, 'benchmark')
+        [result, timeHeadBlocks] = timeCall(parser.processHeadBlocks)
+        [result, timeLeads] = timeCall(parser.processLeads)
+    return {'leadCount': leadCount, 'parse': timeParse, 'processHeadBlocks': timeHeadBlocks, 'processLeads': timeLeads, 'total': timeParse + timeHeadBlocks + timeLeads}
+# ---------------------------------------------------------------------------
+
+
+
+
+# ---------------------------------------------------------------------------
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Benchmark lead lookup against lead count.')
+    argParser.add_argument('--counts', default='100,1000,5000,10000,20000')
+    argParser.add_argument('--linear', action='store_true', help='use the original linear scan lookup')
+    args = argParser.parse_args()
+    #
+    print('{:>8} {:>10} {:>18} {:>14} {:>10}'.format('leads', 'parse', 'processHeadBlocks', 'processLeads', 'total'))
+    for leadCount in [int(val) for val in args.counts.split(',')]:
+        stats = runLeadIndexBenchmark(leadCount, args.linear)
+        print('{:>8} {:>10.3f} {:>18.3f} {:>14.3f} {:>10.3f}'.format(stats['leadCount'], stats['parse'], stats['processHeadBlocks'], stats['processLeads'], stats['total']))
+# ---------------------------------------------------------------------------
@@ -0,0 +1,111 @@
+# benchmark of logging overhead (jrprint/jrlog) during a synthetic casebook build
+# compares the original synchronous jrprint (format twice, write log file and console inline) against the queued logging backend, in verbose and quiet mode
+# each mode runs the same parse + processLeads (where the per lead messages come from), best of --repeat runs; the "none" mode swaps in do-nothing print functions, so (mode - none) is the logging overhead
+#
+# usage (from the hldjango directory):
+#   python -m lib.hl.benchmarks.benchlogging [--leads 5000] [--modes none,legacy,verbose,quiet] [--repeat 3] [--logdir /tmp/benchlogs]
+
+# imports
+from lib.jr import jrfuncs
+from lib.hl import hlparser
+from lib.hl.benchmarks.benchutils import makeBenchmarkParser, quietOutput, timeCall
+from lib.hl.benchmarks.benchleadindex import makeLeadChainText
+
+# python modules
+import argparse
+import logging
+import tempfile
+
+
+
+
+# ---------------------------------------------------------------------------
+class LegacyPrinter:
+    # the jrprint/jrlog implementation before the logging backend, writing to its own log file
+    def __init__(self, filePath):
+        self.logFile = open(filePath, 'a+', encoding='utf-8')
+        self.errorCount = 0
+
+    def jrprint(self, *args, **kwargs):
+        textLine = jrfuncs.jrSprintf(args, kwargs).upper()
+        if ('ERROR' in textLine) or ('EXCEPTION' in textLine):
+            self.errorCount += 1
+        print(*args, file=self.logFile, **kwargs)
+        return print(*args, **kwargs)
+
+    def jrprintVerbose(self, formatString, *args):
+        self.jrprint(formatString.format(*args))
+
+    def jrlog(self, *args, **kwargs):
+        print(*args, file=self.logFile, **kwargs)
+
+    def close(self):
+        self.logFile.close()
+
+
+def installPrintFunctions(jrprintFunc, jrprintVerboseFunc, jrlogFunc):
+    # the parser imports these by name, so swap them in its module
+    hlparser.jrprint = jrprintFunc
+    hlparser.jrprintVerbose = jrprintVerboseFunc
+    hlparser.jrlog = jrlogFunc
+
+
+def runBuild(parser, storyText):
+    parser.parseStoryTextIntoBlocks(storyText, 'benchmark')
+    parser.processHeadBlocks()
+    parser.processLeads()
+
+
+def runLoggingBenchmark(leadCount, mode, logDir, repeatCount):
+    storyText = makeLeadChainText(leadCount)
+    originalFunctions = [hlparser.jrprint, hlparser.jrprintVerbose, hlparser.jrlog]
+    originalLevel = jrfuncs.getLogLevel()
+    legacyPrinter = None
+    jrfuncs.setLogFileDir(logDir)
+    if (mode=='none'):
+        doNothing = lambda *args, **kwargs: None
+        installPrintFunctions(doNothing, doNothing, doNothing)
+    elif (mode=='legacy'):
+        legacyPrinter = LegacyPrinter(logDir + '/legacy.txt')
+        installPrintFunctions(legacyPrinter.jrprint, legacyPrinter.jrprintVerbose, legacyPrinter.jrlog)
+    else:
+        jrfuncs.setLogQuietMode(mode=='quiet')
+    timings = []
+    try:
+        for index in range(0, repeatCount):
+            parser = makeBenchmarkParser()
+            with quietOutput():
+                [result, secs] = timeCall(runBuild, parser, storyText)
+                # the queued backend is not done until its writer thread is
+                [result, flushSecs] = timeCall(jrfuncs.flushLog)
+            timings.append([secs + flushSecs, secs, flushSecs])
+    finally:
+        if (legacyPrinter is not None):
+            legacyPrinter.close()
+        installPrintFunctions(*originalFunctions)
+        jrfuncs.setLogLevel(originalLevel)
+    [totalSecs, secs, flushSecs] = min(timings)
+    return {'leadCount': leadCount, 'mode': mode, 'build': secs, 'flush': flushSecs, 'total': totalSecs}
+# ---------------------------------------------------------------------------
+
+
+
+
+# ---------------------------------------------------------------------------
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Benchmark logging overhead of a synthetic build.')
+    argParser.add_argument('--leads', type=int, default=5000)
+    argParser.add_argument('--modes', default='none,legacy,verbose,quiet')
+    argParser.add_argument('--repeat', type=int, default=3)
+    argParser.add_argument('--logdir', default=tempfile.gettempdir() + '/benchlogs')
+    args = argParser.parse_args()
+    #
+    print('{:>8} {:>8} {:>10} {:>10} {:>10} {:>10}'.format('leads', 'mode', 'build', 'flush', 'total', 'overhead'))
+    baseSecs = None
+    for mode in args.modes.split(','):
+        stats = runLoggingBenchmark(args.leads, mode, args.logdir, args.repeat)
+        if (mode=='none'):
+            baseSecs = stats['total']
+        overheadText = '' if (baseSecs is None) else '{:.3f}'.format(stats['total'] - baseSecs)
+        print('{:>8} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10}'.format(stats['leadCount'], stats['mode'], stats['build'], stats['flush'], stats['total'], overheadText))
+# ---------------------------------------------------------------------------
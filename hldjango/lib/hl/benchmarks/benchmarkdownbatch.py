@@ -0,0 +1,71 @@
+# benchmark of per lead markdown rendering against batched (one mistletoe parse per section) rendering
+# also checks that the two paths produce identical output for every lead
+#
+# usage (from the hldjango directory):
+#   python -m lib.hl.benchmarks.benchmarkdownbatch [--leads 5000] [--sectionsize 100] [--formats latex,html]
+
+# imports
+from lib.hl.benchmarks.benchutils import makeBenchmarkParser, quietOutput, timeCall
+from lib.hl.benchmarks.benchleadindex import makeLeadChainText
+
+# python modules
+import argparse
+
+
+
+
+# ---------------------------------------------------------------------------
+def makeLeadMarkdownList(leadCount):
+    # parse and process a synthetic casebook, returning the markdown of each lead the way renderLead assembles it (id and label headers plus text)
+    parser = makeBenchmarkParser()
+    with quietOutput():
+        parser.parseStoryTextIntoBlocks(makeLeadChainText(leadCount), 'benchmark')
+        parser.processHeadBlocks()
+        parser.processLeads()
+    markdownList = []
+    for lead in parser.leads:
+        leadProperties = lead['properties']
+        markdownText = '## {}\n### {}\n{}\n\n- a clue\n- *another* clue\n\n> "Interesting," says the **inspector**.\n'.format(leadProperties['renderId'], leadProperties.get('label', ''), lead['text'])
+        markdownList.append(markdownText)
+    return [parser, markdownList]
+
+
+def renderPerLead(hlMarkdown, markdownList, renderFormat):
+    return [hlMarkdown.renderMarkdownUncached(text, renderFormat, True)[0:2] for text in markdownList]
+
+
+def renderBatched(hlMarkdown, markdownList, renderFormat, sectionSize):
+    resultList = []
+    for index in range(0, len(markdownList), sectionSize):
+        resultList += hlMarkdown.renderMarkdownBatch(markdownList[index:index+sectionSize], renderFormat, True)
+    return resultList
+
+
+def runMarkdownBatchBenchmark(leadCount, sectionSize, renderFormat):
+    [parser, markdownList] = makeLeadMarkdownList(leadCount)
+    hlMarkdown = parser.hlMarkdown
+    # no render cache, so both paths do the full work
+    hlMarkdown.renderCache = None
+    with quietOutput():
+        [perLeadResults, timePerLead] = timeCall(renderPerLead, hlMarkdown, markdownList, renderFormat)
+        [batchedResults, timeBatched] = timeCall(renderBatched, hlMarkdown, markdownList, renderFormat, sectionSize)
+    mismatchCount = len([1 for [a, b] in zip(perLeadResults, batchedResults) if (a != b)])
+    return {'leadCount': len(markdownList), 'format': renderFormat, 'perLead': timePerLead, 'batched': timeBatched, 'mismatches': mismatchCount}
+# ---------------------------------------------------------------------------
+
+
+
+
+# ---------------------------------------------------------------------------
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Benchmark per lead vs batched markdown rendering.')
+    argParser.add_argument('--leads', type=int, default=5000)
+    argParser.add_argument('--sectionsize', type=int, default=100, help='leads per batch (roughly leads per section)')
+    argParser.add_argument('--formats', default='latex,html')
+    args = argParser.parse_args()
+    #
+    print('{:>8} {:>8} {:>10} {:>10} {:>10}'.format('leads', 'format', 'perLead', 'batched', 'mismatch'))
+    for renderFormat in args.formats.split(','):
+        stats = runMarkdownBatchBenchmark(args.leads, args.sectionsize, renderFormat)
+        print('{:>8} {:>8} {:>10.3f} {:>10.3f} {:>10}'.format(stats['leadCount'], stats['format'], stats['perLead'], stats['batched'], stats['mismatches']))
+# ---------------------------------------------------------------------------
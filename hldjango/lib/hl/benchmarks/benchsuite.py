@@ -0,0 +1,180 @@
+# benchmark suite timing each stage of a build on synthetic casebooks (see benchcasebook) of several sizes
+# stages: parse (parseStoryTextIntoBlocks), processHeadBlocks, processLeads, renderLeads (no latex compile, no markdown render cache),
+# a full runBuildList (parse + build list of a few pdf variants, no latex compile) and HlApi directory lookups
+# each stage is the best of --repeat runs on a fresh parser
+#
+# results can be written out as json (--json) and compared against an earlier saved run (--baseline), so regressions show up across commits
+# when comparing, the exit code is 1 if any stage is slower than the baseline by more than --threshold
+#
+# usage (from the hldjango directory):
+#   python -m lib.hl.benchmarks.benchsuite [--leads 500,2000] [--repeat 3] [--json results.json] [--baseline baseline.json] [--threshold 1.25]
+
+# imports
+from lib.hl.benchmarks.benchutils import makeBenchmarkParser, quietOutput, timeCall, BenchmarkGameFileManager
+from lib.hl.benchmarks.benchcasebook import makeSyntheticCasebookText
+from lib.hl.benchmarks.benchfuzzymatch import makeQueries
+
+# python modules
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+
+
+
+# ---------------------------------------------------------------------------
+stageNames = ['parse', 'processHeadBlocks', 'processLeads', 'renderLeads', 'runBuildList', 'hlapiLookups']
+
+# the build list for the runBuildList stage; same shape as the ones made by the games app
+benchmarkBuildList = [
+    {'label': 'onecol', 'gameName': 'benchmark', 'format': 'pdf', 'paperSize': 'LETTER', 'layout': 'onecol', 'variant': 'normal', 'gameFileType': 'buildDraft', 'fontSize': '10pt', 'paperSizeLatex': 'letter', 'doubleSided': False, 'columns': 1, 'solo': False, 'suffix': '_onecol'},
+    {'label': 'twocol', 'gameName': 'benchmark', 'format': 'pdf', 'paperSize': 'LETTER', 'layout': 'twocol', 'variant': 'normal', 'gameFileType': 'buildDraft', 'fontSize': '10pt', 'paperSizeLatex': 'letter', 'doubleSided': False, 'columns': 2, 'solo': False, 'suffix': '_twocol'},
+    {'label': 'summary', 'gameName': 'benchmark', 'format': 'pdf', 'paperSize': 'LETTER', 'layout': 'onecol', 'variant': 'summary', 'gameFileType': 'buildDraft', 'fontSize': '10pt', 'paperSizeLatex': 'letter', 'doubleSided': False, 'columns': 1, 'solo': True, 'suffix': '_summary'},
+    ]
+
+
+def makeSuiteParser(extraOptions={}):
+    parser = makeBenchmarkParser(extraOptions)
+    parser.jroptions.dataDict['options']['renderOptions']['compileLatex'] = False
+    # so repeated runs measure rendering rather than cache hits
+    parser.hlMarkdown.renderCache = None
+    return parser
+
+
+def timeStages(storyText, workDir):
+    # returns dictionary of stage name -> seconds for one run of each stage
+    timings = {}
+    #
+    # the per lead stages, each on the result of the one before
+    parser = makeSuiteParser({'chapterSaveDir': workDir + '/render'})
+    with quietOutput():
+        [result, timings['parse']] = timeCall(parser.parseStoryTextIntoBlocks, storyText, 'benchmark')
+        [result, timings['processHeadBlocks']] = timeCall(parser.processHeadBlocks)
+        [result, timings['processLeads']] = timeCall(parser.processLeads)
+        [result, timings['renderLeads']] = timeCall(parser.renderLeads, {'suffix': '', 'mode': 'normal'}, False)
+    if (parser.getBuildErrorCount() > 0):
+        raise Exception('Synthetic casebook build had errors: {}'.format(parser.getBuildLog()[0:1000]))
+    #
+    # a full build list, as a build request would run it
+    parser = makeSuiteParser({'gameFileManager': BenchmarkGameFileManager(workDir + '/build'), 'buildList': benchmarkBuildList})
+    with quietOutput():
+        timeStart = time.perf_counter()
+        parser.parseStoryTextIntoBlocks(storyText, 'benchmark')
+        parser.runBuildList(False)
+        timings['runBuildList'] = time.perf_counter() - timeStart
+    #
+    # directory lookups (these do not depend on the casebook size, but the parser makes them for every lead that references the directory)
+    timings['hlapiLookups'] = timeHlApiLookups(parser.getHlApi())
+    return timings
+
+
+def timeHlApiLookups(api, exactCount=2000, similarCount=20, seed=1):
+    # exact id and name lookups plus a few approximate ones (index build is done once up front and not timed)
+    with quietOutput():
+        api.loadLeads()
+        api.getFuzzyIndex()
+    rows = [row for leadRows in api.leads.values() for row in leadRows]
+    exactQueries = [rows[(index * 7919) % len(rows)] for index in range(0, exactCount)]
+    similarQueries = makeQueries(api, similarCount, seed)
+    timeStart = time.perf_counter()
+    for row in exactQueries:
+        api.findLeadRowByLeadId(row['properties']['lead'])
+        api.findLeadRowByNameOrAddress(row['properties']['dName'] or '')
+    for query in similarQueries:
+        api.findLeadRowSimilarByNameOrAddress(query)
+    return time.perf_counter() - timeStart
+
+
+def runBenchmarkSuite(leadCounts, repeatCount, seed=1):
+    # returns a json friendly dictionary with the best time of each stage for each casebook size
+    results = {}
+    workDir = tempfile.mkdtemp(prefix='hlbenchsuite')
+    try:
+        for leadCount in leadCounts:
+            storyText = makeSyntheticCasebookText(leadCount, seed=seed)
+            best = {}
+            for index in range(0, repeatCount):
+                timings = timeStages(storyText, workDir)
+                for stageName, secs in timings.items():
+                    best[stageName] = min(secs, best.get(stageName, secs))
+            results[str(leadCount)] = best
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+    #
+    return {
+        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'commit': getGitCommit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeatCount,
+        'seed': seed,
+        'results': results,
+        }
+
+
+def getGitCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(__file__), capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compareWithBaseline(suiteResult, baseline, threshold):
+    # returns list of [leadCountKey, stageName, baselineSecs, secs, ratio, flagRegression] for stages in both
+    comparisons = []
+    for leadCountKey, timings in suiteResult['results'].items():
+        baselineTimings = baseline['results'].get(leadCountKey, {})
+        for stageName in stageNames:
+            if (stageName not in timings) or (stageName not in baselineTimings):
+                continue
+            ratio = timings[stageName] / max(baselineTimings[stageName], 1e-9)
+            comparisons.append([leadCountKey, stageName, baselineTimings[stageName], timings[stageName], ratio, ratio > threshold])
+    return comparisons
+# ---------------------------------------------------------------------------
+
+
+
+
+# ---------------------------------------------------------------------------
+if __name__ == '__main__':
+    argParser = argparse.ArgumentParser(description='Benchmark each build stage on synthetic casebooks.')
+    argParser.add_argument('--leads', default='500,2000')
+    argParser.add_argument('--repeat', type=int, default=3)
+    argParser.add_argument('--seed', type=int, default=1)
+    argParser.add_argument('--json', default=None, help='write the results to this file')
+    argParser.add_argument('--baseline', default=None, help='compare against results saved earlier with --json')
+    argParser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio (vs baseline) that counts as a regression')
+    args = argParser.parse_args()
+    #
+    leadCounts = [int(leadCount) for leadCount in args.leads.split(',')]
+    suiteResult = runBenchmarkSuite(leadCounts, args.repeat, args.seed)
+    #
+    print('{:>8} '.format('leads') + ' '.join(['{:>18}'.format(stageName) for stageName in stageNames]))
+    for leadCountKey, timings in suiteResult['results'].items():
+        print('{:>8} '.format(leadCountKey) + ' '.join(['{:>18.3f}'.format(timings[stageName]) for stageName in stageNames]))
+    #
+    if (args.json is not None):
+        with open(args.json, 'w', encoding='utf-8') as outFile:
+            json.dump(suiteResult, outFile, indent=2)
+        print('Wrote results to {}.'.format(args.json))
+    #
+    if (args.baseline is not None):
+        with open(args.baseline, 'r', encoding='utf-8') as inFile:
+            baseline = json.load(inFile)
+        print('\nCompared to baseline from commit {} ({}):'.format(baseline.get('commit'), baseline.get('timestamp')))
+        print('{:>8} {:>18} {:>10} {:>10} {:>8}'.format('leads', 'stage', 'baseline', 'now', 'ratio'))
+        regressionCount = 0
+        for [leadCountKey, stageName, baselineSecs, secs, ratio, flagRegression] in compareWithBaseline(suiteResult, baseline, args.threshold):
+            print('{:>8} {:>18} {:>10.3f} {:>10.3f} {:>8.2f}{}'.format(leadCountKey, stageName, baselineSecs, secs, ratio, '  REGRESSION' if flagRegression else ''))
+            if (flagRegression):
+                regressionCount += 1
+        if (regressionCount > 0):
+            print('{} stage(s) slower than baseline by more than {:.2f}x.'.format(regressionCount, args.threshold))
+            sys.exit(1)
+# ---------------------------------------------------------------------------
@@ -0,0 +1,55 @@
+# shared helpers for the hl parser benchmarks
+
+# imports
+from lib.hl import hlparser
+
+# python modules
+import os
+import io
+import time
+import contextlib
+
+
+
+
+# ---------------------------------------------------------------------------
+def makeBenchmarkParser(extraOptions={}):
+    # create a parser configured the way hltasks does, but without a game file manager
+    hlDirPath = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+    optionsDirPath = hlDirPath + '/options'
+    overrideOptions = {
+        'hlDataDir': hlDirPath + '/hldata',
+        'templatedir': hlDirPath + '/templates',
+        'buildList': [],
+        'gameFileManager': True,
+        }
+    overrideOptions.update(extraOptions)
+    with quietOutput():
+        parser = hlparser.HlParser(optionsDirPath, overrideOptions)
+    return parser
+
+
+def quietOutput():
+    # swallow the (copious) jrprint console output while timing; it still goes to the log file
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def timeCall(func, *args, **kwargs):
+    # return [result, secondsElapsed]
+    timeStart = time.perf_counter()
+    result = func(*args, **kwargs)
+    return [result, time.perf_counter() - timeStart]
+
+
+class BenchmarkGameFileManager:
+    # stands in for the games app file manager, putting each game file type in its own subdirectory of baseDir
+    def __init__(self, baseDir):
+        self.baseDir = baseDir
+
+    def getDirectoryPathForGameType(self, gameFileType):
+        return self.baseDir + '/' + gameFileType
+
+    def findImagesForName(self, name, flagMarkUsage, flagRevertToPrefix):
+        # synthetic casebooks have no images
+        return None
+# ---------------------------------------------------------------------------
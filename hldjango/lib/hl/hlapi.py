@@ -9,10 +9,26 @@ import csv
 import os
 import pathlib
 import json
+import pickle
+import heapq
 from difflib import SequenceMatcher
 
 
 
+# ---------------------------------------------------------------------------
+# bump this when the structure of the compiled lead database changes
+compiledLeadDatabaseVersion = 1
+
+# number of leading characters of a name used for the fuzzy search startswith boost
+fuzzyStartLen = 5
+
+# module global cache of loaded lead databases keyed by (leads directory, file signature)
+# so a long running worker process only loads each data version once
+loadedLeadDatabases = {}
+# ---------------------------------------------------------------------------
+
+
+
 # ---------------------------------------------------------------------------
 class HlApi:
     def __init__(self, dataDir, options={}):
@@ -21,6 +37,10 @@ class HlApi:
         #
         self.unusedLeads = None
         self.leads = None
+        # hash indexes built when leads are loaded
+        self.leadIdIndex = None
+        self.nameOrAddressIndex = None
+        self.normalizedNameIndex = None
 
     def setDataDir(self, dataDir):
         self.dataDir = dataDir
@@ -31,6 +51,14 @@ class HlApi:
     def enableSlowSearch(self):
         return ('disableSlowSearch' not in self.options) or (not self.options['disableSlowSearch'])
 
+    def enableCompiledCache(self):
+        return ('compiledCache' in self.options) and (self.options['compiledCache'])
+
+    def getCompiledCachePath(self):
+        if ('compiledCachePath' in self.options):
+            return self.options['compiledCachePath']
+        return self.dataDir + '/leadsCompiled.pickle'
+
 
 
 # ---------------------------------------------------------------------------
@@ -59,18 +87,48 @@ class HlApi:
         if (not self.isEnabled()):
             return False
         
-        self.leads = {}
         directoryPath = self.dataDir + '/leads/'
+        [filePaths, signature] = self.calcLeadFilesSignature(directoryPath)
+
+        # already loaded in this process?
+        cacheKey = (os.path.abspath(directoryPath), signature)
+        if (cacheKey in loadedLeadDatabases):
+            self.setLeadDatabase(loadedLeadDatabases[cacheKey])
+            return True
 
+        # compiled on disk version up to date?
+        leadDatabase = None
+        if (self.enableCompiledCache()):
+            leadDatabase = self.loadCompiledLeadDatabase(signature)
+
+        if (leadDatabase is None):
+            # parse the json files and build indexes
+            self.leads = {}
+            for [filePath, baseName] in filePaths:
+                self.loadLeadFile(filePath, baseName)
+            leadDatabase = self.buildLeadDatabase(signature)
+            if (self.enableCompiledCache()):
+                self.saveCompiledLeadDatabase(leadDatabase)
+
+        loadedLeadDatabases[cacheKey] = leadDatabase
+        self.setLeadDatabase(leadDatabase)
+        return True
+
+
+    def calcLeadFilesSignature(self, directoryPath):
+        # return [filePaths, signature] where filePaths is list of [path, sourceLabel] in load order and signature identifies their current contents
+        filePaths = []
+        signature = []
         for (dirPath, dirNames, fileNames) in os.walk(directoryPath):
             for fileName in fileNames:
                 fileNameLower = fileName.lower()
                 if (fileNameLower.endswith('.json')):
                     baseName = pathlib.Path(fileName).stem
                     fileFinishedPath = dirPath + '/' + fileName
-                    self.loadLeadFile(fileFinishedPath, baseName)
-
-        return True
+                    filePaths.append([fileFinishedPath, baseName])
+                    fileStat = os.stat(fileFinishedPath)
+                    signature.append((fileFinishedPath, fileStat.st_mtime_ns, fileStat.st_size))
+        return [filePaths, tuple(signature)]
 
 
     def loadLeadFile(self, filePath, fileSourceLabel):
@@ -88,6 +146,82 @@ class HlApi:
             self.leads[fileSourceLabel] = rows
 
 
+    def buildLeadDatabase(self, signature):
+        # build hash indexes over all lead rows; for each key the FIRST row (in source load order) wins, matching the old linear scans
+        leadIdIndex = {}
+        nameOrAddressIndex = {}
+        normalizedNameIndex = {}
+        for sourceKey, leadRows in self.leads.items():
+            for row in leadRows:
+                rowProperties = row['properties']
+                entry = [row, sourceKey]
+                leadIdIndex.setdefault(rowProperties['lead'], entry)
+                address = rowProperties['address']
+                dName = rowProperties['dName']
+                if (address is not None):
+                    nameOrAddressIndex.setdefault(address, entry)
+                if (dName is not None):
+                    nameOrAddressIndex.setdefault(dName, entry)
+                    normalizedName = self.normalizeName(dName)
+                    if (normalizedName!=''):
+                        normalizedNameIndex.setdefault(normalizedName, []).append(entry)
+        #
+        leadDatabase = {
+            'version': compiledLeadDatabaseVersion,
+            'signature': signature,
+            'leads': self.leads,
+            'leadIdIndex': leadIdIndex,
+            'nameOrAddressIndex': nameOrAddressIndex,
+            'normalizedNameIndex': normalizedNameIndex,
+            }
+        return leadDatabase
+
+
+    def setLeadDatabase(self, leadDatabase):
+        self.leads = leadDatabase['leads']
+        self.leadIdIndex = leadDatabase['leadIdIndex']
+        self.nameOrAddressIndex = leadDatabase['nameOrAddressIndex']
+        self.normalizedNameIndex = leadDatabase['normalizedNameIndex']
+
+
+    def loadCompiledLeadDatabase(self, signature):
+        # return the compiled lead database from disk, or None if missing or out of date
+        filePath = self.getCompiledCachePath()
+        if (not os.path.isfile(filePath)):
+            return None
+        try:
+            with open(filePath, 'rb') as pickleFile:
+                leadDatabase = pickle.load(pickleFile)
+        except Exception as e:
+            jrprint('WARNING: failed to load compiled lead database "{}": {}'.format(filePath, e))
+            return None
+        if (leadDatabase.get('version') != compiledLeadDatabaseVersion) or (leadDatabase.get('signature') != signature):
+            jrprint('Compiled lead database "{}" is out of date; rebuilding.'.format(filePath))
+            return None
+        jrprint('Loaded compiled lead database from "{}".'.format(filePath))
+        return leadDatabase
+
+
+    def saveCompiledLeadDatabase(self, leadDatabase):
+        # write atomically so a concurrent worker never sees a partial file; failure is not fatal
+        filePath = self.getCompiledCachePath()
+        tempFilePath = '{}.{}.tmp'.format(filePath, os.getpid())
+        try:
+            with open(tempFilePath, 'wb') as pickleFile:
+                pickle.dump(leadDatabase, pickleFile, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tempFilePath, filePath)
+            jrprint('Saved compiled lead database to "{}".'.format(filePath))
+        except Exception as e:
+            jrprint('WARNING: failed to save compiled lead database "{}": {}'.format(filePath, e))
+            if (os.path.isfile(tempFilePath)):
+                os.remove(tempFilePath)
+
+
+    def normalizeName(self, txt):
+        # lowercase with punctuation and spaces removed (same normalization as jrfuncs.semiMatchStringsNoPunctuation)
+        return ''.join(e for e in txt.lower() if e.isalnum())
+
+
     def findLeadRowByLeadId(self, leadId):
         if (not self.isEnabled()):
             return [None, None]
@@ -97,10 +231,9 @@ class HlApi:
         if (leadId.startswith('#')):
             leadId = leadId[1:]
         #
-        for sourceKey, leadRows in self.leads.items():
-            for row in leadRows:
-                if (row['properties']['lead']==leadId):
-                    return [row, sourceKey]
+        entry = self.leadIdIndex.get(leadId)
+        if (entry is not None):
+            return list(entry)
         # not found
         return [None, None]
 
@@ -116,16 +249,27 @@ class HlApi:
 
         if (self.leads is None):
             self.loadLeads()
-        for sourceKey, leadRows in self.leads.items():
-            for row in leadRows:
-                if (row['properties']['address']==txt) or (row['properties']['dName']==txt):
-                    return [row, sourceKey]
-                dName = row['properties']['dName']
+        entry = self.nameOrAddressIndex.get(txt)
+        if (entry is not None):
+            return list(entry)
         # not found
         return [None, None]
 
 
+    def findLeadRowsByNormalizedName(self, txt):
+        # return list of [row, sourceKey] whose dName matches ignoring case, spaces and punctuation
+        if (not self.isEnabled()):
+            return []
+        normalizedName = self.normalizeName(txt)
+        if (normalizedName==''):
+            return []
+        if (self.leads is None):
+            self.loadLeads()
+        return self.normalizedNameIndex.get(normalizedName, [])
+
+
     def findLeadRowSimilarByNameOrAddress(self, txt):
+        # return [row, sourceKey, score] of the best approximate match on name or address
         if (not self.isEnabled()):
             return [None, None, 0]
         if (not self.enableSlowSearch()):
@@ -134,26 +278,134 @@ class HlApi:
         if (txt==''):
             return [None, None]
 
+        matches = self.findLeadRowsSimilarByNameOrAddress(txt, 1, None)
+        if (len(matches)==0):
+            return [None, None, 0]
+        return matches[0]
+
+
+    def findLeadRowsSimilarByNameOrAddress(self, txt, topK=5, minScore=None):
+        # return up to topK [row, sourceKey, score] sorted best first, with score > minScore
+        # score is the same as the old full sweep: max(ratio(txt, dName) + startswith boost, ratio(txt, address))
+        # but exact scoring is only done on a shortlist narrowed down by a character trigram inverted index
+        if (not self.isEnabled()):
+            return []
+        txt = txt.strip()
+        if (txt==''):
+            return []
+        if (minScore is None):
+            minScore = self.options['fuzzyMinScore'] if ('fuzzyMinScore' in self.options) else 0
+        candidateLimit = self.options['fuzzyCandidateLimit'] if ('fuzzyCandidateLimit' in self.options) else 200
+
+        if (self.leads is None):
+            self.loadLeads()
+        fuzzyIndex = self.getFuzzyIndex()
+        fuzzyRows = fuzzyIndex['rows']
+
+        # candidate rows that get the startswith boost (dName prefix is a prefix of the query)
+        txtUpper = txt.upper()
+        candidateOrdinals = set()
+        for prefixLen in range(0, fuzzyStartLen+1):
+            candidateOrdinals.update(fuzzyIndex['prefixIndex'].get(txtUpper[0:prefixLen], []))
+
+        # candidate rows sharing the most trigrams with the query, ranked by dice coefficient
+        queryGrams = self.calcTrigrams(txt)
+        if (len(queryGrams)>0):
+            sharedCounts = {}
+            trigramIndex = fuzzyIndex['trigramIndex']
+            for gram in queryGrams:
+                for fieldKey in trigramIndex.get(gram, []):
+                    sharedCounts[fieldKey] = sharedCounts.get(fieldKey, 0) + 1
+            fieldGramCounts = fuzzyIndex['fieldGramCounts']
+            queryGramCount = len(queryGrams)
+            rankedFieldKeys = heapq.nlargest(candidateLimit, sharedCounts.keys(), key=lambda fieldKey: (2.0 * sharedCounts[fieldKey]) / (queryGramCount + fieldGramCounts[fieldKey]))
+            for fieldKey in rankedFieldKeys:
+                candidateOrdinals.add(fieldKey // 2)
+
+        # exact scoring on the shortlist
+        results = []
+        for ordinal in candidateOrdinals:
+            [row, sourceKey] = fuzzyRows[ordinal]
+            score = self.calcSimilarScore(txt, txtUpper, row)
+            if (score > minScore):
+                results.append([score, ordinal])
+        # best score first; ties go to the earliest row, like the old sweep
+        results.sort(key=lambda result: (-result[0], result[1]))
+        return [[fuzzyRows[ordinal][0], fuzzyRows[ordinal][1], score] for [score, ordinal] in results[0:topK]]
+
+
+    def findLeadRowSimilarByNameOrAddressSweep(self, txt):
+        # original exhaustive SequenceMatcher sweep over every row; kept as the reference for benchmarking the trigram matcher
+        if (not self.isEnabled()):
+            return [None, None, 0]
+        txt = txt.strip()
+        if (txt==''):
+            return [None, None]
+
         if (self.leads is None):
             self.loadLeads()
         # walk ALL and find max
         txtUpper = txt.upper()
-        startLen = 5 
         maxDist = 0
         maxMatchRow = None
         maxMatchSourceKey = None
         for sourceKey, leadRows in self.leads.items():
             for row in leadRows:
-                distName = SequenceMatcher(None, txt, row['properties']['dName']).ratio()
-                distAddr = SequenceMatcher(None, txt, row['properties']['address']).ratio()
-                # kludge for startswith
-                if (txtUpper.startswith(row['properties']['dName'][0:startLen].upper())):
-                    distName += 0.5
-                thisMaxDist = max(distName, distAddr)
+                thisMaxDist = self.calcSimilarScore(txt, txtUpper, row)
                 if (thisMaxDist > maxDist):
                     maxDist = thisMaxDist
                     maxMatchRow = row
                     maxMatchSourceKey = sourceKey
         # not found
         return [maxMatchRow, maxMatchSourceKey, maxDist]
+
+
+    def calcSimilarScore(self, txt, txtUpper, row):
+        distName = SequenceMatcher(None, txt, row['properties']['dName']).ratio()
+        distAddr = SequenceMatcher(None, txt, row['properties']['address']).ratio()
+        # kludge for startswith
+        if (txtUpper.startswith(row['properties']['dName'][0:fuzzyStartLen].upper())):
+            distName += 0.5
+        return max(distName, distAddr)
+
+
+    def calcTrigrams(self, txt):
+        # set of lowercase character trigrams, padded so short strings and word starts still produce grams
+        txt = ' ' + txt.lower() + ' '
+        return set(txt[i:i+3] for i in range(0, len(txt)-2))
+
+
+    def getFuzzyIndex(self):
+        # the trigram index is built the first time a fuzzy search is done and shared via the loaded lead database
+        leadDatabase = self.findLoadedLeadDatabase()
+        if (leadDatabase is not None) and ('fuzzyIndex' in leadDatabase):
+            return leadDatabase['fuzzyIndex']
+        #
+        rows = []
+        trigramIndex = {}
+        prefixIndex = {}
+        fieldGramCounts = {}
+        for sourceKey, leadRows in self.leads.items():
+            for row in leadRows:
+                ordinal = len(rows)
+                rows.append([row, sourceKey])
+                rowProperties = row['properties']
+                # field keys are ordinal*2 for dName and ordinal*2+1 for address
+                for [fieldKey, fieldText] in [[ordinal*2, rowProperties['dName']], [ordinal*2+1, rowProperties['address']]]:
+                    grams = self.calcTrigrams(fieldText)
+                    fieldGramCounts[fieldKey] = len(grams)
+                    for gram in grams:
+                        trigramIndex.setdefault(gram, []).append(fieldKey)
+                prefixIndex.setdefault(rowProperties['dName'][0:fuzzyStartLen].upper(), []).append(ordinal)
+        fuzzyIndex = {'rows': rows, 'trigramIndex': trigramIndex, 'prefixIndex': prefixIndex, 'fieldGramCounts': fieldGramCounts}
+        if (leadDatabase is not None):
+            leadDatabase['fuzzyIndex'] = fuzzyIndex
+        return fuzzyIndex
+
+
+    def findLoadedLeadDatabase(self):
+        for leadDatabase in loadedLeadDatabases.values():
+            if (leadDatabase['leads'] is self.leads):
+                return leadDatabase
+        return None
 # ---------------------------------------------------------------------------
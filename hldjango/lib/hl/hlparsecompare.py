@@ -0,0 +1,99 @@
+# differential test harness for the story text parser
+# runs the table driven tokenizer (HlParser.parseStoryTextIntoBlocks) and the original per-character parser (HlParser.parseStoryTextIntoBlocksCharLoop)
+# over a corpus of story files and reports any difference in head blocks, child blocks, line numbers or parse errors
+#
+# usage (from the hldjango directory):
+#   python -m lib.hl.hlparsecompare story1.txt story2.txt storydir/ ...
+
+# imports
+from lib.jr import jrfuncs
+from lib.jr.jrfuncs import jrprint
+from lib.hl import hlparser
+
+# python modules
+import os
+import sys
+import json
+
+
+
+
+# ---------------------------------------------------------------------------
+def runParseCapture(parser, parseFunc, text, sourceLabel):
+    # run one parser implementation on a clean slate and return [headBlocks, errorString]
+    parser.headBlocks = []
+    parser.storegGameText = ''
+    errorString = None
+    try:
+        parseFunc(text, sourceLabel)
+    except Exception as e:
+        errorString = str(e)
+    # deep copy via json so later runs cannot alias
+    headBlocks = json.loads(json.dumps(parser.headBlocks))
+    return [headBlocks, errorString]
+
+
+def compareStoryText(parser, text, sourceLabel):
+    # return a list of difference strings (empty if both implementations agree)
+    [oldBlocks, oldError] = runParseCapture(parser, parser.parseStoryTextIntoBlocksCharLoop, text, sourceLabel)
+    [newBlocks, newError] = runParseCapture(parser, parser.parseStoryTextIntoBlocks, text, sourceLabel)
+    #
+    diffs = []
+    if (oldError != newError):
+        diffs.append('parse error differs: old="{}" new="{}"'.format(oldError, newError))
+    if (len(oldBlocks) != len(newBlocks)):
+        diffs.append('head block count differs: old={} new={}'.format(len(oldBlocks), len(newBlocks)))
+    for index, [oldBlock, newBlock] in enumerate(zip(oldBlocks, newBlocks)):
+        if (oldBlock != newBlock):
+            label = oldBlock['properties'].get('id', '?')
+            diffs.append('head block {} ("{}" line {}) differs'.format(index, label, oldBlock['lineNumber']))
+            oldChildren = oldBlock.get('blocks', [])
+            newChildren = newBlock.get('blocks', [])
+            for childIndex, [oldChild, newChild] in enumerate(zip(oldChildren, newChildren)):
+                if (oldChild != newChild):
+                    diffs.append('  child {}: old={} new={}'.format(childIndex, repr(oldChild)[0:200], repr(newChild)[0:200]))
+                    break
+    return diffs
+
+
+def findCorpusFiles(pathList):
+    filePaths = []
+    for path in pathList:
+        if (os.path.isdir(path)):
+            for (dirPath, dirNames, fileNames) in os.walk(path):
+                for fileName in sorted(fileNames):
+                    if (fileName.lower().endswith('.txt')):
+                        filePaths.append(os.path.join(dirPath, fileName))
+        else:
+            filePaths.append(path)
+    return filePaths
+
+
+def compareCorpus(pathList, optionsDirPath=None):
+    # returns number of files with differences
+    if (optionsDirPath is None):
+        optionsDirPath = os.path.abspath(os.path.dirname(__file__)) + '/options'
+    parser = hlparser.HlParser(optionsDirPath, {'gameFileManager': True, 'workingdir': None})
+    #
+    failCount = 0
+    filePaths = findCorpusFiles(pathList)
+    for filePath in filePaths:
+        text = jrfuncs.loadTxtFromFile(filePath, True, 'utf-8')
+        diffs = compareStoryText(parser, text, 'FILE "{}"'.format(filePath))
+        if (len(diffs)>0):
+            failCount += 1
+            jrprint('MISMATCH in "{}":\n{}'.format(filePath, '\n'.join(diffs)))
+        else:
+            jrprint('Parsers agree on "{}".'.format(filePath))
+    jrprint('Compared {} story files; {} mismatched.'.format(len(filePaths), failCount))
+    return failCount
+# ---------------------------------------------------------------------------
+
+
+
+
+# ---------------------------------------------------------------------------
+if __name__ == '__main__':
+    failCount = compareCorpus(sys.argv[1:])
+    sys.exit(1 if (failCount>0) else 0)
+# ---------------------------------------------------------------------------
@@ -2,13 +2,14 @@
 
 from lib.jr import jrfuncs
 from lib.jr import jroptions
-from lib.jr.jrfuncs import jrprint, jrlog
+from lib.jr.jrfuncs import jrprint, jrprintVerbose, jrlog
 from lib.jr.jrfuncs import jrException
 
 from lib.jr.hlmarkdown import HlMarkdown
 from . import hlapi
 from lib.jr import jrmindmap
 from lib.jr.jrfilefinder import JrFileFinder
+from lib.jr.jrtiming import JrTimingTree, timedSpan
 
 # for compiling latex
 import pylatex
@@ -20,7 +21,7 @@ from pdflatex import PDFLaTeX
 import re
 import os
 import pathlib
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 import json
 import random
 import argparse
@@ -31,12 +32,59 @@ import errno
 import math
 import traceback
 import datetime
+import shutil
+import time
+import threading
+import hashlib
+import tempfile
+import pickle
+from concurrent.futures import ThreadPoolExecutor
 
 
 
 
 # ---------------------------------------------------------------------------
 buildVersion = '3.1jr'
+# pdflatex auxiliary files whose contents decide whether another pass is needed
+latexAuxSeedExtensions = ['aux', 'toc', 'out']
+# first line of pdflatex --version (see HlParser.getTexVersion)
+texVersionString = None
+# bump when the format of cached story parse chunks changes (see HlParser.parseStoryTextIncremental)
+storyParseCacheVersion = 1
+# chunk size used when streaming the rendered document to disk (see HlParser.renderLeads)
+renderFileBufferSize = 1 << 18
+# start of a chunk for incremental parsing: a "# " header line
+regexStoryTextChunkStart = re.compile(r'^# ', re.MULTILINE)
+# templates replaced in the final document by HlParser.textReplacementsLate, as [name, prefix, suffix]; the order matters when patterns interact
+lateTemplateList = [
+    ['coverstart', '', ''],
+    ['coverend', '', ''],
+    ['coverinfo', '', ''],
+    ['pagebreak', '', ''],
+    ['casestats', '', ''],
+    ['fontTypewriter', '', ''],
+    ['fontHandwriting', '', ''],
+    ['fontOff', '', ''],
+    ['alignleft', '', ''],
+    ['aligncenter', '', ''],
+    ['Symbol.Clock', '', ''],
+    ['Symbol.Mark', '', ''],
+    ['Symbol.Doc', '', ''],
+    ['Symbol.Checkbox', '', ''],
+    ['Symbol.Exclamation', '', ''],
+    ['Symbol.Stop', '', ''],
+    ['Symbol.Hand', '', ''],
+    ['Symbol.Choice', '', ''],
+    ['Symbol.Bonus', '', ''],
+    ['fontColorRed', '', ''],
+    ['fontColorNormal', '', ''],
+    ['boxstart', '', ''],
+    ['boxstartred', '', ''],
+    ['boxend', '', ''],
+    ['radiostart', '', '\n\n'],
+    ['radioend', '\n\n', ''],
+    ['Separator.Final', '\n\n', '\n'],
+    ]
 # ---------------------------------------------------------------------------
 
 
@@ -45,6 +93,176 @@ buildVersion = '3.1jr'
 
 
 
+# ---------------------------------------------------------------------------
+# characters that can change the state of the story text parser; everything between them is handled as a slice
+storyTextDelimiterCharacters = '\n#{}$/*"“”'
+regexStoryTextDelimiter = re.compile(r'[\n#{}$/*"“”]')
+# ---------------------------------------------------------------------------
+
+
+
+
+
+# ---------------------------------------------------------------------------
+# a parsed $func(args) code block (see HlParser.getParsedCodeCall); shared between evaluations so args must not be modified
+HlCodeCall = namedtuple('HlCodeCall', ['funcName', 'args', 'pos'])
+# ---------------------------------------------------------------------------
+
+
+
+
+
+# ---------------------------------------------------------------------------
+class PdflatexCompileJob:
+    # handle for a background pdflatex compile started by HlParser.generatePdflatexAsync
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.future = None
+        self.parser = None
+        self.canceledEvent = threading.Event()
+        self.processLock = threading.Lock()
+        self.process = None
+        self.reported = False
+
+    def setProcess(self, process):
+        with self.processLock:
+            self.process = process
+            if (process is not None) and (self.canceledEvent.is_set()):
+                process.kill()
+
+    def cancel(self):
+        # stop before the next pass, killing any pdflatex currently running
+        self.canceledEvent.set()
+        self.future.cancel()
+        with self.processLock:
+            if (self.process is not None):
+                self.process.kill()
+
+    def isCanceled(self):
+        return self.canceledEvent.is_set()
+
+    def done(self):
+        return self.future.done()
+
+    def wait(self, timeout=None):
+        # wait for the compile, report it into the parser build log (once) and return the result dictionary
+        if (self.future.cancelled()):
+            result = {'filepath': self.filepath, 'quietMode': True, 'errored': True, 'timedOut': False, 'canceled': True, 'runCount': 0, 'stdOutText': '', 'stdErrText': 'pdflatex compile was canceled.\n', 'hasStdErr': True, 'elapsed': 0}
+        else:
+            result = self.future.result(timeout)
+        if (not self.reported):
+            self.reported = True
+            self.parser.reportPdflatexResult(result)
+        return result
+# ---------------------------------------------------------------------------
+
+
+
+
+
+# ---------------------------------------------------------------------------
+class TextTemplateEngine:
+    # single pass substitution of an ordered list of templates of the form prefix + delim + name + delim + suffix (e.g. '%pagebreak%')
+    # the result is always identical to the simple sequential version:
+    #   for each template in order, if its pattern occurs: text = text.replace(pattern, value)
+    # but the text is scanned once and built with one join, and values are only computed for templates that occur
+    # templates with a prefix (literal context before the delimiter) must come last, and are applied sequentially after the single pass
+    # if the single pass cannot guarantee identical output (patterns sharing a delimiter, or a replacement producing another pattern) we fall back to the sequential version
+    def __init__(self, templateList, delim):
+        # templateList is a list of [name, prefix, suffix]; names must not contain the delimiter
+        self.templates = []
+        self.singlePassNames = {}
+        for [name, prefix, suffix] in templateList:
+            pattern = prefix + delim + name + delim + suffix
+            if (prefix==''):
+                if (len(self.singlePassNames) < len(self.templates)):
+                    raise Exception('TextTemplateEngine templates with a prefix must come after all others ({}).'.format(name))
+                # keyed by the pattern without its leading delimiter, which is what the regex captures
+                self.singlePassNames[pattern[len(delim):]] = name
+            self.templates.append([name, pattern])
+        # the regex starts with a literal, which lets the regex engine skip quickly to candidates; longest first
+        tailsRegexText = '(' + '|'.join([re.escape(tail) for tail in sorted(self.singlePassNames.keys(), key=len, reverse=True)]) + ')'
+        self.regex = re.compile(re.escape(delim) + tailsRegexText)
+        # a template name whose closing delimiter starts another pattern (%a%b%); the order of application decides which one is replaced
+        namesRegexText = '(?:' + '|'.join([re.escape(name) for [name, pattern] in self.templates]) + ')'
+        self.regexShared = re.compile(re.escape(delim) + namesRegexText + re.escape(delim) + tailsRegexText)
+
+    def substitute(self, text, valueFunc):
+        # valueFunc(name) returns the replacement text, and is called at most once per template that occurs
+        values = {}
+        if (len(self.singlePassNames)>0):
+            # split gives [text, tail, text, tail, ..., text]
+            parts = self.regex.split(text)
+            if (len(parts)>1):
+                if (self.regexShared.search(text) is not None):
+                    return self.substituteSequential(text, valueFunc, values)
+                tails = parts[1::2]
+                for tail in set(tails):
+                    values[self.singlePassNames[tail]] = valueFunc(self.singlePassNames[tail])
+                parts[1::2] = [values[self.singlePassNames[tail]] for tail in tails]
+                resultText = ''.join(parts)
+                if (self.regex.search(resultText) is not None):
+                    # a replacement value contained (or formed, with its neighbors) a pattern
+                    return self.substituteSequential(text, valueFunc, values)
+                text = resultText
+        # the (rare) templates with a prefix
+        for [name, pattern] in self.templates[len(self.singlePassNames):]:
+            if (text.find(pattern)>-1):
+                if (name not in values):
+                    values[name] = valueFunc(name)
+                text = text.replace(pattern, values[name])
+        return text
+
+    def substituteSequential(self, text, valueFunc, values):
+        for [name, pattern] in self.templates:
+            if (text.find(pattern)>-1):
+                if (name not in values):
+                    values[name] = valueFunc(name)
+                text = text.replace(pattern, values[name])
+        return text
+# ---------------------------------------------------------------------------
+
+# %solo.*% templates in lead text (see HlParser.renderLead)
+soloTemplateEngine = TextTemplateEngine([['solo.VerticalSpace', '', '\n'], ['solo.TurnPage', '', '\n']], '%')
+
+
+
+
+
+# ---------------------------------------------------------------------------
+class TransformingTextWriter:
+    # writes text to an open file in pieces, running a text transform (e.g. HlParser.textReplacementsLate) on each piece before it is written
+    # pending text is only cut just after a space, so for a transform whose patterns never contain a space the output is identical to transforming the whole text at once
+    def __init__(self, outFile, transformFunc, minChunkSize=renderFileBufferSize):
+        self.outFile = outFile
+        self.transformFunc = transformFunc
+        self.minChunkSize = minChunkSize
+        self.pending = []
+        self.pendingSize = 0
+
+    def write(self, text):
+        self.pending.append(text)
+        self.pendingSize += len(text)
+        if (self.pendingSize >= self.minChunkSize):
+            self.flushPending(False)
+
+    def close(self):
+        self.flushPending(True)
+
+    def flushPending(self, flagAll):
+        text = ''.join(self.pending)
+        cutPos = len(text) if (flagAll) else text.rfind(' ')+1
+        if (cutPos>0):
+            self.outFile.write(self.transformFunc(text[0:cutPos]))
+            text = text[cutPos:]
+        self.pending = [text]
+        self.pendingSize = len(text)
+# ---------------------------------------------------------------------------
+
+
+
+
+
 # ---------------------------------------------------------------------------
 # NOT A CLASS FUNCTION
 def fastExtractSettingsDictionary(text):
@@ -99,6 +317,9 @@ class HlParser:
         self.headBlocks = []
         self.leads = []
         self.leadStats = {}
+        # lead lookup indices (canonical id -> lead, renderId -> list of leads in lead order); kept in sync by addLead and setLeadRenderId
+        self.leadIdIndex = {}
+        self.leadRenderIdIndex = {}
 
         self.warnings = []
         self.dynamicLeadMap = {}
@@ -229,6 +450,26 @@ class HlParser:
         #
         # game file manager
         self.gameFileManager = self.getOptionValThrowException('gameFileManager')
+        #
+        # thread pool for generatePdflatexAsync (created on first use, shut down at the end of runBuildList)
+        self.pdflatexCompileExecutor = None
+        # compiles started by renderLeads during runBuildList that have not been finished yet (see waitPendingLatexCompiles)
+        self.flagDeferLatexCompiles = False
+        self.pendingLatexCompiles = []
+        #
+        # debug mode that checks the lead indices against a linear scan on every lookup
+        self.leadIndexDebugCheck = self.getOptionVal('leadIndexDebugCheck', False)
+        #
+        # parsed code blocks and code function dispatch (see evaluateCodeBlock)
+        self.codeCallCache = {}
+        self.codeFuncRegistry = self.buildCodeFuncRegistry()
+        self.codeFuncStats = {}
+        #
+        # per stage build timings (see getTimingTree)
+        self.timings = JrTimingTree('build')
+        #
+        # TextTemplateEngine for textReplacementsLate, per render format
+        self.lateTemplateEngines = {}
 # ---------------------------------------------------------------------------
 
 # ---------------------------------------------------------------------------
@@ -501,7 +742,7 @@ class HlParser:
                 dirPathLink = dirPath
                 fileFinishedPath = dirPathLink + '/' + fileName
                 if (fileNameLower.endswith('.txt')):
-                    jrprint('Adding file "{}" to lead queue.'.format(fileFinishedPath, baseName))
+                    jrprintVerbose('Adding file "{}" to lead queue.', fileFinishedPath)
                     self.storyFileList.append(fileFinishedPath)
 # ---------------------------------------------------------------------------
 
@@ -591,7 +832,7 @@ class HlParser:
 
 # ---------------------------------------------------------------------------
     def loadStoryFileIntoBlocks(self, filePath):
-        jrprint('Loading story file: "{}"'.format(filePath))
+        jrprintVerbose('Loading story file: "{}"', filePath)
         sourceLabel = 'FILE "{}"'.format(filePath)
         encoding = self.getOptionValThrowException('storyFileEncoding')
         fileText = jrfuncs.loadTxtFromFile(filePath, True, encoding)
@@ -601,7 +842,402 @@ class HlParser:
 
 
 
+    @timedSpan('parseStoryTextIntoBlocks')
     def parseStoryTextIntoBlocks(self, text, sourceLabel):
+        # NOTE: this must produce exactly the same blocks, line numbers and parse errors as parseStoryTextIntoBlocksCharLoop (see hlparsecompare.py)
+        self.storedGameTextAdd(text)
+        #
+        # add head comments to text so we skip all beginning stuff
+        text = '# comments\n' + text
+        #
+        text = self.textReplacementsEarlyMarkdown(text, sourceLabel)
+        #
+        # add newline to text to make sure we handle end of last line
+        text = text + '\n'
+        #
+        # reuse blocks from the previous build for unchanged chunks?
+        parseCacheFilePath = self.getOptionVal('parseCacheFilePath', None)
+        if (parseCacheFilePath is not None):
+            if (self.parseStoryTextIncremental(text, sourceLabel, parseCacheFilePath)):
+                return
+        #
+        self.tokenizeStoryTextIntoBlocks(text, sourceLabel, True)
+
+
+    def tokenizeStoryTextIntoBlocks(self, text, sourceLabel, flagWholeText):
+        # table driven tokenizer; rather than walking every character we jump from one significant delimiter to the next
+        # and handle the runs of ordinary characters between them as slices
+        # text has already been prepared by parseStoryTextIntoBlocks
+        # when flagWholeText is False we are parsing a single chunk for parseStoryTextIncremental; then instead of raising end of text errors
+        # and adding the eof block we return the final line number, or None if the chunk ended inside a header, code block or comment
+        headBlock = None
+        curTextBlock = None
+        curTextBlockParts = None
+        curTextParts = []
+        pendingTextBlocks = []
+        inSingleLineComment = False
+        inSingleLineHead = False
+        inBlockCommentDepth = 0
+        inCodeBlackDepth = 0
+        inRaw = False
+        lineNumber = 0
+        lineNumberStart = 0
+        posOnLine = -1
+        cprev = ''
+        inDoubleQuotes = False
+        #
+        validShortCodeStartCharacterList = 'abcdefghijklmnopqrstuvwxyz'
+        #
+        trackEnclosusers = {'comment': [], 'code': []}
+        #
+        textlen = len(text)
+        #
+        try:
+            i = -1
+            while (True):
+                i += 1
+                if (i>=textlen):
+                    break
+                #
+                c = text[i]
+                if (c not in storyTextDelimiterCharacters):
+                    # run of ordinary characters up to the next delimiter; none of them can change parser state
+                    matches = regexStoryTextDelimiter.search(text, i)
+                    runEnd = matches.start() if (matches is not None) else textlen
+                    # position bookkeeping for the first character then the rest of the run
+                    if (cprev == '\n'):
+                        posOnLine = 0
+                        lineNumber += 1
+                        inDoubleQuotes = False
+                    else:
+                        posOnLine += 1
+                    posOnLine += (runEnd - i) - 1
+                    cprev = text[runEnd-1]
+                    #
+                    if (inSingleLineComment) or (inBlockCommentDepth>0):
+                        # ignore it
+                        pass
+                    elif (inRaw) or ((not inSingleLineHead) and (inCodeBlackDepth==0)):
+                        # we are in a text block
+                        if (curTextBlock is None):
+                            curTextBlock = self.makeBlockText(sourceLabel, lineNumber)
+                            self.addChildBlock(headBlock, curTextBlock)
+                            curTextBlockParts = []
+                            pendingTextBlocks.append([curTextBlock, curTextBlockParts])
+                        curTextBlockParts.append(text[i:runEnd])
+                    else:
+                        # accumulating text for later block use
+                        curTextParts.append(text[i:runEnd])
+                    # resume at the delimiter
+                    i = runEnd - 1
+                    continue
+
+                # handle end of previous line
+                if (cprev == '\n'):
+                    # last character was end of line
+                    posOnLine = 0
+                    lineNumber += 1
+                    # reset double quotes (kludge)
+                    inDoubleQuotes = False
+                else:
+                    posOnLine += 1
+                #  get next char
+                cprev = c
+                if (i<textlen-1):
+                    cnext = text[i+1]
+                else:
+                    cnext = ''
+                #
+
+                if (c=='\n'):
+                    # FIRST we need to kick out of single line comment (very imp)
+                    if (inSingleLineComment):
+                        # single line comments end at end of line
+                        inSingleLineComment = False
+                        # now we drop down to handle end of single line head
+
+                    if (inSingleLineHead):
+                        # process the single line head
+                        inSingleLineHead = False
+                        curText = ''.join(curTextParts).strip()
+                        headBlock = self.makeBlockHeader(curText, sourceLabel, lineNumber, 'lead')
+                        self.addHeadBlock(headBlock)
+                        if ('raw' in headBlock['properties']) and (headBlock['properties']['raw']==True):
+                            # raw mode grabs EVERYTHING as text until the next header
+                            inRaw = True
+                        # clear current text
+                        curTextParts = []
+                        continue
+
+                # warnings
+                if (not inRaw):
+                    if (c=='#') and (cnext==' ') and (posOnLine==0) and ((inCodeBlackDepth>0) ):
+                        jrprint('WARNING: got a header inside a code block; source: {} line: {} pos: {}'.format(sourceLabel, lineNumber, posOnLine))
+                    if (c=='#') and (cnext==' ') and (posOnLine==0) and ((inBlockCommentDepth>0) ):
+                        jrprint('WARNING: got a header inside a comment block; source: {} line: {} pos: {}'.format(sourceLabel, lineNumber, posOnLine))
+
+                    if (c=='#') and (cnext!=' ') and (cnext!='#') and (posOnLine<=1):
+                        # probably an error
+                        self.raiseParseException('#LEAD without space encountered at start of line -- this is an error; you must have a space after the #.', i, posOnLine, lineNumber, text, sourceLabel)
+
+                if (inSingleLineComment):
+                    # we are on a comment line, just ignore it
+                    continue
+                #
+                if (c=='/') and (cnext=='*'):
+                    # blockComment start
+                    i+=1
+                    inBlockCommentDepth += 1
+                    if (inBlockCommentDepth==1):
+                        # clear current text block
+                        curTextBlock = None
+                    trackEnclosusers['comment'].append('line {} pos {}'.format(lineNumber,posOnLine))
+                    continue
+                if (c=='*') and (cnext=='/'):
+                    # blockComment end
+                    if (inBlockCommentDepth==0):
+                        self.raiseParseException('End of block comment encountered (*/) without matching start comment block (/*).', i, posOnLine, lineNumber, text, sourceLabel)
+                    i+=1
+                    inBlockCommentDepth -= 1
+                    trackEnclosusers['comment'].pop()
+                    if (inBlockCommentDepth<0):
+                        self.raiseParseException('End of comment block "*/" found without matching start.', i, posOnLine, lineNumber, text, sourceLabel)
+                    continue
+                if (inBlockCommentDepth>0):
+                    # in multi-line comment, ignore it
+                    continue
+
+                if (c=='"') or (c=='“') or (c=='”'):
+                    # toggle in double quotes
+                    inDoubleQuotes = not inDoubleQuotes
+                    # we use this to ignore // looking comment which could be url
+
+                #
+                if (c=='/') and (cnext=='/') and (not inDoubleQuotes):
+                    # single comment line start
+                    inSingleLineComment = True
+                    continue
+
+                if (inRaw):
+                    # grabbing everything until we get a valid next head block
+                    if (c=='#') and (cnext==' ') and (posOnLine==0):
+                        # we got something new
+                        inRaw = False
+                    else:
+                        # raw text glob
+                        if (curTextBlock is None):
+                            # create new text block
+                            curTextBlock = self.makeBlockText(sourceLabel, lineNumber)
+                            self.addChildBlock(headBlock, curTextBlock)
+                            curTextBlockParts = []
+                            pendingTextBlocks.append([curTextBlock, curTextBlockParts])
+                        # add character to textblock
+                        curTextBlockParts.append(c)
+                        continue
+
+                #
+                if (c=='{') and (not inSingleLineHead):
+                    # code block start
+                    inCodeBlackDepth += 1
+                    trackEnclosusers['code'].append('line {} pos {}'.format(lineNumber,posOnLine))
+                    if (inCodeBlackDepth==1):
+                        # outer code block { does not capture
+                        # clear current text block
+                        curTextBlock = None
+                        codeBlockStartLineNumber = lineNumber
+                        continue
+                if (c=='}') and (not inSingleLineHead):
+                    # code block end
+                    inCodeBlackDepth -= 1
+                    trackEnclosusers['code'].pop()
+                    if (inCodeBlackDepth<0):
+                        self.raiseParseException('End of code block "}" found without matching start.', i, posOnLine, lineNumber, text, sourceLabel)
+                    if (inCodeBlackDepth==0):
+                        # close of code block
+                        curText = ''.join(curTextParts).strip()
+                        block = self.makeBlockCode(curText, sourceLabel, codeBlockStartLineNumber, False)
+                        self.addChildBlock(headBlock, block)
+                        # clear current text to prepare for next block section
+                        curTextParts = []
+                        # out code block } does not capture
+                        continue
+                #
+                if (c=='$') and (cnext in validShortCodeStartCharacterList) and (not inSingleLineHead) and (inCodeBlackDepth==0):
+                    # got a shorthand code line (does not use {} but rather of the form $func(params))
+                    # just consume it all now
+                    [shortCodeText, resumePos] = self.consumeShortCodeFromText(text, sourceLabel, lineNumber, posOnLine, i+1)
+                    if (resumePos==-1):
+                        # false alarm no shortcode
+                        pass
+                    else:
+                        # got some shortcode
+                        shortCodeText = shortCodeText.strip()
+                        block = self.makeBlockCode(shortCodeText, sourceLabel, lineNumber, True)
+                        self.addChildBlock(headBlock, block)
+                        # clear current text to prepare for next block section
+                        curTextParts = []
+                        curTextBlock = None
+                        i = resumePos-1
+                        continue
+                #
+                if (c=='#') and (cnext==' ') and (posOnLine==0) and (not inSingleLineHead) and (inCodeBlackDepth==0):
+                    # "#" at start of line followed by space means we have a header
+                    # skip next char
+                    i+=1
+                    inSingleLineHead = True
+                    # clear current text block
+                    curTextBlock = None
+                    continue
+                #
+                if (not inSingleLineHead) and (inCodeBlackDepth==0) and (not inSingleLineComment) and (inBlockCommentDepth==0):
+                    # we are in a text block
+                    if (curTextBlock is None):
+                        # create new text block
+                        curTextBlock = self.makeBlockText(sourceLabel, lineNumber)
+                        self.addChildBlock(headBlock, curTextBlock)
+                        curTextBlockParts = []
+                        pendingTextBlocks.append([curTextBlock, curTextBlockParts])
+                    # add character to textblock
+                    curTextBlockParts.append(c)
+                else:
+                    # accumulating text for later block use
+                    curTextParts.append(c)
+        finally:
+            # text blocks are built from slices; join them now (even on a parse error, so partial state matches the char loop)
+            for [textBlock, textBlockParts] in pendingTextBlocks:
+                textBlock['text'] = ''.join(textBlockParts)
+
+        if (not flagWholeText):
+            if (inSingleLineHead) or (inCodeBlackDepth>0) or (inBlockCommentDepth>0):
+                return None
+            return lineNumber
+
+        # make sure didnt end in comments, etc.
+        if (inSingleLineHead):
+            self.raiseParseException('Unexpected end of text while parsing "#" header.', i, posOnLine, lineNumber, text, sourceLabel)
+        if (inCodeBlackDepth>0):
+            stackHistoryString = ';'.join(trackEnclosusers['code'])
+            self.raiseParseException('Unexpected end of text while inside code block [stack {}].'.format(stackHistoryString), i, posOnLine, lineNumber, text, sourceLabel)
+        if (inBlockCommentDepth>0):
+            stackHistoryString = ';'.join(trackEnclosusers['comment'])
+            self.raiseParseException('Unexpected end of text while inside comment block  [stack {}].'.format(stackHistoryString), i, posOnLine, lineNumber, text, sourceLabel)
+
+        # and eof which can help stop us from following one lead to subsequent one from another file
+        block = self.makeBlockEndFile(sourceLabel, lineNumber)
+        self.addChildBlock(headBlock, block)
+
+
+
+    def parseStoryTextIncremental(self, text, sourceLabel, parseCacheFilePath):
+        # split prepared story text into chunks at "# " header lines and reuse the blocks parsed for any chunk seen in the previous build
+        # returns False (having added nothing) if it can't be done safely, in which case the caller does a normal full parse
+        # a chunk can only be parsed on its own if no comment or code block is open where it starts, so any chunk that ends inside one forces a full parse
+        timeStart = time.time()
+        oldChunks = self.loadStoryParseCache(parseCacheFilePath)
+        newChunks = {}
+        headBlocks = []
+        reusedCount = 0
+        endLineNumber = 0
+        for [chunkText, chunkStartLine] in self.splitStoryTextIntoChunks(text):
+            chunkKey = hashlib.sha1((sourceLabel + '\n' + chunkText).encode('utf-8')).hexdigest()
+            chunkEntry = newChunks.get(chunkKey) or oldChunks.get(chunkKey)
+            if (chunkEntry is not None):
+                reusedCount += 1
+            else:
+                chunkEntry = self.parseStoryTextChunk(chunkText, sourceLabel, chunkStartLine)
+                if (chunkEntry is None):
+                    jrprint('Incremental parse not possible (chunk at line {} does not end cleanly); doing full parse.'.format(chunkStartLine))
+                    return False
+            newChunks[chunkKey] = chunkEntry
+            # fresh copy of the blocks, moved to where this chunk now sits in the text (cached line numbers are for startLine)
+            chunkBlocks = pickle.loads(chunkEntry['headBlocks'])
+            if (chunkStartLine != chunkEntry['startLine']):
+                self.offsetBlockLineNumbers(chunkBlocks, chunkStartLine - chunkEntry['startLine'])
+            headBlocks += chunkBlocks
+            endLineNumber = chunkEntry['endLineNumber'] + chunkStartLine
+        #
+        for headBlock in headBlocks:
+            self.addHeadBlock(headBlock)
+        # and eof which can help stop us from following one lead to subsequent one from another file
+        block = self.makeBlockEndFile(sourceLabel, endLineNumber)
+        self.addChildBlock(headBlocks[-1], block)
+        #
+        self.saveStoryParseCache(parseCacheFilePath, newChunks)
+        jrprint('Incremental parse reused {} of {} chunks in {:.3f}s.'.format(reusedCount, len(newChunks), time.time()-timeStart))
+        return True
+
+
+    def splitStoryTextIntoChunks(self, text):
+        # return list of [chunkText, startLineNumber]; every chunk starts at a "# " line (prepared text always starts with "# comments")
+        chunkList = []
+        startPositions = [matches.start() for matches in regexStoryTextChunkStart.finditer(text)]
+        lineNumber = 0
+        for index, startPos in enumerate(startPositions):
+            endPos = startPositions[index+1] if (index+1 < len(startPositions)) else len(text)
+            chunkText = text[startPos:endPos]
+            chunkList.append([chunkText, lineNumber])
+            lineNumber += chunkText.count('\n')
+        return chunkList
+
+
+    def parseStoryTextChunk(self, chunkText, sourceLabel, chunkStartLine):
+        # parse one chunk on its own; returns cache entry (pickled head blocks with line numbers as if the chunk starts at chunkStartLine) or None if it can't stand alone
+        savedHeadBlocks = self.headBlocks
+        self.headBlocks = []
+        try:
+            endLineNumber = self.tokenizeStoryTextIntoBlocks(chunkText, sourceLabel, False)
+            chunkHeadBlocks = self.headBlocks
+        except Exception as e:
+            # let the full parse report the error with proper context
+            return None
+        finally:
+            self.headBlocks = savedHeadBlocks
+        if (endLineNumber is None):
+            return None
+        self.offsetBlockLineNumbers(chunkHeadBlocks, chunkStartLine)
+        return {'headBlocks': pickle.dumps(chunkHeadBlocks, protocol=pickle.HIGHEST_PROTOCOL), 'startLine': chunkStartLine, 'endLineNumber': endLineNumber}
+
+
+    def offsetBlockLineNumbers(self, headBlocks, lineOffset):
+        for headBlock in headBlocks:
+            headBlock['lineNumber'] += lineOffset
+            if ('blocks' in headBlock):
+                for block in headBlock['blocks']:
+                    block['lineNumber'] += lineOffset
+
+
+    def loadStoryParseCache(self, parseCacheFilePath):
+        # returns dictionary of chunkKey -> chunk entry; empty if missing, unreadable or from a different parser version
+        if (not os.path.isfile(parseCacheFilePath)):
+            return {}
+        try:
+            with open(parseCacheFilePath, 'rb') as fp:
+                cacheData = pickle.load(fp)
+        except Exception as e:
+            jrprint('Ignoring unreadable story parse cache "{}": {}'.format(parseCacheFilePath, repr(e)))
+            return {}
+        if (cacheData.get('version') != storyParseCacheVersion) or (cacheData.get('buildVersion') != buildVersion):
+            return {}
+        return cacheData['chunks']
+
+
+    def saveStoryParseCache(self, parseCacheFilePath, chunks):
+        # only the chunks of the current text are kept, so the cache never grows beyond one game's worth
+        jrfuncs.createDirIfMissing(os.path.dirname(parseCacheFilePath))
+        cacheData = {'version': storyParseCacheVersion, 'buildVersion': buildVersion, 'chunks': chunks}
+        tempFilePath = '{}.{}.tmp'.format(parseCacheFilePath, os.getpid())
+        try:
+            with open(tempFilePath, 'wb') as fp:
+                pickle.dump(cacheData, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tempFilePath, parseCacheFilePath)
+        except Exception as e:
+            jrprint('Could not save story parse cache "{}": {}'.format(parseCacheFilePath, repr(e)))
+            jrfuncs.deleteFilePathIfExists(tempFilePath)
+
+
+
+    def parseStoryTextIntoBlocksCharLoop(self, text, sourceLabel):
+        # original per-character parser; kept as the reference implementation for differential testing of parseStoryTextIntoBlocks
         headBlock = None
         curTextBlock = None
         curText = ''
@@ -1058,7 +1694,12 @@ class HlParser:
 # ---------------------------------------------------------------------------
     def consumeShortCodeFromText(self, text, sourceLabel, lineNumber, posOnLine, textPos):
         # return [shortCodeText, resumePos]
-        remainderText = text[textPos:]
+        # shortcodes cannot span lines, so only look at the rest of this line (including its newline) instead of copying the whole remaining text
+        lineEndPos = text.find('\n', textPos)
+        if (lineEndPos==-1):
+            remainderText = text[textPos:]
+        else:
+            remainderText = text[textPos:lineEndPos+1]
         matches = re.match(r'^([a-z][A-Za-z0-9_]*)(\(.*)$', remainderText, re.MULTILINE)
         if (matches is None):
             # not a shortcode
@@ -1453,6 +2094,7 @@ class HlParser:
 
 
 # ---------------------------------------------------------------------------
+    @timedSpan('processHeadBlocks')
     def processHeadBlocks(self):
         # first we make a pass for EARLY stage processing
         # we need to do this in multiple stages because we do NOT want to fully process a lead if it is overwritten by another later
@@ -1461,6 +2103,7 @@ class HlParser:
             self.processHeadBlock(block)
 
 
+    @timedSpan('processLeads')
     def processLeads(self):
         # now process leads
         jrprint('Processing {} leads..'.format(len(self.leads)))
@@ -1789,7 +2432,7 @@ class HlParser:
         leadId = lead['id']
         leadProprties = lead['properties']
         debugInfo = leadProprties['label']
-        jrprint('Stage 2: Processing lead {:.<20}... {}'.format(leadId, debugInfo))
+        jrprintVerbose('Stage 2: Processing lead {:.<20}... {}', leadId, debugInfo)
 
         # manual warnings for leads
         warningVal = jrfuncs.getDictValueOrDefault(leadProprties, 'warning', None)
@@ -1894,6 +2537,26 @@ class HlParser:
         
         leadId = self.canonicalLeadId(leadId)
 
+        # same result as a linear scan: the first lead (in lead order) whose id matches or (optionally) whose renderId matches
+        lead = self.leadIdIndex.get(leadId)
+        if (flagCheckRenderId):
+            renderIdLeads = self.leadRenderIdIndex.get(leadId)
+            if (renderIdLeads is not None):
+                renderIdLead = renderIdLeads[0]
+                if (lead is None) or (renderIdLead['leadIndex'] < lead['leadIndex']):
+                    lead = renderIdLead
+
+        if (self.leadIndexDebugCheck):
+            self.checkLeadIndexInvariants()
+            scanLead = self.findLeadByIdLinearScan(leadId, flagCheckRenderId)
+            if (scanLead is not lead):
+                raise Exception('Lead index out of sync for lookup of lead id "{}" (flagCheckRenderId={}).'.format(leadId, flagCheckRenderId))
+
+        return lead
+
+
+    def findLeadByIdLinearScan(self, leadId, flagCheckRenderId):
+        # original unindexed lookup; used only to check the indices in debug mode
         for lead in self.leads:
             propLeadId = lead['id']
             if (propLeadId == leadId):
@@ -1904,6 +2567,7 @@ class HlParser:
 
         return None
 
+
     def addLead(self, lead):
         #jrprint('Storing lead: {}.'.format(leadId))
 
@@ -1915,6 +2579,10 @@ class HlParser:
         leadIndex = len(self.leads)
         lead['leadIndex'] = leadIndex
         self.leads.append(lead)
+        # update indices
+        self.leadIdIndex[lead['id']] = lead
+        self.addLeadToRenderIdIndex(lead, lead['properties']['renderId'])
+        #
         mapStyle = jrfuncs.getDictValueOrDefault(lead['properties'],'map','')
         propType = jrfuncs.getDictValueOrDefault(lead['properties'],'type','')
         if (propType=='doc_REN'):
@@ -1924,6 +2592,57 @@ class HlParser:
             self.createMindMapLead(lead, mapStyle)
         return leadIndex
 
+
+    def setLeadRenderId(self, lead, renderId):
+        # change the renderId of a lead, keeping the renderId index in sync; ALL changes to renderId after addLead must go through here
+        properties = lead['properties']
+        if (self.isLeadIndexed(lead)):
+            self.removeLeadFromRenderIdIndex(lead, properties['renderId'])
+            properties['renderId'] = renderId
+            self.addLeadToRenderIdIndex(lead, renderId)
+        else:
+            properties['renderId'] = renderId
+
+    def isLeadIndexed(self, lead):
+        leadIndex = lead.get('leadIndex')
+        return (leadIndex is not None) and (leadIndex < len(self.leads)) and (self.leads[leadIndex] is lead)
+
+    def addLeadToRenderIdIndex(self, lead, renderId):
+        renderIdLeads = self.leadRenderIdIndex.get(renderId)
+        if (renderIdLeads is None):
+            self.leadRenderIdIndex[renderId] = [lead]
+            return
+        # keep in lead order so the first entry is what a linear scan would find
+        insertPos = len(renderIdLeads)
+        while (insertPos > 0) and (renderIdLeads[insertPos-1]['leadIndex'] > lead['leadIndex']):
+            insertPos -= 1
+        renderIdLeads.insert(insertPos, lead)
+
+    def removeLeadFromRenderIdIndex(self, lead, renderId):
+        renderIdLeads = self.leadRenderIdIndex.get(renderId)
+        if (renderIdLeads is None):
+            return
+        renderIdLeads[:] = [renderIdLead for renderIdLead in renderIdLeads if (renderIdLead is not lead)]
+        if (len(renderIdLeads)==0):
+            del self.leadRenderIdIndex[renderId]
+
+
+    def checkLeadIndexInvariants(self):
+        # debug check that the lead indices exactly mirror self.leads
+        renderIdCount = 0
+        for leadIndex, lead in enumerate(self.leads):
+            if (lead['leadIndex'] != leadIndex):
+                raise Exception('Lead index invariant failed: lead "{}" has leadIndex {} but is at position {}.'.format(lead['id'], lead['leadIndex'], leadIndex))
+            if (self.leadIdIndex.get(lead['id']) is not lead):
+                raise Exception('Lead index invariant failed: lead id "{}" not indexed.'.format(lead['id']))
+            renderIdLeads = self.leadRenderIdIndex.get(lead['properties']['renderId'], [])
+            if (not any(renderIdLead is lead for renderIdLead in renderIdLeads)):
+                raise Exception('Lead index invariant failed: lead "{}" not indexed under renderId "{}" (was renderId changed without setLeadRenderId?).'.format(lead['id'], lead['properties']['renderId']))
+        for renderIdLeads in self.leadRenderIdIndex.values():
+            renderIdCount += len(renderIdLeads)
+        if (len(self.leadIdIndex) != len(self.leads)) or (renderIdCount != len(self.leads)):
+            raise Exception('Lead index invariant failed: index sizes ({}, {}) do not match lead count ({}).'.format(len(self.leadIdIndex), renderIdCount, len(self.leads)))
+
     def canonicalLeadId(self, id):
         # uppercase
         #id = id.upper()
@@ -2888,26 +3607,18 @@ class HlParser:
         # note that now behalfLead is the lead that should be credited with any debug stats, and if it is None then do not count such stats
         # this is used so that we can regenerate leads in a debug mode and similar things without effecting such stats
 
-        # options
-        optionConditionTagsAsLetters = self.getConditionTagsAsLetters()
-
-        # initial values; the None for reportText says to copy from resultText
-        codeResult = {}
-        resultText = ''
-        reportText = None
-        behalfLeadId = behalfLead['id']
-        behalfLeadProperties = behalfLead['properties']
-
-        # parse code
-        codeText = block['text']
-        [funcName, args, pos] = self.parseFunctionCallAndArgs(block, codeText)
-
+        # parse code (only the first time we see this code text)
+        call = self.getParsedCodeCall(block)
+        funcName = call.funcName
 
-        #flagDisableDemeritHours = True
-        #if (flagDisableDemeritHours):
-        #    funcNameFix = {'demerithours': 'demerits', 'inlinedemerithours': 'inlinedemerit'}
-        #    if (funcName in funcNameFix):
-        #        funcName = funcNameFix[funcName]
+        # find the handler for this function (see buildCodeFuncRegistry)
+        handler = self.codeFuncRegistry.get(funcName)
+        if (handler is None):
+            # debug
+            dbgObj = {'funcName': funcName, 'args': call.args, 'pos': call.pos}
+            text = json.dumps(dbgObj)
+            msg = 'Syntax error; code function not understood: {}'.format(text)
+            self.raiseBlockException(block, 0, msg)
 
         if (sourceLead==behalfLead) or (behalfLead is None):
             leadInfoText = 'lead "{}"'.format(sourceLead['id'])
@@ -2916,566 +3627,765 @@ class HlParser:
             leadInfoText = 'lead "{}" [copied from "{}"]'.format(behalfLead['id'], sourceLead['id'])
             leadInfoMText = 'lead "{}" [copied from "{}"]'.format(self.makeTextLinkToLead(behalfLead, None, True, True), self.makeTextLinkToLead(sourceLead, None, True, True))
 
-        if (funcName=='empty'):
-            # just placeholder
-            pass
-        
-        elif (funcName=='options'):
-            # merge in options
-            jsonOptionString = args['json']
-            jsonOptions = json.loads(jsonOptionString)
-            # set the WORKINGDIR options
-            self.jroptionsWorkingDir.mergeRawDataForKey('options', jsonOptions)
-
-        elif (funcName in ['golead','leadid', 'returnlead', 'reflead', 'goleadback']):
-            # replace with a lead's rendered id
-            leadId = args['leadId']
-            mindMapLinkLabel = jrfuncs.getDictValueOrDefault(args,'link',None)
-            comeBack = jrfuncs.getDictValueFromTrueFalse(args,'comeback',False)
-            #
-            existingLead = self.findLeadById(leadId, False)
-            if (existingLead is None):
-                self.raiseBlockException(block, 0, 'Unknown lead reference: "{}"'.format(leadId))
-            #
-            if (funcName == 'golead'):
-                linkText = self.makeTextLinkToLead(existingLead, None, False, True)
-                baseText = self.getText('goto') + ' ' + linkText
-            elif (funcName == 'goleadback'):
-                linkText = self.makeTextLinkToLead(existingLead, None, False, True)
-                baseText = self.getText('goto') + ' ' + linkText
-                baseText += ' then return here afterwards.'
-            elif (funcName == 'returnlead'):
-                linkText = self.makeTextLinkToLead(existingLead, None, False, True)
-                baseText = self.getText('returnto') + ' ' + linkText
-            elif (funcName == 'reflead'):
-                linkText = self.makeTextLinkToLead(existingLead, None, False, True)
-                baseText = linkText
-            else:
-                linkText = self.makeTextLinkToLead(existingLead, None, False, False)
-                baseText = linkText
-            #
-            if (comeBack):
-                baseText += ' and then return'
+        # evaluation state passed to the handler; handlers may set 'action' etc. in codeResult
+        codeResult = {}
+        ev = {'block': block, 'sourceLead': sourceLead, 'behalfLead': behalfLead, 'behalfLeadId': behalfLead['id'], 'behalfLeadProperties': behalfLead['properties'],
+              'textPositionStyle': textPositionStyle, 'evaluationOptions': evaluationOptions, 'context': context, 'codeResult': codeResult,
+              'leadInfoText': leadInfoText, 'leadInfoMText': leadInfoMText}
 
-            if (funcName=='returnlead'):
-                flagBoxIt = True
-                #fullLineText = self.getFullLineReturnToMd(False)
-                fullLineText = ''
-            else:
-                flagBoxIt = True
-                fullLineText =  '* '
-                fullLineText = ''
-            baseText = self.modifyTextToSuitTextPositionStyle(baseText, textPositionStyle, fullLineText, True, flagBoxIt, False)
-            resultText = baseText
-            # mindmap
-            self.createMindMapLinkLeadGoesToLead(block, behalfLead, existingLead, context, mindMapLinkLabel, False)
-            # default no autotime on leads that go somewhere
-            behalfLeadProperties['defaultTime'] = False
+        # run it; the handler gets its own copy of the args since the parsed call is shared
+        # the None for reportText says to copy from resultText
+        startTime = time.perf_counter()
+        [resultText, reportText] = handler(funcName, dict(call.args), ev)
+        self.addCodeFuncStat(funcName, time.perf_counter() - startTime)
 
-        elif (funcName in ['gofake', 'gofakebak']):
-            leadId = self.consumeUnusedLeadId()
-            if (funcName == 'gofake'):
-                linkText = self.makeTextLinkToLeadId(leadId, leadId, None, False, False)
-                baseText = self.getText('goto') + ' ' + linkText
-            elif (funcName == 'gofakeback'):
-                linkText = self.makeTextLinkToLeadId(leadId, leadId, None, False, False)
-                baseText = self.getText('goto') + ' ' + linkText
-                baseText += ' then return here afterwards.'
-            fullLineText =  '* '
-            baseText = self.modifyTextToSuitTextPositionStyle(baseText, textPositionStyle, fullLineText, True, False, False)
-            resultText = baseText
+        # store results
+        codeResult['text'] = resultText
+        if (reportText is None):
+            reportText = resultText
+        codeResult['reportText'] = reportText
 
+        return codeResult
+# ---------------------------------------------------------------------------
 
-        elif (funcName in ['returninline']):
-            # replace with a lead's rendered id
-            leadId = jrfuncs.getDictValueOrDefault(behalfLeadProperties,'inlineSourceLeadId',None)
-            if (leadId is None):
-                self.raiseBlockException(block, 0, 'The $returninline() function can only be used inside an inline lead; otherwise use $returnlead()')
-            mindMapLinkLabel = jrfuncs.getDictValueOrDefault(args,'link',None)
-            #
-            existingLead = self.findLeadById(leadId, False)
-            if (existingLead is None):
-                self.raiseBlockException(block, 0, 'Unknown lead reference: "{}"'.format(leadId))
-            #
-            linkText = self.makeTextLinkToLead(existingLead, None, False, True)
-            baseText = self.getText('returnto') + ' ' + linkText
-            #baseText = self.modifyTextToSuitTextPositionStyle(baseText, textPositionStyle, self.getFullLineReturnToMd(False), True, False, False)
-            baseText = self.modifyTextToSuitTextPositionStyle(baseText, textPositionStyle, '', True, True, False)
-            resultText = baseText
-            # mindmap
-            self.createMindMapLinkLeadGoesToLead(block, behalfLead, existingLead, context, mindMapLinkLabel, False)
 
 
+# ---------------------------------------------------------------------------
+    def getParsedCodeCall(self, block):
+        # code blocks are parsed (and their args validated against self.argDefs) only once, and the HlCodeCall reused for every later evaluation
+        # (blank leads evaluated on behalf of another lead, inserted leads, debug regeneration); the parse depends on nothing but the code text
+        # so we key on that, which also keeps the block dicts (saved to json and the story parse cache) unchanged
+        codeText = block['text']
+        call = self.codeCallCache.get(codeText)
+        if (call is None):
+            [funcName, args, pos] = self.parseFunctionCallAndArgs(block, codeText)
+            call = HlCodeCall(funcName, args, pos)
+            self.codeCallCache[codeText] = call
+        return call
+
+
+    def buildCodeFuncRegistry(self):
+        # map of code function name -> handler(funcName, args, ev) returning [resultText, reportText]
+        # note that argDefs defines some names (demerits, resumebriefing) without a handler; these are reported as syntax errors
+        registry = {
+            'empty': self.evalCodeFuncEmpty,
+            'options': self.evalCodeFuncOptions,
+            'golead': self.evalCodeFuncGoLead,
+            'leadid': self.evalCodeFuncGoLead,
+            'returnlead': self.evalCodeFuncGoLead,
+            'reflead': self.evalCodeFuncGoLead,
+            'goleadback': self.evalCodeFuncGoLead,
+            'gofake': self.evalCodeFuncGoFake,
+            'gofakeback': self.evalCodeFuncGoFake,
+            'returninline': self.evalCodeFuncReturnInline,
+            'definetag': self.evalCodeFuncDefineTag,
+            'gaintag': self.evalCodeFuncGainTag,
+            'hastag': self.evalCodeFuncUseTag,
+            'hasalltags': self.evalCodeFuncUseTag,
+            'hasanytag': self.evalCodeFuncUseTag,
+            'requiretag': self.evalCodeFuncUseTag,
+            'requirealltags': self.evalCodeFuncUseTag,
+            'requireanytags': self.evalCodeFuncUseTag,
+            'missingtag': self.evalCodeFuncUseTag,
+            'missinganytags': self.evalCodeFuncUseTag,
+            'missingalltags': self.evalCodeFuncUseTag,
+            'mentiontags': self.evalCodeFuncUseTag,
+            'beforeday': self.evalCodeFuncDayCheck,
+            'afterday': self.evalCodeFuncDayCheck,
+            'onday': self.evalCodeFuncDayCheck,
+            'inline': self.evalCodeFuncInline,
+            'inlineback': self.evalCodeFuncInline,
+            'inlinehint': self.evalCodeFuncInline,
+            'endjump': self.evalCodeFuncEndJump,
+            'insertlead': self.evalCodeFuncInsertLead,
+            'get': self.evalCodeFuncGetVar,
+            'set': self.evalCodeFuncSetVar,
+            'mark': self.evalCodeFuncMark,
+            'time': self.evalCodeFuncTime,
+            'otime': self.evalCodeFuncTime,
+            'backdemerit': self.evalCodeFuncBackDemerit,
+            'form': self.evalCodeFuncForm,
+            'report': self.evalCodeFuncReport,
+            'otherwise': self.evalCodeFuncOtherwise,
+            'logicmentions': self.evalCodeFuncLogicLinkTo,
+            'logicimplies': self.evalCodeFuncLogicLinkTo,
+            'logicsuggests': self.evalCodeFuncLogicLinkTo,
+            'logicmentionedby': self.evalCodeFuncLogicLinkFrom,
+            'logicimpliedby': self.evalCodeFuncLogicLinkFrom,
+            'logicsuggestedby': self.evalCodeFuncLogicLinkFrom,
+            'logicidea': self.evalCodeFuncLogicIdea,
+            'logicab': self.evalCodeFuncLogicAb,
+            'logicaba': self.evalCodeFuncLogicAb,
+            'logicirrelevant': self.evalCodeFuncLogicIrrelevant,
+            'onlyonce': self.evalCodeFuncOnlyOnce,
+            'warning': self.evalCodeFuncWarning,
+            'remind': self.evalCodeFuncRemind,
+            'autohint': self.evalCodeFuncAutoHint,
+            'deadlineinfo': self.evalCodeFuncDeadlineInfo,
+            'ifcond': self.evalCodeFuncIfCond,
+            'include': self.evalCodeFuncInclude,
+            'begin': self.evalCodeFuncBeginEnd,
+            'end': self.evalCodeFuncBeginEnd,
+        }
+        return registry
 
 
+    def addCodeFuncStat(self, funcName, elapsed):
+        # per function call counts and cumulative time (inclusive of nested evaluation, e.g. $insertlead), reported in debug builds
+        if (funcName not in self.codeFuncStats):
+            self.codeFuncStats[funcName] = {'calls': 0, 'time': 0.0}
+        stats = self.codeFuncStats[funcName]
+        stats['calls'] += 1
+        stats['time'] += elapsed
 
 
+    def reportCodeFuncStats(self):
+        if (len(self.codeFuncStats)==0):
+            return
+        lines = []
+        for funcName, stats in sorted(self.codeFuncStats.items(), key=lambda item: item[1]['time'], reverse=True):
+            lines.append('  {}: {} calls, {:.1f}ms total, {:.3f}ms avg'.format(funcName, stats['calls'], stats['time']*1000.0, stats['time']*1000.0/stats['calls']))
+        msg = 'Code function evaluation stats ({} distinct code blocks parsed):\n'.format(len(self.codeCallCache)) + '\n'.join(lines)
+        jrprint(msg)
+        self.addBuildLog(msg, False)
+# ---------------------------------------------------------------------------
 
 
 
+# ---------------------------------------------------------------------------
+# code function handlers (see buildCodeFuncRegistry)
+    def evalCodeFuncEmpty(self, funcName, args, ev):
+        resultText = ''
+        reportText = None
+        # just placeholder
+        return [resultText, reportText]
 
+    def evalCodeFuncOptions(self, funcName, args, ev):
+        resultText = ''
+        reportText = None
+        # merge in options
+        jsonOptionString = args['json']
+        jsonOptions = json.loads(jsonOptionString)
+        # set the WORKINGDIR options
+        self.jroptionsWorkingDir.mergeRawDataForKey('options', jsonOptions)
+        return [resultText, reportText]
 
+    def evalCodeFuncGoLead(self, funcName, args, ev):
+        block = ev['block']
+        behalfLead = ev['behalfLead']
+        behalfLeadProperties = ev['behalfLeadProperties']
+        textPositionStyle = ev['textPositionStyle']
+        context = ev['context']
+        resultText = ''
+        reportText = None
+        # replace with a lead's rendered id
+        leadId = args['leadId']
+        mindMapLinkLabel = jrfuncs.getDictValueOrDefault(args,'link',None)
+        comeBack = jrfuncs.getDictValueFromTrueFalse(args,'comeback',False)
+        #
+        existingLead = self.findLeadById(leadId, False)
+        if (existingLead is None):
+            self.raiseBlockException(block, 0, 'Unknown lead reference: "{}"'.format(leadId))
+        #
+        if (funcName == 'golead'):
+            linkText = self.makeTextLinkToLead(existingLead, None, False, True)
+            baseText = self.getText('goto') + ' ' + linkText
+        elif (funcName == 'goleadback'):
+            linkText = self.makeTextLinkToLead(existingLead, None, False, True)
+            baseText = self.getText('goto') + ' ' + linkText
+            baseText += ' then return here afterwards.'
+        elif (funcName == 'returnlead'):
+            linkText = self.makeTextLinkToLead(existingLead, None, False, True)
+            baseText = self.getText('returnto') + ' ' + linkText
+        elif (funcName == 'reflead'):
+            linkText = self.makeTextLinkToLead(existingLead, None, False, True)
+            baseText = linkText
+        else:
+            linkText = self.makeTextLinkToLead(existingLead, None, False, False)
+            baseText = linkText
+        #
+        if (comeBack):
+            baseText += ' and then return'
 
+        if (funcName=='returnlead'):
+            flagBoxIt = True
+            #fullLineText = self.getFullLineReturnToMd(False)
+            fullLineText = ''
+        else:
+            flagBoxIt = True
+            fullLineText =  '* '
+            fullLineText = ''
+        baseText = self.modifyTextToSuitTextPositionStyle(baseText, textPositionStyle, fullLineText, True, flagBoxIt, False)
+        resultText = baseText
+        # mindmap
+        self.createMindMapLinkLeadGoesToLead(block, behalfLead, existingLead, context, mindMapLinkLabel, False)
+        # default no autotime on leads that go somewhere
+        behalfLeadProperties['defaultTime'] = False
+        return [resultText, reportText]
 
+    def evalCodeFuncGoFake(self, funcName, args, ev):
+        textPositionStyle = ev['textPositionStyle']
+        resultText = ''
+        reportText = None
+        leadId = self.consumeUnusedLeadId()
+        if (funcName == 'gofake'):
+            linkText = self.makeTextLinkToLeadId(leadId, leadId, None, False, False)
+            baseText = self.getText('goto') + ' ' + linkText
+        elif (funcName == 'gofakeback'):
+            linkText = self.makeTextLinkToLeadId(leadId, leadId, None, False, False)
+            baseText = self.getText('goto') + ' ' + linkText
+            baseText += ' then return here afterwards.'
+        fullLineText =  '* '
+        baseText = self.modifyTextToSuitTextPositionStyle(baseText, textPositionStyle, fullLineText, True, False, False)
+        resultText = baseText
+        return [resultText, reportText]
 
+    def evalCodeFuncReturnInline(self, funcName, args, ev):
+        block = ev['block']
+        behalfLead = ev['behalfLead']
+        behalfLeadProperties = ev['behalfLeadProperties']
+        textPositionStyle = ev['textPositionStyle']
+        context = ev['context']
+        resultText = ''
+        reportText = None
+        # replace with a lead's rendered id
+        leadId = jrfuncs.getDictValueOrDefault(behalfLeadProperties,'inlineSourceLeadId',None)
+        if (leadId is None):
+            self.raiseBlockException(block, 0, 'The $returninline() function can only be used inside an inline lead; otherwise use $returnlead()')
+        mindMapLinkLabel = jrfuncs.getDictValueOrDefault(args,'link',None)
+        #
+        existingLead = self.findLeadById(leadId, False)
+        if (existingLead is None):
+            self.raiseBlockException(block, 0, 'Unknown lead reference: "{}"'.format(leadId))
+        #
+        linkText = self.makeTextLinkToLead(existingLead, None, False, True)
+        baseText = self.getText('returnto') + ' ' + linkText
+        #baseText = self.modifyTextToSuitTextPositionStyle(baseText, textPositionStyle, self.getFullLineReturnToMd(False), True, False, False)
+        baseText = self.modifyTextToSuitTextPositionStyle(baseText, textPositionStyle, '', True, True, False)
+        resultText = baseText
+        # mindmap
+        self.createMindMapLinkLeadGoesToLead(block, behalfLead, existingLead, context, mindMapLinkLabel, False)
+        return [resultText, reportText]
 
+    # tag use
+    def evalCodeFuncDefineTag(self, funcName, args, ev):
+        block = ev['block']
+        behalfLead = ev['behalfLead']
+        resultText = ''
+        reportText = None
+        # we now require pre defining tags before use to catch errors better
+        self.doDefineTag('', args, behalfLead, None, block)
+        resultText = ''
+        return [resultText, reportText]
 
+    def evalCodeFuncGainTag(self, funcName, args, ev):
+        block = ev['block']
+        behalfLead = ev['behalfLead']
+        textPositionStyle = ev['textPositionStyle']
+        leadInfoText = ev['leadInfoText']
+        leadInfoMText = ev['leadInfoMText']
+        resultText = ''
+        reportText = None
+        # show someone text that they get a tag
+        [resultText, reportText] = self.doGainTag(args, behalfLead, block, leadInfoText, leadInfoMText, textPositionStyle)
+        return [resultText, reportText]
 
+    def evalCodeFuncUseTag(self, funcName, args, ev):
+        block = ev['block']
+        behalfLead = ev['behalfLead']
+        textPositionStyle = ev['textPositionStyle']
+        context = ev['context']
+        codeResult = ev['codeResult']
+        leadInfoText = ev['leadInfoText']
+        leadInfoMText = ev['leadInfoMText']
+        resultText = ''
+        reportText = None
+        # show someone text that checking a tag
+        [resultText, reportText] = self.doUseTag(args, behalfLead, funcName, codeResult, context, block, leadInfoText, leadInfoMText, textPositionStyle)
+        return [resultText, reportText]
 
+    def evalCodeFuncDayCheck(self, funcName, args, ev):
+        block = ev['block']
+        behalfLead = ev['behalfLead']
+        textPositionStyle = ev['textPositionStyle']
+        context = ev['context']
+        leadInfoText = ev['leadInfoText']
+        leadInfoMText = ev['leadInfoMText']
+        resultText = ''
+        reportText = None
+        # kludge to make condition tag a bit nicer
+        #
+        day = int(args['day'])
+        #
+        # we make it a TAG soley for mindmap graphing and keeping track of use
+        virtualTagNameMap = {'beforeday': 'preday', 'afterday': 'postday', 'onday': 'day'}
+        virtualTagId = 'day.{}_{}'.format(virtualTagNameMap[funcName], day)
+        #
+        # look up tag, do NOT convert to letter
+        tagDict = self.findTag(virtualTagId, behalfLead, block, False, False)
+        if (tagDict is None):
+            # day tags do not have to exist ahead of time, we create them on the fly
+            tagArgs = {'id': virtualTagId, 'relation': funcName, 'day': day}
+            tagDict = self.doDefineTag('', tagArgs, behalfLead, None, block)
+        #
+        # track use
+        if (behalfLead is not None):
+            tagDict['useCount'] += 1
+            msg = 'Checking if it is {} {}'.format(funcName, day)
+            self.appendUseNoteToTagDict(tagDict, msg, leadInfoText, leadInfoMText, block)
 
+        # remember tags for a future mindmap
+        context['lastTest'] = {'block': block, 'text': virtualTagId}
 
+        # build output
+        resultText = tagDict['testText']
+        resultText = self.modifyTextToSuitTextPositionStyle(resultText, textPositionStyle, '* ', True, False, False)
 
+        # mindmap
+        self.createMindMapLinkLeadChecksDay(behalfLead, tagDict['id'])
+        return [resultText, reportText]
 
-
-
-        # tag use
-        elif (funcName=='definetag'):
-            # we now require pre defining tags before use to catch errors better
-            self.doDefineTag('', args, behalfLead, None, block)
-            resultText = ''
-
-
-        elif (funcName=='gaintag'):
-            # show someone text that they get a tag
-            [resultText, reportText] = self.doGainTag(args, behalfLead, block, leadInfoText, leadInfoMText, textPositionStyle)
-
-        elif (funcName in ['hastag', 'hasalltags', 'hasanytag', 'requiretag', 'requirealltags', 'requireanytags', 'missingtag','missinganytags','missingalltags', 'mentiontags']):
-            # show someone text that checking a tag
-            [resultText, reportText] = self.doUseTag(args, behalfLead, funcName, codeResult, context, block, leadInfoText, leadInfoMText, textPositionStyle)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-        elif (funcName in ['beforeday', 'afterday', 'onday']):
-            # kludge to make condition tag a bit nicer
-            #
-            day = int(args['day'])
+    def evalCodeFuncInline(self, funcName, args, ev):
+        behalfLead = ev['behalfLead']
+        behalfLeadProperties = ev['behalfLeadProperties']
+        codeResult = ev['codeResult']
+        resultText = ''
+        reportText = None
+        # tricky one, this moves the subsqeuent text blocks into a new dynamically assigned lead and returns the lead #
+        # it is handled by caller not by use
+        #
+        codeResult['action'] = 'inline'
+        codeResult['args'] = jrfuncs.deepCopyListDict(args)
+        #
+        leadTagType = jrfuncs.getDictValueOrDefault(behalfLeadProperties, 'leadTagType','')
+        if (leadTagType=='hint'):
+            # inlines derived from hints to not take up time by default
+            codeResult['args']['defaultTime'] = False
+        #
+        # shortcut
+        if (funcName in ['inlineback', 'inlinehint']):
+            optionDefaultBack = True
+        else:
+            optionDefaultBack = False
+        #
+        back = jrfuncs.getDictValueFromTrueFalse(args, 'back', optionDefaultBack)
+        resume = jrfuncs.getDictValueFromTrueFalse(args, 'resume', False)
+        unless = jrfuncs.getDictValueOrDefault(args, 'unless', None)
+        optionDisableDemeritHours = True
+        demerits = jrfuncs.getDictValueOrDefault(args, 'demerits', None)
+        demeritHours = jrfuncs.getDictValueOrDefault(args, 'demeritHours', None)
+        if (demeritHours is not None) and (demerits is None) and optionDisableDemeritHours:
+            demerits = demeritHours
+            demeritHours = None
+        #
+
+        returnLink = self.makeTextLinkToLead(behalfLead, None, False, True)
+        returnText = ''
+        codeResult['args']['after'] = ''
+        codeResult['inlinePostText'] = ''
+        simplePost = True
+
+        if (resume):
+            returnText = 'resume searching for leads'
+            codeResult['args']['after'] = 'then resume searching for leads'
+            codeResult['inlinePostText'] = 'resume searching for leads'
+        #
+        if (back):
+            linkText = returnLink
+            if (returnText != ''):
+                returnText += ', then '
+            if (codeResult['args']['after'] != ''):
+                codeResult['args']['after'] += ', '
+            returnText += self.getText('returnto') + ' ' + linkText + '.'
+            codeResult['args']['after'] += 'then return here afterwards.'
+            codeResult['inlinePostText'] += returnText
+
+
+        if (demerits is not None):
+            simplePost = False
+            amount = int(args['demerits'])
+            markType = 'demerit'
             #
-            # we make it a TAG soley for mindmap graphing and keeping track of use
-            virtualTagNameMap = {'beforeday': 'preday', 'afterday': 'postday', 'onday': 'day'}
-            virtualTagId = 'day.{}_{}'.format(virtualTagNameMap[funcName], day)
+            self.updateMarkBoxTracker(markType, amount, behalfLead)
+            markText = self.calcMarkInstructions(markType, amount)
+            if (unless is not None):
+                markText += ' (unless {})'.format(unless)
+            #postMessage = '\n---\n' + jrfuncs.uppercaseFirstLetter(markText)
+            postMessage = jrfuncs.uppercaseFirstLetter(markText)
+            if (codeResult['inlinePostText']!=''):
+                postMessage += ', then '
+            codeResult['inlinePostText'] = postMessage + codeResult['inlinePostText']
+        elif (demeritHours is not None):
+            simplePost = False
+            amount = int(args['demerits'])
+            markType = 'demerit'
             #
-            # look up tag, do NOT convert to letter
-            tagDict = self.findTag(virtualTagId, behalfLead, block, False, False)
-            if (tagDict is None):
-                # day tags do not have to exist ahead of time, we create them on the fly
-                tagArgs = {'id': virtualTagId, 'relation': funcName, 'day': day}
-                tagDict = self.doDefineTag('', tagArgs, behalfLead, None, block)
+            maxDemerits = 12 / amount
+            self.updateMarkBoxTracker(markType, maxDemerits, behalfLead)
+            markText = self.calcMarkHourInstructions(markType, amount)
+            if (unless is not None):
+                markText += ' (unless {})'.format(unless)
+            #postMessage = '\n---\n' + jrfuncs.uppercaseFirstLetter(markText)
+            postMessage = jrfuncs.uppercaseFirstLetter(markText)
+            if (codeResult['inlinePostText']!=''):
+                postMessage += ', then '
+            else:
+                postMessage += '.'
             #
-            # track use
-            if (behalfLead is not None):
-                tagDict['useCount'] += 1
-                msg = 'Checking if it is {} {}'.format(funcName, day)
-                self.appendUseNoteToTagDict(tagDict, msg, leadInfoText, leadInfoMText, block)
-
-            # remember tags for a future mindmap
-            context['lastTest'] = {'block': block, 'text': virtualTagId}
-
-            # build output
-            resultText = tagDict['testText']
-            resultText = self.modifyTextToSuitTextPositionStyle(resultText, textPositionStyle, '* ', True, False, False)
-
-            # mindmap
-            self.createMindMapLinkLeadChecksDay(behalfLead, tagDict['id'])
-
-
-
-
-
+            codeResult['inlinePostText'] = postMessage + codeResult['inlinePostText']
 
+        #
+        if (simplePost) and (codeResult['inlinePostText']!=''):
+            #codeResult['inlinePostText'] = self.getFullLineReturnToMd(False) + 'Now '+ codeResult['inlinePostText']
+            codeResult['inlinePostText'] = 'Now '+ codeResult['inlinePostText']
 
+        # put inlinePostText in box?
+        if (codeResult['inlinePostText']!='') and True:
+            codeResult['inlinePostText'] = r'%boxstartred% ' + codeResult['inlinePostText'] + r' %boxend%' + '\n'
+        return [resultText, reportText]
 
+    def evalCodeFuncEndJump(self, funcName, args, ev):
+        resultText = ''
+        reportText = None
+        # tricky one, this moves the subsqeuent text blocks into a new dynamically assigned lead and returns the lead #
+        return [resultText, reportText]
 
+    def evalCodeFuncInsertLead(self, funcName, args, ev):
+        block = ev['block']
+        behalfLead = ev['behalfLead']
+        evaluationOptions = ev['evaluationOptions']
+        resultText = ''
+        reportText = None
+        # embed contents of a lead here
+        leadId = args['leadId']
+        existingLead = self.findLeadById(leadId, False)
+        if (existingLead is None):
+            self.raiseBlockException(block, 0, 'Unknown lead reference: "{}"'.format(leadId))
+        # ATTN: this RE-EVALUATES the lead text, but it would probably be better to use pre-evaluated text; the only problem is if a lead is INSERTED before it is defined
+        # we COULD throw an error in this case (bad), or instead defer evaluation until later by doing this in two passes?
+        # the one thing that could get messed up by this is any debug statistics and reporting that may get confused by us calling this on behalf of another lead
+        # for example, our stats of recording when a tag is used will be confused into thinking the inserted lead used a tag twice instead of THIS lea
+        [resultText, reportText] = self.evaluateHeadBlockTextCode(existingLead, behalfLead, evaluationOptions)
+        return [resultText, reportText]
 
+    def evalCodeFuncGetVar(self, funcName, args, ev):
+        resultText = ''
+        reportText = None
+        # insert contents of a lead here
+        varName = args['varName']
+        [resultText, reportText] = self.getUserVariableTuple(varName)
+        return [resultText, reportText]
 
+    def evalCodeFuncSetVar(self, funcName, args, ev):
+        resultText = ''
+        reportText = None
+        # insert contents of a lead here
+        varName = args['varName']
+        varVal = args['value']
+        self.setUserVariable(varName, varVal)
+        return [resultText, reportText]
 
+    def evalCodeFuncMark(self, funcName, args, ev):
+        behalfLead = ev['behalfLead']
+        textPositionStyle = ev['textPositionStyle']
+        resultText = ''
+        reportText = None
+        if (funcName == 'demerits'):
+            markType = 'demerit'
+        else:
+            markType = args['type']
+        if (markType=='demerits'):
+            markType = 'demerit'
+        #if (markType=='demerit'):
+        #    jrprint('DEBUG STOP')
+
+        # insert contents of a lead here
+        amount = int(args['amount']) if ('amount' in args) else 1
+        self.updateMarkBoxTracker(markType, amount, behalfLead)
+        text = self.calcMarkInstructions(markType, amount)
+        text = self.modifyTextToSuitTextPositionStyle(text, textPositionStyle, '', True, True, True)
+        resultText = text
+        return [resultText, reportText]
 
+    def evalCodeFuncTime(self, funcName, args, ev):
+        behalfLead = ev['behalfLead']
+        textPositionStyle = ev['textPositionStyle']
+        resultText = ''
+        reportText = None
+        if (funcName == 'otime') or (self.getOptionClockMode()==True):
+            amount = float(args['amount']) if ('amount' in args) else 1
+            text = self.calcTimeAdvanceInstructions(amount, behalfLead, True)
+            text = self.modifyTextToSuitTextPositionStyle(text, textPositionStyle, '', True, True, True)
+        else:
+            text = ''
+        resultText = text
+        return [resultText, reportText]
 
-        # ATTN: new attempt to unify as 'inline'
-        #elif (funcName in ['inline', 'inlinedemerit', 'inlineback', 'inlinebacks', 'inlinehint']):
-        elif (funcName in ['inline', 'inlineback', 'inlinehint']):
-            # tricky one, this moves the subsqeuent text blocks into a new dynamically assigned lead and returns the lead #
-            # it is handled by caller not by use
-            #
-            codeResult['action'] = 'inline'
-            codeResult['args'] = jrfuncs.deepCopyListDict(args)
-            #
-            leadTagType = jrfuncs.getDictValueOrDefault(behalfLeadProperties, 'leadTagType','')
-            if (leadTagType=='hint'):
-                # inlines derived from hints to not take up time by default
-                codeResult['args']['defaultTime'] = False
-            #
-            # shortcut
-            if (funcName in ['inlineback', 'inlinehint']):
-                optionDefaultBack = True
+    def evalCodeFuncBackDemerit(self, funcName, args, ev):
+        block = ev['block']
+        behalfLead = ev['behalfLead']
+        textPositionStyle = ev['textPositionStyle']
+        resultText = ''
+        reportText = None
+        # insert contents of a lead here
+        amount = int(args['demerits']) if ('demerits' in args) else 1
+        gotoQuestion = args['goto'] if ('goto' in args) else ''
+        leadId = args['lead'] if ('lead' in args) else None
+        markType = 'demerit'
+        if (leadId is None):
+            goText = 'return to searching for leads'
+        else:
+            goLead = self.findLeadById(leadId, True)
+            if (goLead is None):
+                self.raiseBlockException(block, 0, 'Unknown lead reference: "{}"'.format(leadId))
+            linkText = self.makeTextLinkToLead(goLead, None, False, True)
+            goText = self.getText('goto') + ' ' + linkText
+        #
+        if (amount>0):
+            if (gotoQuestion==''):
+                text = self.calcMarkInstructions(markType, amount) + ' and {}; then resume the questionnaire after you finish.'.format(goText)
             else:
-                optionDefaultBack = False
-            #
-            back = jrfuncs.getDictValueFromTrueFalse(args, 'back', optionDefaultBack)
-            resume = jrfuncs.getDictValueFromTrueFalse(args, 'resume', False)
-            unless = jrfuncs.getDictValueOrDefault(args, 'unless', None)
-            optionDisableDemeritHours = True
-            demerits = jrfuncs.getDictValueOrDefault(args, 'demerits', None)
-            demeritHours = jrfuncs.getDictValueOrDefault(args, 'demeritHours', None)
-            if (demeritHours is not None) and (demerits is None) and optionDisableDemeritHours:
-                demerits = demeritHours
-                demeritHours = None
-            #
+                text = self.calcMarkInstructions(markType, amount) + ' and {}, then resume at question "{}" if you can accomplish this; if you need more help continue reading.'.format(goText, gotoQuestion)                
+        else:
+            text = goText
+        #
+        text = self.modifyTextToSuitTextPositionStyle(text, textPositionStyle, '* If not, ', False, False, False)
+        self.updateMarkBoxTracker(markType, amount, behalfLead)
+        resultText = text
+        return [resultText, reportText]
 
-            returnLink = self.makeTextLinkToLead(behalfLead, None, False, True)
-            returnText = ''
-            codeResult['args']['after'] = ''
-            codeResult['inlinePostText'] = ''
-            simplePost = True
+    def evalCodeFuncForm(self, funcName, args, ev):
+        block = ev['block']
+        resultText = ''
+        reportText = None
+        # insert contents of a lead here
+        typeStr = args['type']
+        shortInputText = '>`____________________________`'
+        if (typeStr=='short'):
+            text = shortInputText
+        elif (typeStr in ['mini', 'score']):
+            text = '_____'
+        elif (typeStr=='long'):
+            text = '>`__________________________________________________`\n'
+        elif (typeStr=='multiline'):
+            oneLine = '>`__________________________________________________`\n'
+            #text = ('    ' + oneLine ) * 6
+            text = oneLine * 6
+        elif (typeStr=='choice'):
+            choices = args['choices'].split(';')
+            text = ''
+            for i,choiceVal in enumerate(choices):
+                choiceVal = choiceVal.strip()
+                text += ' {}. {}\n'.format(i,choiceVal)
+        else:
+            self.raiseBlockException(block, 0, 'Unknown form type: "{}"'.format(typeStr))
+        resultText = text
+        return [resultText, reportText]
 
-            if (resume):
-                returnText = 'resume searching for leads'
-                codeResult['args']['after'] = 'then resume searching for leads'
-                codeResult['inlinePostText'] = 'resume searching for leads'
-            #
-            if (back):
-                linkText = returnLink
-                if (returnText != ''):
-                    returnText += ', then '
-                if (codeResult['args']['after'] != ''):
-                    codeResult['args']['after'] += ', '
-                returnText += self.getText('returnto') + ' ' + linkText + '.'
-                codeResult['args']['after'] += 'then return here afterwards.'
-                codeResult['inlinePostText'] += returnText
-
-
-            if (demerits is not None):
-                simplePost = False
-                amount = int(args['demerits'])
-                markType = 'demerit'
-                #
-                self.updateMarkBoxTracker(markType, amount, behalfLead)
-                markText = self.calcMarkInstructions(markType, amount)
-                if (unless is not None):
-                    markText += ' (unless {})'.format(unless)
-                #postMessage = '\n---\n' + jrfuncs.uppercaseFirstLetter(markText)
-                postMessage = jrfuncs.uppercaseFirstLetter(markText)
-                if (codeResult['inlinePostText']!=''):
-                    postMessage += ', then '
-                codeResult['inlinePostText'] = postMessage + codeResult['inlinePostText']
-            elif (demeritHours is not None):
-                simplePost = False
-                amount = int(args['demerits'])
-                markType = 'demerit'
-                #
-                maxDemerits = 12 / amount
-                self.updateMarkBoxTracker(markType, maxDemerits, behalfLead)
-                markText = self.calcMarkHourInstructions(markType, amount)
-                if (unless is not None):
-                    markText += ' (unless {})'.format(unless)
-                #postMessage = '\n---\n' + jrfuncs.uppercaseFirstLetter(markText)
-                postMessage = jrfuncs.uppercaseFirstLetter(markText)
-                if (codeResult['inlinePostText']!=''):
-                    postMessage += ', then '
-                else:
-                    postMessage += '.'
-                #
-                codeResult['inlinePostText'] = postMessage + codeResult['inlinePostText']
+    def evalCodeFuncReport(self, funcName, args, ev):
+        resultText = ''
+        reportText = None
+        # just a comment to show in the report only
+        reportText = '**REPORT NOTE**: {}'.format(args['comment'])
+        return [resultText, reportText]
 
-            #
-            if (simplePost) and (codeResult['inlinePostText']!=''):
-                #codeResult['inlinePostText'] = self.getFullLineReturnToMd(False) + 'Now '+ codeResult['inlinePostText']
-                codeResult['inlinePostText'] = 'Now '+ codeResult['inlinePostText']
+    def evalCodeFuncOtherwise(self, funcName, args, ev):
+        block = ev['block']
+        textPositionStyle = ev['textPositionStyle']
+        context = ev['context']
+        resultText = ''
+        reportText = None
+        text = 'Otherwise'
 
-            # put inlinePostText in box?
-            if (codeResult['inlinePostText']!='') and True:
-                codeResult['inlinePostText'] = r'%boxstartred% ' + codeResult['inlinePostText'] + r' %boxend%' + '\n'
+        # remember tags for a future mindmap
+        context['lastTest'] = {'block': block, 'text': 'otherwise'}
 
+        text = self.modifyTextToSuitTextPositionStyle(text, textPositionStyle, '* ', True, False, False)
+        resultText = text
+        return [resultText, reportText]
 
+    # logic funcs
+    def evalCodeFuncLogicLinkTo(self, funcName, args, ev):
+        behalfLead = ev['behalfLead']
+        resultText = ''
+        reportText = None
+        target = args['target']
+        # mindmap
+        mindMapLinkLabel = jrfuncs.getDictValueOrDefault(args,'link',None)
+        linkType = funcName
+        linkType = linkType.replace('logic','')
+        self.createMindMapLinkLeadToNodeGeneric(behalfLead, target, linkType, mindMapLinkLabel)
+        resultText = ''
+        return [resultText, reportText]
 
-        elif (funcName=='endjump'):
-            # tricky one, this moves the subsqeuent text blocks into a new dynamically assigned lead and returns the lead #
-            pass
+    def evalCodeFuncLogicLinkFrom(self, funcName, args, ev):
+        behalfLead = ev['behalfLead']
+        resultText = ''
+        reportText = None
+        target = args['target']
+        # mindmap
+        mindMapLinkLabel = jrfuncs.getDictValueOrDefault(args,'link',None)
+        linkType = funcName
+        if (linkType=='logicimpliedby'):
+            linkType = 'implies'
+        else:
+            linkType = linkType.replace('logic','')
+            linkType = linkType.replace('edby','s')
+        self.createMindMapLinkLeadFromNodeGeneric(behalfLead, target, linkType, mindMapLinkLabel)
+        resultText = ''
+        return [resultText, reportText]
 
-        elif (funcName=='insertlead'):
-            # embed contents of a lead here
-            leadId = args['leadId']
-            existingLead = self.findLeadById(leadId, False)
-            if (existingLead is None):
-                self.raiseBlockException(block, 0, 'Unknown lead reference: "{}"'.format(leadId))
-            # ATTN: this RE-EVALUATES the lead text, but it would probably be better to use pre-evaluated text; the only problem is if a lead is INSERTED before it is defined
-            # we COULD throw an error in this case (bad), or instead defer evaluation until later by doing this in two passes?
-            # the one thing that could get messed up by this is any debug statistics and reporting that may get confused by us calling this on behalf of another lead
-            # for example, our stats of recording when a tag is used will be confused into thinking the inserted lead used a tag twice instead of THIS lea
-            [resultText, reportText] = self.evaluateHeadBlockTextCode(existingLead, behalfLead, evaluationOptions)
-
-        elif (funcName=='get'):
-            # insert contents of a lead here
-            varName = args['varName']
-            [resultText, reportText] = self.getUserVariableTuple(varName)
-
-        elif (funcName=='set'):
-            # insert contents of a lead here
-            varName = args['varName']
-            varVal = args['value']
-            self.setUserVariable(varName, varVal)
-
-        elif (funcName in ['mark']):
-            if (funcName == 'demerits'):
-                markType = 'demerit'
-            else:
-                markType = args['type']
-            if (markType=='demerits'):
-                markType = 'demerit'
-            #if (markType=='demerit'):
-            #    jrprint('DEBUG STOP')
+    def evalCodeFuncLogicIdea(self, funcName, args, ev):
+        behalfLead = ev['behalfLead']
+        resultText = ''
+        reportText = None
+        name = args['name']
+        # mindmap
+        mindMapNodeLabel = jrfuncs.getDictValueOrDefault(args,'link',None)
+        self.createMindMapNode(name, 'idea', mindMapNodeLabel, True, behalfLead)
+        resultText = ''
+        return [resultText, reportText]
 
-            # insert contents of a lead here
-            amount = int(args['amount']) if ('amount' in args) else 1
-            self.updateMarkBoxTracker(markType, amount, behalfLead)
-            text = self.calcMarkInstructions(markType, amount)
-            text = self.modifyTextToSuitTextPositionStyle(text, textPositionStyle, '', True, True, True)
-            resultText = text
+    def evalCodeFuncLogicAb(self, funcName, args, ev):
+        behalfLead = ev['behalfLead']
+        behalfLeadId = ev['behalfLeadId']
+        resultText = ''
+        reportText = None
+        a = args['a']
+        b = jrfuncs.getDictValueOrDefault(args,'b',None)
+        if (b is None):
+            b = behalfLeadId
+        # mindmap
+        mindMapLinkLabel = jrfuncs.getDictValueOrDefault(args,'link',None)
+        if (funcName=='logicaba'):
+            self.createMindMapLinkFromBidirectionNodesNodeGeneric(a, b, mindMapLinkLabel, behalfLead)
+        else:
+            self.createMindMapLinkFromNodeToNodeNodeGeneric(a, b, mindMapLinkLabel, behalfLead)
+        resultText = ''
+        return [resultText, reportText]
 
+    def evalCodeFuncLogicIrrelevant(self, funcName, args, ev):
+        behalfLead = ev['behalfLead']
+        resultText = ''
+        reportText = None
+        # mindmap
+        self.annotateMindMapLeadNode(behalfLead, {'relevance': -1})
+        resultText = ''
+        return [resultText, reportText]
 
-        elif (funcName in ['time','otime']):
-            if (funcName == 'otime') or (self.getOptionClockMode()==True):
-                amount = float(args['amount']) if ('amount' in args) else 1
-                text = self.calcTimeAdvanceInstructions(amount, behalfLead, True)
-                text = self.modifyTextToSuitTextPositionStyle(text, textPositionStyle, '', True, True, True)
-            else:
-                text = ''
-            resultText = text
+    def evalCodeFuncOnlyOnce(self, funcName, args, ev):
+        resultText = ''
+        reportText = None
+        resultText = '**NOTE:** You may only visit this lead once; you may not return here to take a different path.'
+        return [resultText, reportText]
 
+    def evalCodeFuncWarning(self, funcName, args, ev):
+        block = ev['block']
+        behalfLead = ev['behalfLead']
+        resultText = ''
+        reportText = None
+        msg = args['msg']
+        plainText = msg + '; in lead {} from {} around line {}.'.format(behalfLead['id'], block['sourceLabel'], block['lineNumber'])
+        self.addWarning(plainText)
+        return [resultText, reportText]
 
-        elif (funcName=='backdemerit'):
-            # insert contents of a lead here
-            amount = int(args['demerits']) if ('demerits' in args) else 1
-            gotoQuestion = args['goto'] if ('goto' in args) else ''
-            leadId = args['lead'] if ('lead' in args) else None
-            markType = 'demerit'
-            if (leadId is None):
-                goText = 'return to searching for leads'
-            else:
-                goLead = self.findLeadById(leadId, True)
-                if (goLead is None):
-                    self.raiseBlockException(block, 0, 'Unknown lead reference: "{}"'.format(leadId))
-                linkText = self.makeTextLinkToLead(goLead, None, False, True)
-                goText = self.getText('goto') + ' ' + linkText
-            #
-            if (amount>0):
-                if (gotoQuestion==''):
-                    text = self.calcMarkInstructions(markType, amount) + ' and {}; then resume the questionnaire after you finish.'.format(goText)
-                else:
-                    text = self.calcMarkInstructions(markType, amount) + ' and {}, then resume at question "{}" if you can accomplish this; if you need more help continue reading.'.format(goText, gotoQuestion)                
+    def evalCodeFuncRemind(self, funcName, args, ev):
+        block = ev['block']
+        behalfLead = ev['behalfLead']
+        context = ev['context']
+        resultText = ''
+        reportText = None
+        reminderType = args['type']
+        if (reminderType=='turnpage'):
+            msg = "SYNTAX ERROR IN STORYBOOK; WARNING: remind(turnpage) is no longer supported because of different layout formats; ignored."
+            self.addWarning(msg)
+            text = ""
+        elif (reminderType=='turnPageSolo'):
+            if False and (self.isLeadContextSectionStyleSolo(behalfLead, context)):
+                text = '*Turn the page...*\n'
+                text += '%pagebreak%\n'
             else:
-                text = goText
-            #
-            text = self.modifyTextToSuitTextPositionStyle(text, textPositionStyle, '* If not, ', False, False, False)
-            self.updateMarkBoxTracker(markType, amount, behalfLead)
-            resultText = text
-
-
-
-
-        elif (funcName=='form'):
-            # insert contents of a lead here
-            typeStr = args['type']
-            shortInputText = '>`____________________________`'
-            if (typeStr=='short'):
-                text = shortInputText
-            elif (typeStr in ['mini', 'score']):
-                text = '_____'
-            elif (typeStr=='long'):
-                text = '>`__________________________________________________`\n'
-            elif (typeStr=='multiline'):
-                oneLine = '>`__________________________________________________`\n'
-                #text = ('    ' + oneLine ) * 6
-                text = oneLine * 6
-            elif (typeStr=='choice'):
-                choices = args['choices'].split(';')
                 text = ''
-                for i,choiceVal in enumerate(choices):
-                    choiceVal = choiceVal.strip()
-                    text += ' {}. {}\n'.format(i,choiceVal)
-            else:
-                self.raiseBlockException(block, 0, 'Unknown form type: "{}"'.format(typeStr))
-            resultText = text
-
-        elif (funcName=='report'):
-            # just a comment to show in the report only
-            reportText = '**REPORT NOTE**: {}'.format(args['comment'])
-
-        elif (funcName=='otherwise'):
-            text = 'Otherwise'
-
-            # remember tags for a future mindmap
-            context['lastTest'] = {'block': block, 'text': 'otherwise'}
-
-            text = self.modifyTextToSuitTextPositionStyle(text, textPositionStyle, '* ', True, False, False)
-            resultText = text
-
-
-        # logic funcs
-
-        elif (funcName in ['logicmentions', 'logicimplies', 'logicsuggests']):
-            target = args['target']
-            # mindmap
-            mindMapLinkLabel = jrfuncs.getDictValueOrDefault(args,'link',None)
-            linkType = funcName
-            linkType = linkType.replace('logic','')
-            self.createMindMapLinkLeadToNodeGeneric(behalfLead, target, linkType, mindMapLinkLabel)
-            resultText = ''
-
-        elif (funcName in ['logicmentionedby', 'logicimpliedby', 'logicsuggestedby']):
-            target = args['target']
-            # mindmap
-            mindMapLinkLabel = jrfuncs.getDictValueOrDefault(args,'link',None)
-            linkType = funcName
-            if (linkType=='logicimpliedby'):
-                linkType = 'implies'
+        elif (reminderType=='restBreak'):
+            text = self.getText('restbreak') + '\n'
+            text += '%pagebreak%\n'
+        elif (reminderType in ['allyHelp', 'allyHelp3pm']):
+            text = "\n%Symbol.Hand%Note: There are specific hints available for each of the the day's required items (see index).  However, if you need guidance on where to focus your efforts on any given day, you can drop by your old police precinct in the Financial District for some advice"
+            if (reminderType == 'allyHelp3pm'):
+                text += ' (if you arrive between 3pm-4pm you can catch the chief on his break and get his advice for free).\n'
             else:
-                linkType = linkType.replace('logic','')
-                linkType = linkType.replace('edby','s')
-            self.createMindMapLinkLeadFromNodeGeneric(behalfLead, target, linkType, mindMapLinkLabel)
-            resultText = ''
+                text += '.\n'
 
-        elif (funcName == 'logicidea'):
-            name = args['name']
-            # mindmap
-            mindMapNodeLabel = jrfuncs.getDictValueOrDefault(args,'link',None)
-            self.createMindMapNode(name, 'idea', mindMapNodeLabel, True, behalfLead)
-            resultText = ''
-
-        elif (funcName in ['logicab', 'logicaba']):
-            a = args['a']
-            b = jrfuncs.getDictValueOrDefault(args,'b',None)
-            if (b is None):
-                b = behalfLeadId
-            # mindmap
-            mindMapLinkLabel = jrfuncs.getDictValueOrDefault(args,'link',None)
-            if (funcName=='logicaba'):
-                self.createMindMapLinkFromBidirectionNodesNodeGeneric(a, b, mindMapLinkLabel, behalfLead)
+        elif (reminderType=='overtimeScore'):
+            isClockModeEnabled = self.getOptionClockMode()
+            if (isClockModeEnabled):
+                text = 'Subtract **3** points for every day you went into overtime'
             else:
-                self.createMindMapLinkFromNodeToNodeNodeGeneric(a, b, mindMapLinkLabel, behalfLead)
-            resultText = ''
-
-        elif (funcName == 'logicirrelevant'):
-            # mindmap
-            self.annotateMindMapLeadNode(behalfLead, {'relevance': -1})
-            resultText = ''
-
-        elif (funcName == 'onlyonce'):
-            resultText = '**NOTE:** You may only visit this lead once; you may not return here to take a different path.'
-
-        elif (funcName == 'warning'):
-            msg = args['msg']
-            plainText = msg + '; in lead {} from {} around line {}.'.format(behalfLead['id'], block['sourceLabel'], block['lineNumber'])
-            self.addWarning(plainText)
-
-        elif (funcName == 'remind'):
-            reminderType = args['type']
-            if (reminderType=='turnpage'):
-                msg = "SYNTAX ERROR IN STORYBOOK; WARNING: remind(turnpage) is no longer supported because of different layout formats; ignored."
-                self.addWarning(msg)
-                text = ""
-            elif (reminderType=='turnPageSolo'):
-                if False and (self.isLeadContextSectionStyleSolo(behalfLead, context)):
-                    text = '*Turn the page...*\n'
-                    text += '%pagebreak%\n'
-                else:
-                    text = ''
-            elif (reminderType=='restBreak'):
-                text = self.getText('restbreak') + '\n'
-                text += '%pagebreak%\n'
-            elif (reminderType in ['allyHelp', 'allyHelp3pm']):
-                text = "\n%Symbol.Hand%Note: There are specific hints available for each of the the day's required items (see index).  However, if you need guidance on where to focus your efforts on any given day, you can drop by your old police precinct in the Financial District for some advice"
-                if (reminderType == 'allyHelp3pm'):
-                    text += ' (if you arrive between 3pm-4pm you can catch the chief on his break and get his advice for free).\n'
-                else:
-                    text += '.\n'
+                text = 'Subtract **1** point for every 10 overtime you accumulated (rounded down)'
+        else:
+            self.raiseBlockException(block, 0, 'Unknown reminder type in $remind({})'.format(reminderType))
+        resultText = text
+        return [resultText, reportText]
 
-            elif (reminderType=='overtimeScore'):
-                isClockModeEnabled = self.getOptionClockMode()
-                if (isClockModeEnabled):
-                    text = 'Subtract **3** points for every day you went into overtime'
-                else:
-                    text = 'Subtract **1** point for every 10 overtime you accumulated (rounded down)'
-            else:
-                self.raiseBlockException(block, 0, 'Unknown reminder type in $remind({})'.format(reminderType))
-            resultText = text
-
-        elif (funcName == 'autohint'):
-            # this assume we are in a hint lead, and we want to 
-            # autohint is used within a hint, to auto link as a last resort to the lead(s) where the hint is assigned
-            hintLeadList = self.buildHintLeadListForTag(behalfLead, block)          
-            if (len(hintLeadList)==0):
-                resultText = 'There are no more hints available for this item.\n'
+    def evalCodeFuncAutoHint(self, funcName, args, ev):
+        block = ev['block']
+        behalfLead = ev['behalfLead']
+        context = ev['context']
+        resultText = ''
+        reportText = None
+        # this assume we are in a hint lead, and we want to 
+        # autohint is used within a hint, to auto link as a last resort to the lead(s) where the hint is assigned
+        hintLeadList = self.buildHintLeadListForTag(behalfLead, block)          
+        if (len(hintLeadList)==0):
+            resultText = 'There are no more hints available for this item.\n'
+        else:
+            amount = int(args['amount']) if ('amount' in args) else 3
+            markType = 'demerit'
+            self.updateMarkBoxTracker(markType, amount, behalfLead)
+            markText = self.calcMarkInstructions(markType, amount)
+            #
+            if (len(hintLeadList)==1):
+                resultText = '%solo.VerticalSpace%\n---\nAs a last resort, if you cannot figure out how to find it, ' + markText + ', then visit ' + hintLeadList[0] + '\n'
             else:
-                amount = int(args['amount']) if ('amount' in args) else 3
-                markType = 'demerit'
-                self.updateMarkBoxTracker(markType, amount, behalfLead)
-                markText = self.calcMarkInstructions(markType, amount)
-                #
-                if (len(hintLeadList)==1):
-                    resultText = '%solo.VerticalSpace%\n---\nAs a last resort, if you cannot figure out how to find it, ' + markText + ', then visit ' + hintLeadList[0] + '\n'
-                else:
-                    resultText = '%solo.VerticalSpace%\n---\nAs a last resort, if you cannot figure out how to find it, ' + markText + ', then visit one more more of the following:\n'
-                    for line in hintLeadList:
-                        resultText += ' * ' + line + '\n'
-                # for link
-                context['lastTest'] = {'block': block, 'text': 'autohint'}
-
-        elif (funcName == 'deadlineinfo'):
-            # this assume we are in a hint lead, and we want to 
-            [resultText, reportText] = self.doDeadlineInfo(args)
-
-
-        elif (funcName == 'ifcond'):
-            conditionVal = True
-            condition = args['condition']
-            if (condition=='clocked'):
-                conditionVal = self.getOptionClockMode()
-            codeResult['action'] = 'conditioned'
-            codeResult['args'] = {'conditionVal': conditionVal}
-
-        elif (funcName == 'include'):
-            filePath = args['file']
-            resultText = self.includeUserFile(filePath)
-
-
-        elif (funcName in ['begin', 'end']):
-            # these do nothing and are only used for inlining
-            resultText = ''
+                resultText = '%solo.VerticalSpace%\n---\nAs a last resort, if you cannot figure out how to find it, ' + markText + ', then visit one more more of the following:\n'
+                for line in hintLeadList:
+                    resultText += ' * ' + line + '\n'
+            # for link
+            context['lastTest'] = {'block': block, 'text': 'autohint'}
+        return [resultText, reportText]
 
+    def evalCodeFuncDeadlineInfo(self, funcName, args, ev):
+        resultText = ''
+        reportText = None
+        # this assume we are in a hint lead, and we want to 
+        [resultText, reportText] = self.doDeadlineInfo(args)
+        return [resultText, reportText]
 
-        else:
-            # debug
-            dbgObj = {'funcName': funcName, 'args': args, 'pos': pos}
-            text = json.dumps(dbgObj)
-            resultText = text
-            msg = 'Syntax error; code function not understood: {}'.format(text)
-            if (True):
-                self.raiseBlockException(block, 0, msg)
-            else:
-                self.addWarning('WARNING: ' + msg)
+    def evalCodeFuncIfCond(self, funcName, args, ev):
+        codeResult = ev['codeResult']
+        resultText = ''
+        reportText = None
+        conditionVal = True
+        condition = args['condition']
+        if (condition=='clocked'):
+            conditionVal = self.getOptionClockMode()
+        codeResult['action'] = 'conditioned'
+        codeResult['args'] = {'conditionVal': conditionVal}
+        return [resultText, reportText]
 
-        # store results
-        codeResult['text'] = resultText
-        if (reportText is None):
-            reportText = resultText
-        codeResult['reportText'] = reportText
+    def evalCodeFuncInclude(self, funcName, args, ev):
+        resultText = ''
+        reportText = None
+        filePath = args['file']
+        resultText = self.includeUserFile(filePath)
+        return [resultText, reportText]
 
-        return codeResult
+    def evalCodeFuncBeginEnd(self, funcName, args, ev):
+        resultText = ''
+        reportText = None
+        # these do nothing and are only used for inlining
+        resultText = ''
+        return [resultText, reportText]
 # ---------------------------------------------------------------------------
 
 
@@ -4091,6 +5001,7 @@ class HlParser:
 
 
 
+    @timedSpan('saveMindMapStuff')
     def saveMindMapStuff(self, flagCleanTemp):
         #outFilePath = self.calcOutFileDerivedName('MindMap.dot')
         #self.mindMap.renderToDotFile(outFilePath)
@@ -4503,6 +5414,7 @@ class HlParser:
             self.renderLeads({'suffix':'Summary', 'mode': 'normal', 'leadList': ['summary|cover']}, flagCleanAfter)
 
 
+    @timedSpan('renderLeads')
     def renderLeads(self, leadOutputOptions, flagCleanAfter):
         errorCounterPreRun = self.getBuildErrorCount()
 
@@ -4532,7 +5444,8 @@ class HlParser:
         saveDir = self.getOptionVal('chapterSaveDir', defaultSaveDir)
         saveDir = self.resolveTemplateVars(saveDir)
         jrfuncs.createDirIfMissing(saveDir)
-        outFilePath = '{}/{}.{}'.format(saveDir, baseOutputFileName, renderFormat)
+        buildDir = saveDir
+        outFilePath = '{}/{}.{}'.format(buildDir, baseOutputFileName, renderFormat)
 
         # announce
         jrprint('Rendering leads in {} format to: {}'.format(renderFormat, outFilePath))
@@ -4541,29 +5454,27 @@ class HlParser:
         self.sortLeadsIntoSections()
 
 
+        # a background compile still working on this same file must finish before we overwrite it
+        if (any([renderedDocument['outFilePath']==outFilePath for renderedDocument in self.pendingLatexCompiles])):
+            self.waitPendingLatexCompiles()
+
+        # delete files first
+        self.deleteExtensionFilesIfExists(saveDir,baseOutputFileName, ['aux', 'latex', 'pdf', 'html', 'log', 'out', 'toc'])
+        self.deleteSaveDirFileIfExists(saveDir, 'texput.log')
+
         # build main text
         # recursively render sections and write leads, starting from root
+        # the rendered fragments are streamed to a temporary body file, since the document head depends on what rendering the body collects in context
         context = {}
         layoutOptions = self.parseLayoutOptionsForSection(None, None, leadOutputOptions)
-
-        
-        if (leadList is None):
-            # render all sections starting at root
-            text = self.renderSection(None, self.rootSection, layoutOptions, renderFormat, [], leadOutputOptions, context)
-        else:
-            # just render specifics (like cover)
-            text = ''
-            for leadIdStr in leadList:
-                leadIdsOr = leadIdStr.split('|')
-                for leadId in leadIdsOr:
-                    leadId = leadId.strip()
-                    lead = self.findLeadById(leadId, True)
-                    if (lead is None):
-                        continue
-                    section = {'cleanPage': True, 'noPageBreak': True}
-                    leadText = self.renderLead(lead, renderFormat, context, layoutOptions, leadOutputOptions, section)
-                    text += leadText
-                    break
+        bodyFilePath = '{}/{}.body.tmp'.format(buildDir, baseOutputFileName)
+        markdownSecsStart = self.hlMarkdown.renderSecs
+        with self.timingSpan('render'):
+            with open(bodyFilePath, 'w', encoding='utf-8', errors='surrogatepass', newline='', buffering=renderFileBufferSize) as bodyFile:
+                for fragment in self.renderLeadsFragments(leadList, layoutOptions, renderFormat, leadOutputOptions, context):
+                    bodyFile.write(fragment)
+            # the part of that spent in mistletoe (including render cache lookups)
+            self.timings.addSpan('markdown', self.hlMarkdown.renderSecs - markdownSecsStart)
 
         # optional top stuff
         addText = ''
@@ -4581,16 +5492,16 @@ class HlParser:
         addText += self.includeTextFromChapterHelperFile(saveDir, chapterName, 'top', renderFormat)
 
         # add top stuff to text
-        text = addText + text
+        topText = addText
 
 
         # latex main and top get wrapped by mistletoe packages
         renderOptions = self.getComputedRenderOptions()
         if (renderFormat=='latex'):
             preambleLatex = self.generateMetaInfo(renderFormat)
-            text = self.hlMarkdown.wrapMistletoeLatexDoc(text, context, preambleLatex, renderOptions)
+            topText = self.hlMarkdown.wrapMistletoeLatexDoc(topText, context, preambleLatex, renderOptions)
         else:
-            text = self.generateMetaInfo(renderFormat) + text
+            topText = self.generateMetaInfo(renderFormat) + topText
 
 
         # bottom stuff
@@ -4610,52 +5521,84 @@ class HlParser:
             addText += '\n\\end{document}\n'
 
         # add it to bottom
-        text += addText
-
-        # final replacements
-        text = self.textReplacementsLate(text, renderFormat)
-
-        # delete files first
-        deleteFileExtensions = []
-        if (renderFormat=='latex'):
-            deleteFileExtensions = ['aux', 'latex', 'pdf', 'log', 'out', 'toc']
-        elif (renderFormat=='html'):
-            deleteFileExtensions = ['html', 'pdf']
-        self.deleteExtensionFilesIfExists(saveDir,baseOutputFileName, ['aux', 'latex', 'pdf', 'html', 'log', 'out', 'toc'])
-        self.deleteSaveDirFileIfExists(saveDir, 'texput.log')
+        bottomText = addText
 
-        # write out text to file for input to latex
+        # write out top + body + bottom to file for input to latex, with final replacements
         encoding = self.getOptionValThrowException('storyFileEncoding')
-        jrfuncs.saveTxtToFile(outFilePath, text, encoding)
+        with self.timingSpan('write'):
+            self.saveRenderedDocument(outFilePath, topText, bodyFilePath, bottomText, renderFormat, encoding)
+            jrfuncs.deleteFilePathIfExists(bodyFilePath)
 
         # compile latex?
-        if (renderFormat=='latex'):
-            if (optionCompileLatex):
-                self.generatePdflatex(outFilePath, True)
-
-        # cleanup delete files afterwards? but we would like to not do this if there were errors
-        errorCounterPostRun = self.getBuildErrorCount()
-        erroredRendering = (errorCounterPostRun > errorCounterPreRun)
-        if (not erroredRendering):
-            if (flagCleanAfter != "none"):
-                deleteFileExtensions = []
-                if (renderFormat=='latex'):
-                    deleteFileExtensions = ['aux', 'log', 'out', 'toc']
-                    if (flagCleanAfter=="extra"):
-                        deleteFileExtensions.append('latex')
-                elif (renderFormat=='html'):
-                    deleteFileExtensions = []
-                self.deleteExtensionFilesIfExists(saveDir,baseOutputFileName, deleteFileExtensions)
-                self.deleteSaveDirFileIfExists(saveDir, 'texput.log')
-            #
-            outFilePathPdf = outFilePath
-            outFilePathPdf = outFilePathPdf.replace('.latex', '.pdf') 
-            self.addGeneratedFile(outFilePathPdf)
+        optionSeedAux = jrfuncs.getDictValueOrDefault(renderOptions, 'latexSeedAux', True)
+        renderedDocument = {'saveDir': saveDir, 'buildDir': buildDir, 'baseOutputFileName': baseOutputFileName, 'renderFormat': renderFormat, 'outFilePath': outFilePath, 'flagCleanAfter': flagCleanAfter, 'flagSaveAuxSeed': False}
+        if (renderFormat=='latex') and (optionCompileLatex):
+            if (optionSeedAux) and (self.seedLatexAuxFiles(saveDir, buildDir, baseOutputFileName)):
+                jrprint('Seeded latex aux files for "{}" from previous build.'.format(baseOutputFileName))
+            formatFilePath = None
+            if ('latexStaticPreamble' in context):
+                formatFilePath = self.prepareLatexFormat(context['latexStaticPreamble'])
+            renderedDocument['flagSaveAuxSeed'] = optionSeedAux
+            renderedDocument['renderErrored'] = (self.getBuildErrorCount() > errorCounterPreRun)
+            if (self.flagDeferLatexCompiles):
+                # compile in the background while the next build renders; finished by waitPendingLatexCompiles
+                renderedDocument['job'] = self.generatePdflatexAsync(outFilePath, True, formatFilePath)
+                self.pendingLatexCompiles.append(renderedDocument)
+            else:
+                result = self.generatePdflatex(outFilePath, True, formatFilePath)
+                self.finishRenderedDocument(renderedDocument, renderedDocument['renderErrored'] or result['errored'])
+        else:
+            self.finishRenderedDocument(renderedDocument, (self.getBuildErrorCount() > errorCounterPreRun))
 
         # keep track that we rendered for mindmap stuff
         self.didRender = True
 
 
+    def finishRenderedDocument(self, renderedDocument, errored):
+        # after a document is rendered (and compiled): keep its aux files as seed for the next build, cleanup and add the pdf to the generated files
+        # but we would like to not do this if there were errors
+        buildDir = renderedDocument['buildDir']
+        baseOutputFileName = renderedDocument['baseOutputFileName']
+        renderFormat = renderedDocument['renderFormat']
+        flagCleanAfter = renderedDocument['flagCleanAfter']
+        if (errored):
+            return
+        if (renderedDocument['flagSaveAuxSeed']):
+            self.saveLatexAuxSeed(renderedDocument['saveDir'], buildDir, baseOutputFileName)
+        if (flagCleanAfter != "none"):
+            deleteFileExtensions = []
+            if (renderFormat=='latex'):
+                deleteFileExtensions = ['aux', 'log', 'out', 'toc']
+                if (flagCleanAfter=="extra"):
+                    deleteFileExtensions.append('latex')
+            elif (renderFormat=='html'):
+                deleteFileExtensions = []
+            self.deleteExtensionFilesIfExists(buildDir,baseOutputFileName, deleteFileExtensions)
+            self.deleteSaveDirFileIfExists(buildDir, 'texput.log')
+        #
+        outFilePathPdf = renderedDocument['outFilePath']
+        outFilePathPdf = outFilePathPdf.replace('.latex', '.pdf') 
+        self.addGeneratedFile(outFilePathPdf)
+
+
+    def waitPendingLatexCompiles(self, flagCancel=False):
+        # finish the background compiles started by renderLeads, in the order they were started (so generated files keep build list order)
+        # returns False if any of the documents failed; with flagCancel the compiles still running are stopped first
+        allSucceeded = True
+        pendingLatexCompiles = self.pendingLatexCompiles
+        self.pendingLatexCompiles = []
+        if (flagCancel):
+            for renderedDocument in pendingLatexCompiles:
+                renderedDocument['job'].cancel()
+        for renderedDocument in pendingLatexCompiles:
+            result = renderedDocument['job'].wait()
+            errored = (renderedDocument['renderErrored'] or result['errored'])
+            self.finishRenderedDocument(renderedDocument, errored)
+            if (errored):
+                allSucceeded = False
+        return allSucceeded
+
+
     def deleteExtensionFilesIfExists(self, baseDir, baseFileName, extensionList):
         for extension in extensionList:
             filePath = '{}/{}.{}'.format(baseDir, baseFileName, extension)
@@ -4666,8 +5609,51 @@ class HlParser:
             jrfuncs.deleteFilePathIfExists(filePath)
 
 
-    def renderSection(self, parentSection, section, parentLayoutOptions, renderFormat, skipSectionList, leadOutputOptions, context):
-        text = ''
+    def renderLeadsFragments(self, leadList, layoutOptions, renderFormat, leadOutputOptions, context):
+        # generator of rendered body text fragments (at most one lead each)
+        if (leadList is None):
+            # render all sections starting at root
+            yield from self.renderSectionFragments(None, self.rootSection, layoutOptions, renderFormat, [], leadOutputOptions, context)
+        else:
+            # just render specifics (like cover)
+            for leadIdStr in leadList:
+                leadIdsOr = leadIdStr.split('|')
+                for leadId in leadIdsOr:
+                    leadId = leadId.strip()
+                    lead = self.findLeadById(leadId, True)
+                    if (lead is None):
+                        continue
+                    section = {'cleanPage': True, 'noPageBreak': True}
+                    yield self.renderLead(lead, renderFormat, context, layoutOptions, leadOutputOptions, section)
+                    break
+
+
+    def saveRenderedDocument(self, outFilePath, topText, bodyFilePath, bottomText, renderFormat, encoding):
+        # write top text, the streamed body and bottom text to the output file, applying textReplacementsLate as we go
+        # like jrfuncs.saveTxtToFile, fall back on the default encoding if the text cannot be written with the one asked for
+        try:
+            self.saveRenderedDocumentWithEncoding(outFilePath, topText, bodyFilePath, bottomText, renderFormat, encoding)
+        except UnicodeEncodeError as e:
+            if (encoding is None):
+                raise
+            self.saveRenderedDocumentWithEncoding(outFilePath, topText, bodyFilePath, bottomText, renderFormat, None)
+
+    def saveRenderedDocumentWithEncoding(self, outFilePath, topText, bodyFilePath, bottomText, renderFormat, encoding):
+        with open(outFilePath, 'w', encoding=encoding, buffering=renderFileBufferSize) as outFile:
+            writer = TransformingTextWriter(outFile, lambda text: self.textReplacementsLate(text, renderFormat))
+            writer.write(topText)
+            with open(bodyFilePath, 'r', encoding='utf-8', errors='surrogatepass', newline='') as bodyFile:
+                while True:
+                    chunk = bodyFile.read(renderFileBufferSize)
+                    if (chunk == ''):
+                        break
+                    writer.write(chunk)
+            writer.write(bottomText)
+            writer.close()
+
+
+    def renderSectionFragments(self, parentSection, section, parentLayoutOptions, renderFormat, skipSectionList, leadOutputOptions, context):
+        # generator of rendered text fragments for this section and its children
 
         # create a COPY of layout options which includes this sections overrides added to original parent layoutOptions
         # the layout options (used by latex/html can use css) which can be changed by the section
@@ -4681,10 +5667,10 @@ class HlParser:
                 # special automatic debugReport section
                 if (outMode == 'report'):
                     if (renderFormat=='html') or (True):
-                        text += self.renderDebugReportSection(section, renderFormat, leadOutputOptions)
+                        yield self.renderDebugReportSection(section, renderFormat, leadOutputOptions)
                 else:
                     # do not show this section if not in report mode
-                    return text
+                    return
             elif (sectionId=='toc'):
                 # table of contents
                 text = self.renderTableOfContents(section, renderFormat, leadOutputOptions)
@@ -4695,8 +5681,8 @@ class HlParser:
                     if (layoutOptions['columns']>1):
                         sectionStartText += '\\begin{multicols*}{' + str(layoutOptions['columns']) + '}\n'
                         sectionEndTtext = '\\end{multicols*}\n' + sectionEndTtext
-                return sectionStartText + text + sectionEndTtext
-                #text += sectionStartText + text + sectionEndTtext
+                yield sectionStartText + text + sectionEndTtext
+                return
 
         # pass layoutOptions in context
         context['layoutOptions'] = layoutOptions
@@ -4705,7 +5691,7 @@ class HlParser:
         if ('leads' in section):
             leads = section['leads']
             if (len(leads)>0):
-                text += self.renderSectionLeads(leads, section, layoutOptions, renderFormat, leadOutputOptions, context)
+                yield from self.renderSectionLeadsFragments(leads, section, layoutOptions, renderFormat, leadOutputOptions, context)
         else:
             # blank leads just show section page?
             pass
@@ -4715,100 +5701,197 @@ class HlParser:
             childSections = section['sections']
             for childid, child in childSections.items():
                 if (childid not in skipSectionList):
-                    text += self.renderSection(section, child, layoutOptions, renderFormat, skipSectionList, leadOutputOptions, context)
+                    yield from self.renderSectionFragments(section, child, layoutOptions, renderFormat, skipSectionList, leadOutputOptions, context)
 
-        return text
 
 
 
+    def renderSectionLeadsFragments(self, leads, section, layoutOptions, renderFormat, leadOutputOptions, context):
+        # generator of rendered text fragments for the leads of a section, wrapped in the section container if there are any
+        renderOptions = self.getComputedRenderOptions()
+        outMode = leadOutputOptions['mode']
+
+        # render all the markdown for this section in one batch up front; renderLead then uses each lead's text and output as is
+        renderTextSyntax = renderOptions['textSyntax']
+        prerenderedLeads = {}
+        if (renderTextSyntax=='markdown') and (jrfuncs.getDictValueOrDefault(renderOptions, 'markdownBatch', False)):
+            prerenderedLeads = self.prerenderSectionLeadsMarkdown(leads, section, renderFormat, leadOutputOptions, context)
+
+        # iterate leads
+        sectionEndText = None
+        for leadid, lead in leads.items():
+            leadProperties = lead['properties']
+            flagRender = leadProperties['render'] if ('render' in leadProperties) else True
+            if (flagRender=='false') or (flagRender==False):
+                continue
+            
+            # get rendered text for lead
+            leadTextRendered = self.renderLead(lead, renderFormat, context, layoutOptions, leadOutputOptions, section, prerenderedLeads.get(leadid, None))
+            if (leadTextRendered == ''):
+                continue
+
+            # there is lead content in this section, so it gets wrapped in section container
+            if (sectionEndText is None):
+                [sectionStartText, sectionEndText] = self.calcSectionLeadsContainerText(section, layoutOptions, renderFormat)
+                yield sectionStartText
+
+            # add it
+            yield leadTextRendered
+
+            # loop contines for all leads
 
-    def renderSectionLeads(self, leads, section, layoutOptions, renderFormat, leadOutputOptions, context):
+        # finished lead loop
+        if (sectionEndText is not None):
+            yield sectionEndText
+
+
+    def calcSectionLeadsContainerText(self, section, layoutOptions, renderFormat):
+        # returns [sectionStartText, sectionEndText] that sandwhich the rendered leads of a section
         renderOptions = self.getComputedRenderOptions()
         renderSectionHeaders = renderOptions['sectionHeaders']
-        renderLeadLabels = renderOptions['leadLabels']
         renderTextSyntax = renderOptions['textSyntax']
-        outMode = leadOutputOptions['mode']
 
         # section header
         sectionLabel = section['label']
 
-        # start building text
-        text = ''
+        # section page header (big number marking the start of leads with this prefix)
+        sectionStartText = ''
+        sectionEndTtext = ''
+        # start of containter
+        if (renderFormat=='html'):
+            sectionStartText += '\n\n\n<article class="leads {}">\n'.format(layoutOptions['styleFileString'])
+            sectionStartText += '<div class="leadsection {}">\n'.format(layoutOptions['styleFileString'])
+
+        # section big text header
+        if (renderSectionHeaders):
+            if (sectionLabel!=''):
+                # note that the sectionLabel here is rendered in a standalone call to renderTextSyntax rather than combining into LeadText
+                markdownText = '# ' + sectionLabel + '\n'
+                [outText, extras] = self.renderTextSyntax(renderTextSyntax, markdownText, renderFormat, True)
+                sectionStartText += outText + '\n'
+
+        # special section stop?
+        breakAfter = jrfuncs.getDictValueOrDefault(section, 'stop', False)
+        if (type(breakAfter) is str):
+            sectionStartText += self.renderedTextSpecial('stop_'+breakAfter, renderFormat)
+
+        # end of container
+        if (renderFormat=='html'):
+            sectionEndTtext += '</div> <!-- lead section -->\n\n'
+            sectionEndTtext += '</article>\n\n\n\n'
 
-        # iterate leads
+
+        # multi columns
+        if (renderFormat=='latex'):
+            if (layoutOptions['columns']>1):
+                sectionStartText += '\\begin{multicols*}{' + str(layoutOptions['columns']) + '}\n'
+                sectionEndTtext = '\\end{multicols*}\n' + sectionEndTtext
+
+        if (jrfuncs.getDictValueOrDefault(section,'stop', False)):
+            if (renderFormat=='latex'):
+                sectionEndTtext += '\n\\newpage\n'
+
+        return [sectionStartText, sectionEndTtext]
+
+
+    def prerenderSectionLeadsMarkdown(self, leads, section, renderFormat, leadOutputOptions, context):
+        # returns dictionary of leadid -> [leadText, leadTextRendered, extras] for the rendered leads of the section
+        leadidList = []
+        markdownTextList = []
         for leadid, lead in leads.items():
             leadProperties = lead['properties']
             flagRender = leadProperties['render'] if ('render' in leadProperties) else True
             if (flagRender=='false') or (flagRender==False):
                 continue
-            
-            # get rendered text for lead
-            leadTextRendered = self.renderLead(lead, renderFormat, context, layoutOptions, leadOutputOptions, section)
+            leadidList.append(leadid)
+            markdownTextList.append(self.buildLeadMarkdownText(lead, context, leadOutputOptions, section))
+        if (len(markdownTextList)==0):
+            return {}
+        resultList = self.hlMarkdown.renderMarkdownBatch(markdownTextList, renderFormat, True)
+        prerenderedLeads = {}
+        for leadid, leadText, [leadTextRendered, extras] in zip(leadidList, markdownTextList, resultList):
+            prerenderedLeads[leadid] = [leadText, leadTextRendered, extras]
+        return prerenderedLeads
+# ---------------------------------------------------------------------------
 
-            # add it
-            text += leadTextRendered
 
-            # loop contines for all leads
 
 
-        # finished lead loop
-        if (text != ''):
-            # there was lead content in this section, so wrap it in section container
-            # section page header (big number marking the start of leads with this prefix)
-            sectionStartText = ''
-            sectionEndTtext = ''
-            # start of containter
+
+# ---------------------------------------------------------------------------
+    def renderLead(self, lead, renderFormat, context, layoutOptions, leadOutputOptions, section, prerendered=None):
+        # prerendered is an optional [leadText, leadTextRendered, extras] for this lead from prerenderSectionLeadsMarkdown
+        renderOptions = self.getComputedRenderOptions()
+        renderTextSyntax = renderOptions['textSyntax']
+        cleanPageOption = jrfuncs.getDictValueOrDefault(section, 'cleanPage', False)
+        #
+        if (True):
+            leadProperties = lead['properties']
+            renderId = leadProperties['renderId']
+
+            if (prerendered is not None):
+                [leadText, leadTextRendered, extras] = prerendered
+            else:
+                # assemble entire lead text in markdown format, including some inline html
+                leadText = self.buildLeadMarkdownText(lead, context, leadOutputOptions, section)
+
+                # ok leadtext is constructed in markdown format, now convert to our target syntax (usually html)
+                [leadTextRendered, extras] = self.renderTextSyntax(renderTextSyntax, leadText, renderFormat, True)
+
+
+            # post render format text
             if (renderFormat=='html'):
-                sectionStartText += '\n\n\n<article class="leads {}">\n'.format(layoutOptions['styleFileString'])
-                sectionStartText += '<div class="leadsection {}">\n'.format(layoutOptions['styleFileString'])
-
-            # section big text header
-            if (renderSectionHeaders):
-                if (sectionLabel!=''):
-                    # note that the sectionLabel here is rendered in a standalone call to renderTextSyntax rather than combining into LeadText
-                    markdownText = '# ' + sectionLabel + '\n'
-                    [outText, extras] = self.renderTextSyntax(renderTextSyntax, markdownText, renderFormat, True)
-                    sectionStartText += outText + '\n'
-
-            # special section stop?
-            breakAfter = jrfuncs.getDictValueOrDefault(section, 'stop', False)
-            if (type(breakAfter) is str):
-                sectionStartText += self.renderedTextSpecial('stop_'+breakAfter, renderFormat)
+                leadStartHtml = '<div id="{}" class="lead">\n'.format(self.safeMarkdownId(renderId))
+                leadStartHtml += '<div class="leadtext">\n'
+                leadTextRendered = leadStartHtml + leadTextRendered
+                leadTextRendered += '\n'
+                leadTextRendered += '</div> <!-- leadtext -->\n'
+                leadTextRendered += '</div> <!-- leadid -->\n'
+            elif (renderFormat=='latex'):
+                # end of lead visual marker
+                if (not cleanPageOption):
+                    if (not leadTextRendered.endswith('\n')):
+                        leadTextRendered += '\n'
+                    useTombstone = jrfuncs.getDictValueOrDefault(section,'tombstones', True)
+                    if (useTombstone):
+                        # tombstone typography adds a square block at end of line
+                        leadTextRendered += self.hlMarkdown.latexTombstone()
 
-            # end of container
-            if (renderFormat=='html'):
-                sectionEndTtext += '</div> <!-- lead section -->\n\n'
-                sectionEndTtext += '</article>\n\n\n\n'
+                    
 
+            # page breaks
+            breakAfter = jrfuncs.getDictValueOrDefault(leadProperties, 'stop', False)
+            if ((breakAfter) or (layoutOptions['solo'])) and (not jrfuncs.getDictValueOrDefault(section, 'noPageBreak', False)):
+                if (renderFormat=='html'):
+                    if (not layoutOptions['solo']):
+                        # solor is handled in css for html
+                        leadText += '<div class="pagebreakafter"></div>\n'
+                elif (renderFormat=='latex'):
+                    leadTextRendered += '\n\\newpage\n'
 
-            # multi columns
             if (renderFormat=='latex'):
-                if (layoutOptions['columns']>1):
-                    sectionStartText += '\\begin{multicols*}{' + str(layoutOptions['columns']) + '}\n'
-                    sectionEndTtext = '\\end{multicols*}\n' + sectionEndTtext
-
-            # sandwhich text
-            text = sectionStartText + text + sectionEndTtext
-
-            if (jrfuncs.getDictValueOrDefault(section,'stop', False)):
-                if (renderFormat=='latex'):
-                    text += '\n\\newpage\n'
-
-        # return text
-        return text
-# ---------------------------------------------------------------------------
+                # merge in latex extras
+                if ('latexDocClassLines' in extras) and (extras['latexDocClassLines']!=''):
+                    lines = extras['latexDocClassLines'].split('\n')
+                    if ('latexDocClassLines' not in context):
+                        context['latexDocClassLines'] = []
+                    for line in lines:
+                        # add only if not already there
+                        if (not line in context['latexDocClassLines']):
+                            context['latexDocClassLines'].append(line)
 
+            if (type(breakAfter) is str):
+                leadTextRendered += self.renderedTextSpecial('stop_'+breakAfter, renderFormat)
 
+        return leadTextRendered
 
 
 
-# ---------------------------------------------------------------------------
-    def renderLead(self, lead, renderFormat, context, layoutOptions, leadOutputOptions, section):
+    def buildLeadMarkdownText(self, lead, context, leadOutputOptions, section):
+        # assemble the entire lead text in markdown format (including some inline html), ready for renderTextSyntax
         renderOptions = self.getComputedRenderOptions()
         renderLeadLabels = renderOptions['leadLabels']
-        renderTextSyntax = renderOptions['textSyntax']
         outMode = leadOutputOptions['mode']
-        cleanPageOption = jrfuncs.getDictValueOrDefault(section, 'cleanPage', False)
         #
         if (True):
             leadProperties = lead['properties']
@@ -4887,59 +5970,10 @@ class HlParser:
             else:
                 repTextVerticalSpace = ''
                 repTextTurnPage = ''
-            leadText = leadText.replace('%solo.VerticalSpace%\n', repTextVerticalSpace)
-            leadText = leadText.replace('%solo.TurnPage%\n', repTextTurnPage)
-
-
-            # ok leadtext is constructed in markdown format, now convert to our target syntax (usually html)
-            [leadTextRendered, extras] = self.renderTextSyntax(renderTextSyntax, leadText, renderFormat, True)
-
-
-            # post render format text
-            if (renderFormat=='html'):
-                leadStartHtml = '<div id="{}" class="lead">\n'.format(self.safeMarkdownId(renderId))
-                leadStartHtml += '<div class="leadtext">\n'
-                leadTextRendered = leadStartHtml + leadTextRendered
-                leadTextRendered += '\n'
-                leadTextRendered += '</div> <!-- leadtext -->\n'
-                leadTextRendered += '</div> <!-- leadid -->\n'
-            elif (renderFormat=='latex'):
-                # end of lead visual marker
-                if (not cleanPageOption):
-                    if (not leadTextRendered.endswith('\n')):
-                        leadTextRendered += '\n'
-                    useTombstone = jrfuncs.getDictValueOrDefault(section,'tombstones', True)
-                    if (useTombstone):
-                        # tombstone typography adds a square block at end of line
-                        leadTextRendered += self.hlMarkdown.latexTombstone()
-
-                    
-
-            # page breaks
-            breakAfter = jrfuncs.getDictValueOrDefault(leadProperties, 'stop', False)
-            if ((breakAfter) or (layoutOptions['solo'])) and (not jrfuncs.getDictValueOrDefault(section, 'noPageBreak', False)):
-                if (renderFormat=='html'):
-                    if (not layoutOptions['solo']):
-                        # solor is handled in css for html
-                        leadText += '<div class="pagebreakafter"></div>\n'
-                elif (renderFormat=='latex'):
-                    leadTextRendered += '\n\\newpage\n'
-
-            if (renderFormat=='latex'):
-                # merge in latex extras
-                if ('latexDocClassLines' in extras) and (extras['latexDocClassLines']!=''):
-                    lines = extras['latexDocClassLines'].split('\n')
-                    if ('latexDocClassLines' not in context):
-                        context['latexDocClassLines'] = []
-                    for line in lines:
-                        # add only if not already there
-                        if (not line in context['latexDocClassLines']):
-                            context['latexDocClassLines'].append(line)
-
-            if (type(breakAfter) is str):
-                leadTextRendered += self.renderedTextSpecial('stop_'+breakAfter, renderFormat)
+            soloTemplateValues = {'solo.VerticalSpace': repTextVerticalSpace, 'solo.TurnPage': repTextTurnPage}
+            leadText = soloTemplateEngine.substitute(leadText, soloTemplateValues.get)
 
-        return leadTextRendered
+        return leadText
 # ---------------------------------------------------------------------------
 
 
@@ -5315,51 +6349,115 @@ class HlParser:
 
 
 # ---------------------------------------------------------------------------
-    def generatePdflatex(self, filepath, quietMode):
+    @timedSpan('generatePdflatex')
+    def generatePdflatex(self, filepath, quietMode, formatFilePath=None):
+        # compile synchronously in this thread, report into the build log and return the result dictionary
+        result = self.compilePdflatex(filepath, quietMode, None, formatFilePath)
+        self.reportPdflatexResult(result)
+        return result
+
+
+    def generatePdflatexAsync(self, filepath, quietMode, formatFilePath=None):
+        # start compiling on a background thread and return a PdflatexCompileJob; several documents can compile at once
+        # call job.wait() (from the thread that owns the parser) to get the result merged into the build log, or job.cancel() to stop it
+        # the render options are copied now, since the parser moves on to render the next build with its own
+        job = PdflatexCompileJob(filepath)
+        renderOptions = dict(self.getComputedRenderOptions())
+        job.future = self.getPdflatexCompileExecutor().submit(self.compilePdflatex, filepath, quietMode, job, formatFilePath, renderOptions)
+        job.parser = self
+        return job
+
+
+    def getLatexCompileWorkerCount(self):
+        # how many documents of a build list may compile at once (see runBuildList); 1 compiles each one right after it is rendered
+        return max(1, int(self.getOptionVal('latexCompileWorkers', 1)))
+
+
+    def getPdflatexCompileExecutor(self):
+        if (self.pdflatexCompileExecutor is None):
+            self.pdflatexCompileExecutor = ThreadPoolExecutor(max_workers=self.getLatexCompileWorkerCount(), thread_name_prefix='pdflatex')
+        return self.pdflatexCompileExecutor
+
+
+    def shutdownPdflatexCompileExecutor(self):
+        if (self.pdflatexCompileExecutor is not None):
+            self.pdflatexCompileExecutor.shutdown(wait=True)
+            self.pdflatexCompileExecutor = None
+
+
+    def compilePdflatex(self, filepath, quietMode, job, formatFilePath=None, renderOptions=None):
+        # run pdflatex as many times as needed and return a result dictionary; does NOT touch process state (cwd) or the build log,
+        # so it is safe to call from multiple threads at once
+        # formatFilePath is an optional precompiled preamble format (see prepareLatexFormat) that every pass starts from
+        # renderOptions defaults to the current computed ones (background compiles pass a copy made when they started)
         maxRuns = 5
         filePathAbs = os.path.abspath(filepath)
         outputDirName = os.path.dirname(filePathAbs)
-        currentWorkingDir = os.getcwd()
-        os.chdir(outputDirName)
         # evil
         #decodeCharSet = 'ascii'
         decodeCharSet = 'latin-1'
         #
-        flagSwitchToNonQuietOnError = False
-        #
         errored = False
-        pdfl = None
-
-        renderOptions = self.getComputedRenderOptions()
+        timedOut = False
+        canceled = False
+        stdOutText = ''
+        stdErrText = ''
+        stderr_data = None
+        runCount = 0
+
+        if (renderOptions is None):
+            renderOptions = self.getComputedRenderOptions()
         extraTimesToRun = jrfuncs.getDictValueOrDefault(renderOptions, 'latexExtraRuns', 0)
+        # "checksum" reruns until the aux/toc/out files stop changing; "legacy" greps for "Rerun to" plus latexExtraRuns
+        rerunControl = jrfuncs.getDictValueOrDefault(renderOptions, 'latexRerunControl', 'checksum')
+        auxHash = self.calcLatexAuxHash(filePathAbs)
+        passList = []
+        # overall time limit for all passes of this compile (seconds); None for no limit
+        timeoutSecs = jrfuncs.getDictValueOrDefault(renderOptions, 'latexTimeout', None)
+        timeStart = time.time()
 
+        pdfl = None
         # how to run latex compile
         optionPdfLatexRunViaExePath = self.getWorkingOptionVal("pdfLatexRunViaExePath", False)
         optionPdfLatexRunViaExePath = True
         if (optionPdfLatexRunViaExePath):
             # pdf latex executable manually specified
-            # THIS IS SO FUCKING EVIL BUT I AM GOING INSANE AND IN SO MUCH MENTAL TRAUMA
-            renderOptions = self.getComputedRenderOptions()
-            pdflatexFullPath = jrfuncs.getDictValueOrDefault(renderOptions, 'pdfLatexExeFullPath', None)
-            # try this
-            pdflatexFullPath = "pdflatex.exe"
-        else:
-            # use pdflatex to invoke
-            # nothing to do up here
-            pass
-
+            pdflatexFullPath = self.getPdflatexExePath()
 
         wantBreak = 0
         for i in range(0,maxRuns):
             runCount = i
 
+            if (job is not None) and (job.isCanceled()):
+                canceled = True
+                break
+
+            timePassStart = time.time()
             if (optionPdfLatexRunViaExePath):
-                jrprint('{}. Launching pdflatex ({}) on "{}".'.format(i+1, pdflatexFullPath, filePathAbs))
-                proc=subprocess.Popen([pdflatexFullPath, filePathAbs], stdin=PIPE, stdout=PIPE)
-                [stdout_data, stderr_data] = proc.communicate()
+                jrprintVerbose('{}. Launching pdflatex ({}) on "{}".', i+1, pdflatexFullPath, filePathAbs)
+                # run inside the output directory via cwd= rather than chdir, so nothing changes process wide state
+                pdflatexArgs = [pdflatexFullPath, '-output-directory=' + outputDirName]
+                if (formatFilePath is not None):
+                    pdflatexArgs.append('-fmt=' + os.path.splitext(formatFilePath)[0])
+                pdflatexArgs.append(filePathAbs)
+                proc = subprocess.Popen(pdflatexArgs, stdin=PIPE, stdout=PIPE, cwd=outputDirName)
+                if (job is not None):
+                    job.setProcess(proc)
+                try:
+                    remainingSecs = None if (timeoutSecs is None) else max(0, timeoutSecs - (time.time() - timeStart))
+                    [stdout_data, stderr_data] = proc.communicate(timeout=remainingSecs)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+                    [stdout_data, stderr_data] = proc.communicate()
+                    timedOut = True
+                finally:
+                    if (job is not None):
+                        job.setProcess(None)
+                #
                 if (stdout_data is not None):
                     stdOutText = stdout_data.decode(decodeCharSet)
                 else:
+                    stdout_data = b''
                     stdOutText = ''
                 #
                 if (stderr_data is not None):
@@ -5370,16 +6468,14 @@ class HlParser:
                 # use pdflatex to invoke
                 # see https://pypi.org/project/pdflatex/
                 # works BUT seems to fail on re-running because it uses different temp file each time? FUCKED
+                # note: no timeout or cancellation support on this path
                 try:
                     if (pdfl is None):
                         pdfl = PDFLaTeX.from_texfile(filePathAbs)
                         # see https://stackoverflow.com/questions/71991645/python-3-7-pdflatex-filenotfounderror
                         pdfl.set_interaction_mode()  # setting interaction mode to None.
-                    else:
-                        # multiple runs
-                        pass
-                    pdflArgs = {"-output-directory": outputDirName}
-                    pdfl.add_args(pdflArgs)
+                        pdflArgs = {"-output-directory": outputDirName}
+                        pdfl.add_args(pdflArgs)
                     pdf, log, completed_process = pdfl.create_pdf(keep_pdf_file=True, keep_log_file=True)
                     stdout_data = log
                     stdOutText = log.decode(decodeCharSet)
@@ -5394,6 +6490,12 @@ class HlParser:
                     stdout_data = stdOutText.encode(decodeCharSet)
                     stderr_data = stdErrText.encode(decodeCharSet)
 
+            if (timedOut) or ((job is not None) and (job.isCanceled())):
+                errored = True
+                canceled = (not timedOut)
+                msg = 'pdflatex timed out after {} seconds.\n'.format(timeoutSecs) if (timedOut) else 'pdflatex compile was canceled.\n'
+                stdErrText += msg
+                break
 
             # check for error
             if (b'error occurred' in stdout_data) or ((stderr_data is not None) and (b'error occurred' in stderr_data)):
@@ -5402,43 +6504,200 @@ class HlParser:
                 if (stdErrText != ''):
                     stdErrText += '. '
                 stdErrText += msg
-                if (flagSwitchToNonQuietOnError):
-                    quietMode = False
                 errored = True
                 wantBreak = True
-                self.addBuildLog(stdErrText, True)
 
             # pdflatex may require multiple runs
-            if (b'Rerun to' not in stdout_data):
-                wantBreak += 1
-            # kludge to run multiple times
-            if (wantBreak > extraTimesToRun):
-                break
-
+            if (rerunControl == 'checksum'):
+                # stop as soon as a pass leaves the aux/toc/out files exactly as it found them (fixed point)
+                auxHashPrev = auxHash
+                auxHash = self.calcLatexAuxHash(filePathAbs)
+                auxStable = (auxHash == auxHashPrev) and (b'Rerun to' not in stdout_data)
+                passList.append({'pass': i+1, 'secs': time.time()-timePassStart, 'auxStable': auxStable})
+                if (auxStable) or (errored):
+                    break
+            else:
+                passList.append({'pass': i+1, 'secs': time.time()-timePassStart, 'auxStable': None})
+                if (b'Rerun to' not in stdout_data):
+                    wantBreak += 1
+                # kludge to run multiple times
+                if (wantBreak > extraTimesToRun):
+                    break
 
         if (runCount>=maxRuns-1):
             jrprint('WARNING: MAX RUNS ENCOUNTERED ({}) -- PROBABLY AN ERROR RUNNING PDFLATEX.'.format(runCount))
 
-  
-        #jrprint('Pdflatex Result: {}'.format(retv))
-        # change working directory back -- this is so fucking evil
-        os.chdir(currentWorkingDir)
+        return {'filepath': filepath, 'quietMode': quietMode, 'errored': errored, 'timedOut': timedOut, 'canceled': canceled, 'runCount': runCount+1, 'stdOutText': stdOutText, 'stdErrText': stdErrText, 'hasStdErr': (stderr_data is not None), 'elapsed': time.time() - timeStart, 'passes': passList}
+
+
+    def getPdflatexExePath(self):
+        # THIS IS SO FUCKING EVIL BUT I AM GOING INSANE AND IN SO MUCH MENTAL TRAUMA
+        renderOptions = self.getComputedRenderOptions()
+        pdflatexFullPath = jrfuncs.getDictValueOrDefault(renderOptions, 'pdfLatexExeFullPath', None)
+        # try this
+        pdflatexFullPath = "pdflatex.exe"
+        return pdflatexFullPath
+
+
+    def getTexVersion(self):
+        # first line of pdflatex --version, cached per process; part of the precompiled format key since formats are not portable across tex builds
+        global texVersionString
+        if (texVersionString is None):
+            try:
+                proc = subprocess.run([self.getPdflatexExePath(), '--version'], stdin=PIPE, stdout=PIPE, timeout=60)
+                texVersionString = proc.stdout.decode('latin-1').strip().split('\n')[0]
+            except Exception as e:
+                texVersionString = 'unknown'
+        return texVersionString
+
+
+    def getLatexFormatCacheDir(self):
+        formatDir = self.getOptionVal('latexFormatCacheDir', None)
+        if (formatDir is None):
+            formatDir = os.path.join(tempfile.gettempdir(), 'hlLatexFormats')
+        jrfuncs.createDirIfMissing(formatDir)
+        return formatDir
+
+
+    @timedSpan('prepareLatexFormat')
+    def prepareLatexFormat(self, staticPreamble):
+        # return path to a precompiled format (.fmt) of this static preamble, building it if it is not already cached; None if it can't be built
+        # cache key is the preamble text (which includes paper and font size in documentclass) plus the tex version
+        texVersion = self.getTexVersion()
+        formatKey = hashlib.sha1((texVersion + '\n' + staticPreamble).encode('utf-8')).hexdigest()[0:20]
+        formatName = 'hlpre_' + formatKey
+        formatDir = self.getLatexFormatCacheDir()
+        formatFilePath = '{}/{}.fmt'.format(formatDir, formatName)
+        failedFilePath = '{}/{}.failed'.format(formatDir, formatName)
+        if (os.path.isfile(formatFilePath)):
+            return formatFilePath
+        if (os.path.isfile(failedFilePath)):
+            # dont keep retrying a preamble that fails to dump
+            return None
+
+        # build in a private directory then move into place, so concurrent builds never see a partial format
+        jrprint('Building precompiled latex format "{}".'.format(formatName))
+        timeStart = time.time()
+        workDir = tempfile.mkdtemp(prefix=formatName + '_', dir=formatDir)
+        try:
+            texFilePath = '{}/{}.tex'.format(workDir, formatName)
+            jrfuncs.saveTxtToFile(texFilePath, staticPreamble + '\\csname endofdump\\endcsname\n\\begin{document}\n\\end{document}\n', 'utf-8')
+            pdflatexArgs = [self.getPdflatexExePath(), '-ini', '-interaction=nonstopmode', '-jobname=' + formatName, '-output-directory=' + workDir, '&pdflatex', 'mylatexformat.ltx', texFilePath]
+            renderOptions = self.getComputedRenderOptions()
+            timeoutSecs = jrfuncs.getDictValueOrDefault(renderOptions, 'latexTimeout', None)
+            proc = subprocess.run(pdflatexArgs, stdin=PIPE, stdout=PIPE, cwd=workDir, timeout=timeoutSecs)
+            builtFilePath = '{}/{}.fmt'.format(workDir, formatName)
+            if (proc.returncode != 0) or (not os.path.isfile(builtFilePath)):
+                jrlog('PDFLATEX FORMAT OUTPUT:')
+                jrlog(proc.stdout.decode('latin-1'))
+                jrfuncs.saveTxtToFile(failedFilePath, texVersion, 'utf-8')
+                self.addBuildLog('Could not build precompiled latex format; compiling with the full preamble instead.', False)
+                return None
+            os.replace(builtFilePath, formatFilePath)
+        except Exception as e:
+            self.addBuildLog('Could not build precompiled latex format ({}); compiling with the full preamble instead.'.format(repr(e)), False)
+            return None
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+        self.addBuildLog('Built precompiled latex format "{}" in {:.2f}s.'.format(formatName, time.time()-timeStart), False)
+        return formatFilePath
+
+
+    def calcLatexAuxHash(self, latexFilePath):
+        # hash of the auxiliary files that carry state between pdflatex passes (missing files hash as empty)
+        baseFilePath = os.path.splitext(latexFilePath)[0]
+        hasher = hashlib.sha1()
+        for extension in latexAuxSeedExtensions:
+            filePath = '{}.{}'.format(baseFilePath, extension)
+            hasher.update(extension.encode('ascii'))
+            if (os.path.isfile(filePath)):
+                with open(filePath, 'rb') as fp:
+                    hasher.update(fp.read())
+            else:
+                hasher.update(b'<missing>')
+        return hasher.hexdigest()
+
 
-        if (not quietMode):
+    def getLatexSeedDir(self, saveDir):
+        # the build directories are emptied before each build, so previous aux files are kept in a sibling directory
+        seedDir = self.getOptionVal('latexSeedDir', None)
+        if (seedDir is None):
+            seedDir = os.path.join(os.path.dirname(os.path.abspath(saveDir)), '_latexseed')
+        return seedDir
+
+
+    def calcLeadSetSignature(self):
+        # identifies the set (and order) of leads; aux files from a previous build are only reused when this matches
+        hasher = hashlib.sha1()
+        for lead in self.leads:
+            hasher.update('{}\t{}\n'.format(lead['id'], lead.get('renderId')).encode('utf-8'))
+        return hasher.hexdigest()
+
+
+    def seedLatexAuxFiles(self, saveDir, buildDir, baseOutputFileName):
+        # copy the previous build's aux/toc/out for this variant into the build dir so that an unchanged document can finish in one pass
+        seedDir = self.getLatexSeedDir(saveDir)
+        signatureFilePath = '{}/{}.seed.json'.format(seedDir, baseOutputFileName)
+        if (not os.path.isfile(signatureFilePath)):
+            return False
+        try:
+            seedInfo = jrfuncs.loadJsonFromFile(signatureFilePath, True)
+        except Exception as e:
+            return False
+        if (seedInfo.get('leadSetSignature') != self.calcLeadSetSignature()):
+            return False
+        for extension in latexAuxSeedExtensions:
+            seedFilePath = '{}/{}.{}'.format(seedDir, baseOutputFileName, extension)
+            if (os.path.isfile(seedFilePath)):
+                shutil.copyfile(seedFilePath, '{}/{}.{}'.format(buildDir, baseOutputFileName, extension))
+        return True
+
+
+    def saveLatexAuxSeed(self, saveDir, buildDir, baseOutputFileName):
+        # remember the final aux/toc/out of a successful compile for the next build of this variant
+        seedDir = self.getLatexSeedDir(saveDir)
+        jrfuncs.createDirIfMissing(seedDir)
+        for extension in latexAuxSeedExtensions:
+            filePath = '{}/{}.{}'.format(buildDir, baseOutputFileName, extension)
+            seedFilePath = '{}/{}.{}'.format(seedDir, baseOutputFileName, extension)
+            if (os.path.isfile(filePath)):
+                shutil.copyfile(filePath, seedFilePath + '.tmp')
+                os.replace(seedFilePath + '.tmp', seedFilePath)
+            else:
+                jrfuncs.deleteFilePathIfExists(seedFilePath)
+        seedInfo = {'leadSetSignature': self.calcLeadSetSignature(), 'built': jrfuncs.getNiceCurrentDateTime()}
+        jrfuncs.saveTxtToFile('{}/{}.seed.json'.format(seedDir, baseOutputFileName), json.dumps(seedInfo), 'utf-8')
+
+
+    def reportPdflatexResult(self, result):
+        # log a compile result and add it to the build log; call from the thread that owns the parser
+        stdOutText = result['stdOutText']
+        stdErrText = result['stdErrText']
+        if (not result['quietMode']):
             jrprint('PDFLATEX OUTPUT:')
             jrprint(stdOutText)
 
         # to log regardless
         jrlog('PDFLATEX OUTPUT:')
         jrlog(stdOutText)
-        
 
-        baseFileName = os.path.basename(filepath)
-        if (stderr_data is not None):
+        baseFileName = os.path.basename(result['filepath'])
+        passTexts = []
+        for passInfo in result['passes']:
+            self.timings.addSpan('pdflatex pass {}'.format(passInfo['pass']), passInfo['secs'])
+            passText = 'pass {}: {:.2f}s'.format(passInfo['pass'], passInfo['secs'])
+            if (passInfo['auxStable']):
+                passText += ' (aux stable)'
+            passTexts.append(passText)
+        if (len(passTexts)>0):
+            self.addBuildLog('Latex timing for "{}": {}; total {:.2f}s.'.format(baseFileName, ', '.join(passTexts), result['elapsed']), False)
+        if (result['hasStdErr']):
             jrprint('PDFLATEX ERR processing "{}": {}'.format(baseFileName, stdErrText))
-        if (not errored):
+        if (not result['errored']):
             self.addBuildLog('Pdf generation of "{}" from Latex completed successfully.'.format(baseFileName), False)
         else:
+            if (stdErrText != ''):
+                self.addBuildLog(stdErrText, True)
             self.addBuildLog('\n\n----------\nError generating "{}".\nFULL LATEX OUTPUT: {}\n'.format(baseFileName, stdOutText), True)
 # ---------------------------------------------------------------------------
 
@@ -5540,214 +6799,149 @@ class HlParser:
 
 
     def textReplacementsLate(self, text, renderFormat):
+        # replace the %name% templates (see lateTemplateList) in one pass over the whole document
+        # note that renderLeads runs this on space delimited pieces of the document (see TransformingTextWriter), so none of the patterns here may contain a space
+        engine = self.getLateTemplateEngine(renderFormat)
+        text = engine.substitute(text, lambda templateName: self.calcLateTemplateText(templateName, renderFormat))
 
-        templatePattern = self.wrapPercentString('coverstart', renderFormat)
-        if (text.find(templatePattern)>-1):
-            repText = self.calcCoverInfoText(renderFormat, True)
-            text = text.replace(templatePattern, repText)
+        # eliminate double line separators
+        text = text.replace('\n\hrulefill\n\hrulefill\n','\n\hrulefill\n')
+        text = text.replace('\n\hrulefill\n\n\hrulefill\n','\n\hrulefill\n')
+        text = text.replace('\n<hr/>\n</hr>\n','\n</hr>\n')
+        text = text.replace('\n---\n---\n','\n---\n')
+
+        #
+        return text
+
+
+    def getLateTemplateEngine(self, renderFormat):
+        if (renderFormat not in self.lateTemplateEngines):
+            emptyPattern = self.wrapPercentString('', renderFormat)
+            delim = emptyPattern[0:len(emptyPattern)//2]
+            self.lateTemplateEngines[renderFormat] = TextTemplateEngine(lateTemplateList, delim)
+        return self.lateTemplateEngines[renderFormat]
 
-        templatePattern = self.wrapPercentString('coverend', renderFormat)
-        if (text.find(templatePattern)>-1):
+
+    def calcLateTemplateText(self, templateName, renderFormat):
+        # replacement text for one late template
+        if (templateName=='coverstart'):
+            repText = self.calcCoverInfoText(renderFormat, True)
+        elif (templateName=='coverend'):
             if (renderFormat=='html'):
                 repText = '</div> <!-- cover page -->\n'
             elif (renderFormat=='latex'):
                 repText = '\end{titlepage}\n'
-            #
-            text = text.replace(templatePattern, repText)
-
-        templatePattern = self.wrapPercentString('coverinfo', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='coverinfo'):
             repText = self.calcCoverInfoText(renderFormat, False)
-            #
-            text = text.replace(templatePattern, repText)
-
-        templatePattern = self.wrapPercentString('pagebreak', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='pagebreak'):
             if (renderFormat=='html'):
                 repText = '<div class="pagebreakafter"></div>\n'
             elif (renderFormat=='latex'):
                 repText = '\n\\newpage\n'
-            #
-            text = text.replace(templatePattern, repText)
-
-        templatePattern = self.wrapPercentString('casestats', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='casestats'):
             leadStats = self.calcLeadStats()
             repTextMarkdown = ''
-            #
             if (False):
                 # this info is in title normall so no need for it here
                 info = self.getOptionValThrowException('info')
                 versionBuild = jrfuncs.getDictValueOrDefault(info, 'version', 'n/a')
                 versionDate = jrfuncs.getDictValueOrDefault(info, 'date', 'n/a')
                 repTextMarkdown += '* Build: {} ({})\n'.format(versionBuild, versionDate)
-            #
             repTextMarkdown += self.addOptionStatMarkdown('Difficulty')
             repTextMarkdown += self.addOptionStatMarkdown('Playtime')
             repTextMarkdown += self.addOptionStatMarkdown('Warnings')
             repTextMarkdown += '* Leads: {}.\n'.format(leadStats['count'])
             repTextMarkdown += '* Text: {:.2f}k / {:,} words.\n'.format(leadStats['textLength']/1000, leadStats['wordCount'])
             [repText, extras] = self.hlMarkdown.renderMarkdown(repTextMarkdown, renderFormat, True)
-            text = text.replace(templatePattern, repText)
-
-
-        templatePattern = self.wrapPercentString('fontTypewriter', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='fontTypewriter'):
             if (renderFormat=='html'):
                 repText = '\n<div class="fontTypewriter">\n'
             elif (renderFormat=='latex'):
                 repText = '\n{\\ttfamily\n\\Large\n\\raggedright\n'
-            #
-            text = text.replace(templatePattern, repText)
-
-        templatePattern = self.wrapPercentString('fontHandwriting', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='fontHandwriting'):
             if (renderFormat=='html'):
                 repText = '\n<div class="fontHandwriting">\n'
             elif (renderFormat=='latex'):
                 repText = '\n{\\Fontskrivan\n\\LARGE\n\\raggedright\n'
-            #
-            text = text.replace(templatePattern, repText)
-
-        templatePattern = self.wrapPercentString('fontOff', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='fontOff'):
             if (renderFormat=='html'):
                 repText = '\</div> <!-- font div -->\n'
             elif (renderFormat=='latex'):
                 #repText = '\n\\normalfont\n\\normalsize\n\\justifying\n'
                 repText = '\n}\n'
-            #
-            text = text.replace(templatePattern, repText)
-
-
-        templatePattern = self.wrapPercentString('alignleft', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='alignleft'):
             if (renderFormat=='html'):
                 # dont know the right way for this
                 repText = ''
             elif (renderFormat=='latex'):
                 #repText = '\n\\normalfont\n\\normalsize\n\\justifying\n'
                 repText = '\\raggedright\n'
-            text = text.replace(templatePattern, repText)
-        #
-        templatePattern = self.wrapPercentString('aligncenter', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='aligncenter'):
             if (renderFormat=='html'):
                 # dont know the right way for this
                 repText = ''
             elif (renderFormat=='latex'):
                 #repText = '\n\\normalfont\n\\normalsize\n\\justifying\n'
                 repText = '\\centering\n'
-            text = text.replace(templatePattern, repText)
-
-
-        templatePattern = self.wrapPercentString('Symbol.Clock', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='Symbol.Clock'):
             if (renderFormat=='html'):
                 repText = '&#x1F551;'
             elif (renderFormat=='latex'):
                 repText = '\\raisebox{-3.5pt}\\VarTaschenuhr\\hspace{0.075cm}'
-            #
-            text = text.replace(templatePattern, repText)
-        #
-        templatePattern = self.wrapPercentString('Symbol.Mark', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='Symbol.Mark'):
             if (renderFormat=='html'):
                 repText = 'MARKSYMBOL'
             elif (renderFormat=='latex'):
                 #repText = '{\\Large \\faPencil*}\\hspace{0.1cm}'
                 repText = '{\\Large \\faTags}\\hspace{0.1cm}'
-            #
-            text = text.replace(templatePattern, repText)
-        #
-        templatePattern = self.wrapPercentString('Symbol.Doc', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='Symbol.Doc'):
             if (renderFormat=='html'):
                 repText = 'MARKSYMBOL'
             elif (renderFormat=='latex'):
                 repText = '{\\Large \\faCameraRetro}\\hspace{0.1cm}'
-            #
-            text = text.replace(templatePattern, repText)
-        #
-        templatePattern = self.wrapPercentString('Symbol.Checkbox', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='Symbol.Checkbox'):
             if (renderFormat=='html'):
                 repText = 'CHECKBOXSYMBOL'
             elif (renderFormat=='latex'):
                 repText = '{\\Large \\faCheckSquare[regular]}\\hspace{0.1cm}'
-            #
-            text = text.replace(templatePattern, repText)
-
-        templatePattern = self.wrapPercentString('Symbol.Exclamation', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='Symbol.Exclamation'):
             if (renderFormat=='html'):
                 repText = 'Symbol.Exclamation'
             elif (renderFormat=='latex'):
                 repText = '{\\Large \\color{red} \\faExclamationCircle}\\hspace{0.1cm}'
-            #
-            text = text.replace(templatePattern, repText)
-        #
-        templatePattern = self.wrapPercentString('Symbol.Stop', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='Symbol.Stop'):
             if (renderFormat=='html'):
                 repText = 'Symbol.Stop'
             elif (renderFormat=='latex'):
                 #repText = '{\\Large \\color{red} \\faExclamationCircle}\\hspace{0.1cm}'
                 repText = self.genLatexSymbolStop()
-            #
-            text = text.replace(templatePattern, repText)
-        #
-        templatePattern = self.wrapPercentString('Symbol.Hand', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='Symbol.Hand'):
             if (renderFormat=='html'):
                 repText = 'Symbol.Hand'
             elif (renderFormat=='latex'):
                 repText = '{\\Large \\faHandPointRight[regular]}\\hspace{0.1cm}'
-            #
-            text = text.replace(templatePattern, repText)
-        #
-
-        templatePattern = self.wrapPercentString('Symbol.Choice', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='Symbol.Choice'):
             if (renderFormat=='html'):
                 repText = '[Symbol.Choice]'
             elif (renderFormat=='latex'):
                 #repText = '{\\Large \\color{red} \\faTheaterMasks}\\hspace{0.1cm}'
                 repText = '{\\Large \\color{red} \\faBalanceScale}\\hspace{0.1cm}'
-            #
-            text = text.replace(templatePattern, repText)
-
-        templatePattern = self.wrapPercentString('Symbol.Bonus', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='Symbol.Bonus'):
             if (renderFormat=='html'):
                 repText = '[Symbol.Choice]'
             elif (renderFormat=='latex'):
                 repText = '{\\Large \\color{red} \\faTheaterMasks}\\hspace{0.1cm}'
-            #
-            text = text.replace(templatePattern, repText)
-
-
-
-        templatePattern = self.wrapPercentString('fontColorRed', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='fontColorRed'):
             if (renderFormat=='html'):
                 repText = '<font color = "red">'
             elif (renderFormat=='latex'):
                 repText = '\\color{red}'
-            #
-            text = text.replace(templatePattern, repText)
-
-        templatePattern = self.wrapPercentString('fontColorNormal', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='fontColorNormal'):
             if (renderFormat=='html'):
                 repText = '<font color = "black">'
             elif (renderFormat=='latex'):
                 repText = '\\normalcolor{}'
-            #
-            text = text.replace(templatePattern, repText)
-
-        templatePattern = self.wrapPercentString('boxstart', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='boxstart'):
             if (renderFormat=='html'):
                 repText = '<hr/>'
             elif (renderFormat=='latex'):
@@ -5756,38 +6950,18 @@ class HlParser:
                 repText = '\\setlength{\\fboxsep}{1em} \\fbox{\\begin{minipage}[c]{.95\\columnwidth}'
                 #repText = '\\setlength{\\fboxsep}{1em} \\fbox{\\begin{minipage}{\\columnwidth}'
                 #repText = '\\fbox{\\begin{minipage}[c]{\\columnwidth}'
-            #
-            text = text.replace(templatePattern, repText)
-        #
-        templatePattern = self.wrapPercentString('boxstartred', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='boxstartred'):
             if (renderFormat=='html'):
                 repText = '<hr/>'
             elif (renderFormat=='latex'):
                 repText = '\\setlength{\\fboxsep}{1em} \\fbox{\\begin{minipage}[c]{.95\\columnwidth}\\color{red}'
-            #
-            text = text.replace(templatePattern, repText)
-        #
-        templatePattern = self.wrapPercentString('boxend', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='boxend'):
             if (renderFormat=='html'):
                 repText = '<hr/>'
             elif (renderFormat=='latex'):
                 #repText = '}'
                 repText = '\\end{minipage}}\\normalcolor{}'
-            #
-            text = text.replace(templatePattern, repText)
-
-
-
-        #
-        templatePattern = self.wrapPercentString('radiostart', renderFormat)+'\n\n'
-        if (text.find(templatePattern)>-1):
-            # little cleanup first to remove newlines at start for better symbol
-            # THIS IS SO FUCKING STUPID AND EVIL
-            if (False):
-                text = text.replace('\%radiostart\\%\n', '\%radiostart\\%')
-                text = text.replace('\%radiostart\\%\n', '\%radiostart\\%')
+        elif (templateName=='radiostart'):
             if (renderFormat=='html'):
                 repText = '<hr/>'
             elif (renderFormat=='latex'):
@@ -5799,10 +6973,7 @@ class HlParser:
                 repText += '{\\Large \\faVolumeUp}\\hspace{0.1cm} '
                 #repText += '{\\Large \\faRss}\\hspace{0.1cm}'
                 repText += '"'
-            text = text.replace(templatePattern, repText)
-        #
-        templatePattern = '\n\n' + self.wrapPercentString('radioend', renderFormat)
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='radioend'):
             if (renderFormat=='html'):
                 repText = '<hr/>'
             elif (renderFormat=='latex'):
@@ -5811,32 +6982,12 @@ class HlParser:
                 repText = ''
                 repText += '"'
                 repText += '\\end{minipage}}\\end{center}'
-            #
-            text = text.replace(templatePattern, repText)
-
-
-
-        #
-        templatePattern = '\n\n' + self.wrapPercentString('Separator.Final', renderFormat)+'\n'
-        if (text.find(templatePattern)>-1):
+        elif (templateName=='Separator.Final'):
             if (renderFormat=='html'):
                 repText = '<hr/>'
             elif (renderFormat=='latex'):
                 repText = '\n\\begin{center}{\\pgfornament[anchor=center,ydelta=0pt,width=2cm]{80}}\\end{center}%\n'
-            #
-            text = text.replace(templatePattern, repText)
-
-
-
-
-        # eliminate double line separators
-        text = text.replace('\n\hrulefill\n\hrulefill\n','\n\hrulefill\n')
-        text = text.replace('\n\hrulefill\n\n\hrulefill\n','\n\hrulefill\n')
-        text = text.replace('\n<hr/>\n</hr>\n','\n</hr>\n')
-        text = text.replace('\n---\n---\n','\n---\n')
-
-        #
-        return text
+        return repText
 
 
     def genLatexSymbolStop(self):
@@ -6515,7 +7666,7 @@ class HlParser:
 
         # any other hint properties that should add to existing tag?
         targetHintLabel = tagDict['labelFull']
-        hintProperties['renderId'] = 'Hint for ' + targetHintLabel
+        self.setLeadRenderId(lead, 'Hint for ' + targetHintLabel)
         hintProperties['reportExtra'] = tagIdExtended
         if ('deadline' in hintProperties):
             tagDict['deadline'] = hintProperties['deadline']
@@ -6635,7 +7786,7 @@ class HlParser:
             if (tagLead is not None):
                 tagLeadProps = tagLead['properties']
                 # force render id to be the label
-                tagLeadProps['renderId'] = '{} ['.format(jrfuncs.uppercaseFirstLetter(self.getText('condition'))) + label + ']'
+                self.setLeadRenderId(tagLead, '{} ['.format(jrfuncs.uppercaseFirstLetter(self.getText('condition'))) + label + ']')
 
             #
             if (lead is not None):
@@ -6681,7 +7832,7 @@ class HlParser:
             tagDict['labelFull'] = 'Document {}'.format(docIndex+1)
 
             # important -- force the renderId of the lead; this is important because it is used as target of link generated below
-            tagLeadProps['renderId'] = tagDict['label']
+            self.setLeadRenderId(tagLead, tagDict['label'])
             tagLeadProps['reportExtra'] = tagIdExtended
 
             # label for mindmap; it's important that this matches the lead label as that is what is used for mindmap node creation in other places
@@ -7034,6 +8185,7 @@ class HlParser:
         self.reportSummary()
 
 
+    @timedSpan('runDebugExtraStepsIfNeeded')
     def runDebugExtraStepsIfNeeded(self):
         if (self.didRunDebugExtraSteps):
             return
@@ -7048,6 +8200,16 @@ class HlParser:
 
 
 # ---------------------------------------------------------------------------
+    def timingSpan(self, label):
+        # context manager timing a stage of the build (see getTimingTree)
+        return self.timings.span(label)
+
+    def getTimingTree(self):
+        # json friendly tree of how long each build stage took (see lib/jr/jrtiming.py)
+        return self.timings.finish()
+
+
+    @timedSpan('runPreBuildSteps')
     def runPreBuildSteps(self):
         self.processHeadBlocks()
         self.addZeroLeadWarning()
@@ -7069,13 +8231,24 @@ class HlParser:
         #
         buildList = self.getOptionValThrowException('buildList')
         skipCount = 0
-        for build in buildList:
-            success = self.runBuild(build, flagCleanAfter)
-            if (success=="skip"):
-                self.addBuildLog("Skipped build '{}' due to incompatible options (page size vs. column count?)".format(build["label"]), False)
-                skipCount += 1
-            elif (not success):
-                break
+        # with more than one compile worker, each document compiles in the background while the next build renders
+        self.flagDeferLatexCompiles = (self.getLatexCompileWorkerCount() > 1)
+        flagCancelCompiles = True
+        try:
+            for [build, success] in self.iterateBuildListResults(buildList, flagCleanAfter):
+                if (success=="skip"):
+                    self.addBuildLog("Skipped build '{}' due to incompatible options (page size vs. column count?)".format(build["label"]), False)
+                    skipCount += 1
+                elif (not success):
+                    break
+            else:
+                flagCancelCompiles = False
+        finally:
+            # finish (or after a failure, stop) the background compiles and report them into the build log
+            with self.timingSpan('wait for latex compiles'):
+                self.waitPendingLatexCompiles(flagCancelCompiles)
+            self.shutdownPdflatexCompileExecutor()
+            self.flagDeferLatexCompiles = False
         #
         # error if all skipped
         if (skipCount == len(buildList)):
@@ -7084,6 +8257,18 @@ class HlParser:
         return (not self.getBuildErrorStatus())
 
 
+    def iterateBuildListResults(self, buildList, flagCleanAfter):
+        # generator yielding [build, success] in build list order
+        for build in buildList:
+            if (build['variant']=='zip') and (not self.waitPendingLatexCompiles()):
+                # the zip needs all the pdfs before it; a failed compile stops the build list here
+                yield [build, False]
+                return
+            with self.timingSpan('build "{}"'.format(build['label'])):
+                success = self.runBuild(build, flagCleanAfter)
+            yield [build, success]
+
+
     def cleanBuildList(self):
         # new build list generator
         buildList = self.getOptionValThrowException('buildList')
@@ -7157,7 +8342,8 @@ class HlParser:
                 nowTime = datetime.datetime.now()
                 optionZipSuffix += nowTime.strftime('_%Y%m%d')
             if (len(generatedFileList)>0):
-                zipFilePath = jrfuncs.makeZipFile(generatedFileList, optionZipOutDir, gameName + optionZipSuffix)
+                with self.timingSpan('makeZipFile'):
+                    zipFilePath = jrfuncs.makeZipFile(generatedFileList, optionZipOutDir, gameName + optionZipSuffix)
                 jrprint("Zipped {} files to '{}'.".format(len(generatedFileList), zipFilePath))
                 self.addGeneratedFile(zipFilePath, False)
             self.clearGeneratedFileListForZip()
@@ -7214,6 +8400,7 @@ class HlParser:
             self.reportNotes()
             self.reportWarnings()
             self.reportSummary()
+            self.reportCodeFuncStats()
             #
             # just to make a file copy
             self.saveTextLeads()
@@ -5,13 +5,16 @@
 # django
 from huey import crontab
 from huey.contrib.djhuey import db_periodic_task, db_task, task
-from huey.contrib.djhuey import HUEY as huey
+from huey.exceptions import RetryTask
 from django.utils import timezone
+from django.conf import settings
 
 # python modules
 from datetime import datetime
 import os
 import time
+import json
+import hashlib
 import traceback
 
 # user modules
@@ -39,6 +42,66 @@ from lib.jr import jrfuncs
 # see https://huey.readthedocs.io/en/latest/api.html#Huey.task
 @db_task(context=True)
 def queueTaskBuildStoryPdf(gameModelPk, requestOptions, task=None):
+    # a user can only have so many builds running at once; if all their slots are busy, put this one back in the queue for a little while
+    ownerPk = jrfuncs.getDictValueOrDefault(requestOptions, "ownerPk", None)
+    slotKey = acquireUserBuildSlot(ownerPk)
+    if (slotKey is False):
+        raise RetryTask("All build slots for user {} are busy.".format(ownerPk), delay=settings.JR_BUILDQUEUEUSERRETRYDELAY)
+    try:
+        return runTaskBuildStoryPdf(gameModelPk, requestOptions, task)
+    finally:
+        releaseUserBuildSlot(slotKey)
+
+
+def makeTaskBuildStoryPdf(gameModelPk, requestOptions, buildMode):
+    # the build task, not queued yet (see enqueueTask); its id is known now, so it can be saved with the build status before the task could start running
+    return queueTaskBuildStoryPdf.s(gameModelPk, requestOptions, priority=calcBuildTaskPriority(buildMode))
+
+
+def enqueueTask(task):
+    # queue (or in immediate mode run) a task made with .s(); returns its huey Result
+    return huey.enqueue(task)
+
+
+@db_periodic_task(crontab(minute="0", hour=str(settings.JR_ARTIFACTSWEEPHOUR)))
+def periodicTaskReleaseUnusedArtifacts():
+    # deleting a game only renames its directory, so the files keep their artifacts until the directory is removed by hand; sweep those up once a day
+    from games import gamefilemanager
+    deleteCount = gamefilemanager.releaseUnusedArtifacts()
+    jrprint("Released {} unused build artifacts.".format(deleteCount))
+
+
+def calcBuildTaskPriority(buildMode):
+    # higher runs first; quick preferred/debug builds go ahead of long draft sets
+    return settings.JR_BUILDQUEUEPRIORITIES.get(buildMode, 0)
+
+
+def acquireUserBuildSlot(ownerPk):
+    # returns the huey storage key of the slot we took, None if there is no limit for this build, or False if all slots are busy
+    # the slot value is the time it was taken, so a slot left behind by a killed worker is reclaimed after JR_BUILDQUEUESLOTTIMEOUT
+    userLimit = settings.JR_BUILDQUEUEUSERLIMIT
+    if (ownerPk is None) or (not userLimit) or (huey.immediate):
+        return None
+    timeNow = time.time()
+    for slotIndex in range(0, userLimit):
+        slotKey = "buildslot.{}.{}".format(ownerPk, slotIndex)
+        if (huey.put_if_empty(slotKey, timeNow)):
+            return slotKey
+        slotTime = huey.get(slotKey, peek=True)
+        if (slotTime is not None) and (timeNow - slotTime > settings.JR_BUILDQUEUESLOTTIMEOUT):
+            jrprint("Reclaiming stale build slot {} (taken {:.0f}s ago).".format(slotKey, timeNow - slotTime))
+            huey.delete(slotKey)
+            if (huey.put_if_empty(slotKey, timeNow)):
+                return slotKey
+    return False
+
+
+def releaseUserBuildSlot(slotKey):
+    if (slotKey is not None):
+        huey.delete(slotKey)
+
+
+def runTaskBuildStoryPdf(gameModelPk, requestOptions, task):
     # imports needing in function to avoid circular?
     from games.models import Game
     from games import gamefilemanager
@@ -109,7 +172,8 @@ def queueTaskBuildStoryPdf(gameModelPk, requestOptions, task=None):
     game.setBuildResults(buildMode, buildResults)
     #
     # save NOW early (and again later) since it will take some time and something else might run in meantime
-    game.save()
+    # only the build status is written; the author may be editing the game text while we build
+    game.saveBuildStatus([buildMode])
     jrprint("!!!! saving new huey job ({}) starting.".format(buildMode))
 
     # normally this wouildnt happen because a cancel would stop the task from even running
@@ -122,41 +186,34 @@ def queueTaskBuildStoryPdf(gameModelPk, requestOptions, task=None):
     # create new gamefilemanager; which will be intermediary for accessing game data
     gameFileManager = GameFileManager(game)
 
-
     # what outputs do we want parser to build/generate
-    buildList = []
-    if (buildMode in ["buildPreferred"]):
-        # build preferred format
-        build = {"label": "preferred format build", "gameName": gameName, "format": "pdf", "paperSize": preferredFormatPaperSize, "layout": preferredFormatLayout, "variant": "normal", "gameFileType": gamefilemanager.EnumGameFileTypeName_PreferredBuild, }
-        addCalculatedFieldsToBuild(build)
-        buildList.append(build)
-        if (True):
-            # build zip
-            zipBuild = {"label": "zipping built files", "gameName": gameName, "variant": "zip", "layout": None, "gameFileType": gamefilemanager.EnumGameFileTypeName_PreferredBuild}
-            buildList.append(zipBuild)
-        flagCleanAfter = "minimal"
-    if (buildMode in ["buildDebug"]):
-        # build debug format
-        build = {"label": "debug build", "gameName": gameName, "format": "pdf", "paperSize": preferredFormatPaperSize, "layout": preferredFormatLayout, "variant": "debug", "gameFileType": gamefilemanager.EnumGameFileTypeName_Debug, }
-        addCalculatedFieldsToBuild(build)
-        buildList.append(build)
-        if (True):
-            # build zip
-            zipBuild = {"label": "zipping built files", "gameName": gameName, "variant": "zip", "layout": None, "gameFileType": gamefilemanager.EnumGameFileTypeName_Debug}
-            buildList.append(zipBuild)
-        flagCleanAfter = "none"
-    if (buildMode in ["buildDraft"]):
-        # build complete list; all combinations of page size and layout
-        buildList += generateCompleteBuildList(game, False)
-        if (True):
-            # build zip
-            zipBuild = {"label": "zipping built files", "gameName": gameName, "variant": "zip", "layout": None, "gameFileType": gamefilemanager.EnumGameFileTypeName_DraftBuild}
-            buildList.append(zipBuild)
-        flagCleanAfter = "extra"
-        #
-    if (buildMode not in ["buildPreferred", "buildDebug", "buildDraft"]):
-        raise Exception("Build mode not understood: '{}'.".format(buildMode))
-    
+    [buildList, flagCleanAfter] = generateBuildListForMode(game, buildMode)
+    buildFingerprint = calcBuildFingerprint(game, buildMode, buildList, gameFileManager)
+
+    # nothing that goes into the build has changed since the last successful one (e.g. a repeated request), so its files are still good
+    if (not isCanceled) and (isBuildFingerprintCurrent(game, buildMode, buildFingerprint, buildList, gameFileManager)):
+        buildResults = {
+            "queueStatus": Game.GameQueueStatusEnum_Completed,
+            "buildDateQueued": buildDateQueued.timestamp(),
+            "buildDateStart": buildDateStart.timestamp(),
+            "buildDateEnd": timezone.now().timestamp(),
+            "buildVersion": gameBuildVersion,
+            "buildVersionDate": gameBuildVersionDate,
+            "buildTextHash": gameTextHash,
+            "buildError": False,
+            "buildLog": "Build skipped; nothing has changed (text, build options, images or options files) since the last successful build, so its files were kept.",
+            "buildFingerprint": buildFingerprint,
+            "canceled": False,
+            }
+        if (task is not None):
+            buildResults["taskType"] = "huey"
+            buildResults["taskId"] = task.id
+        game.copyLastBuildResultsTo(buildResultsPrevious, buildResults)
+        game.setBuildResults(buildMode, buildResults)
+        game.saveBuildStatus([buildMode])
+        jrprint("!!!! skipped huey job ({}); build fingerprint unchanged.".format(buildMode))
+        return "Build skipped; files are up to date"
+
     # initialize the directory of files, deleting any that exist previously
     gameFileManager.deleteFilesInBuildListDirectories(buildList)
 
@@ -170,6 +227,8 @@ def queueTaskBuildStoryPdf(gameModelPk, requestOptions, task=None):
         "templatedir": templateDirPath,
         "buildList": buildList,
         "gameFileManager": gameFileManager,
+        "latexCompileWorkers": settings.JR_LATEXCOMPILEWORKERS,
+        "parseCacheFilePath": gameFileManager.getStoryParseCacheFilePath(),
         }
 
     # DO THE ACTUAL BUILD
@@ -177,6 +236,10 @@ def queueTaskBuildStoryPdf(gameModelPk, requestOptions, task=None):
 
     # start the build log
     buildLog = "Building: '{}'...\n".format(buildMode)
+    # everything logged by this thread during the build also goes to a per build log file
+    buildLogFilePath = gameFileManager.getBuildLogFilePath(buildMode)
+    jrfuncs.deleteFilePathIfExists(buildLogFilePath)
+    buildLogFileHandle = jrfuncs.addBuildLogFile(buildLogFilePath)
 
     try:
         # create hl parser
@@ -197,6 +260,25 @@ def queueTaskBuildStoryPdf(gameModelPk, requestOptions, task=None):
         buildLog += msg
         buildErrorStatus = True
 
+    jrfuncs.removeBuildLogFile(buildLogFileHandle)
+
+    # keep the built files in the content addressed artifact store; unchanged outputs dedupe, and publishing can link rather than copy them
+    builtGameFileTypes = []
+    for build in buildList:
+        if (build["gameFileType"] not in builtGameFileTypes):
+            builtGameFileTypes.append(build["gameFileType"])
+    for gameFileType in builtGameFileTypes:
+        try:
+            gameFileManager.storeFilesForGameTypeAsArtifacts(gameFileType)
+        except Exception as e:
+            # the built files are still there, just not in the store; report it but carry on so the build status gets saved
+            msg = "ERROR: Exception while storing built '{}' files as artifacts. Exception = ".format(gameFileType) + repr(e)
+            msg += "; " + traceback.format_exc()
+            jrprint(msg)
+            if (buildLog != ""):
+                buildLog += "\n\n"
+            buildLog += msg
+            buildErrorStatus = True
 
     # add file generated list
     generatedFileList = hlParser.getGeneratedFileList()
@@ -230,8 +312,8 @@ def queueTaskBuildStoryPdf(gameModelPk, requestOptions, task=None):
     buildLog += "\nBuild wait time: {}.".format(waitStr)
 
 
-    # REload game instance AGAIN to save state, in case it has changed
-    game = Game.get_or_none(pk=gameModelPk)
+    # REload game instance AGAIN to save state, in case it has changed (no need for its text this time)
+    game = Game.objects.defer(*Game.GameDetailDeferredFieldNames).filter(pk=gameModelPk).first()
     if (game is None):
         raise Exception("Failed to find game pk={} for updating build results - stage 2.".format(gameModelPk))
         # can't continue below
@@ -266,10 +348,14 @@ def queueTaskBuildStoryPdf(gameModelPk, requestOptions, task=None):
         "buildTextHash": gameTextHash,
         "buildError": buildErrorStatus,
         "buildLog": buildLog,
+        "buildTimings": hlParser.getTimingTree(),
+        "buildFingerprint": buildFingerprint,
         "canceled": isCanceled,
         "lastBuildDateStart": buildDateStart.timestamp(),
         "lastBuildVersion": gameBuildVersion,
         "lastBuildVersionDate": gameBuildVersionDate,
+        # the files in the build directories were deleted at the start, so only a good build leaves files matching a fingerprint
+        "lastBuildFingerprint": "" if (buildErrorStatus) else buildFingerprint,
     }
     # add task info
     if (task is not None):
@@ -297,8 +383,8 @@ def queueTaskBuildStoryPdf(gameModelPk, requestOptions, task=None):
     if (not buildErrorStatus):
         game.lastBuildLog += "\n" + game.leadStats
 
-    # save game
-    game.save()
+    # save just the build status fields
+    game.saveBuildStatus([buildMode], ["lastBuildLog", "leadStats"])
 
     jrprint("!!!! FINISHED with a huey job ({}) status = '{}' !!!!".format(buildMode, queueStatus))
 
@@ -310,6 +396,101 @@ def queueTaskBuildStoryPdf(gameModelPk, requestOptions, task=None):
 
 
 
+def generateBuildListForMode(game, buildMode):
+    # returns [buildList, flagCleanAfter] of the outputs to build for a build request
+    # imports needing in function to avoid circular?
+    from games import gamefilemanager
+
+    flagCleanAfter = "minimal"
+    # what outputs do we want parser to build/generate
+    buildList = []
+    if (buildMode in ["buildPreferred"]):
+        # build preferred format
+        build = {"label": "preferred format build", "gameName": game.gameName, "format": "pdf", "paperSize": game.preferredFormatPaperSize, "layout": game.preferredFormatLayout, "variant": "normal", "gameFileType": gamefilemanager.EnumGameFileTypeName_PreferredBuild, }
+        addCalculatedFieldsToBuild(build)
+        buildList.append(build)
+        if (True):
+            # build zip
+            zipBuild = {"label": "zipping built files", "gameName": game.gameName, "variant": "zip", "layout": None, "gameFileType": gamefilemanager.EnumGameFileTypeName_PreferredBuild}
+            buildList.append(zipBuild)
+        flagCleanAfter = "minimal"
+    if (buildMode in ["buildDebug"]):
+        # build debug format
+        build = {"label": "debug build", "gameName": game.gameName, "format": "pdf", "paperSize": game.preferredFormatPaperSize, "layout": game.preferredFormatLayout, "variant": "debug", "gameFileType": gamefilemanager.EnumGameFileTypeName_Debug, }
+        addCalculatedFieldsToBuild(build)
+        buildList.append(build)
+        if (True):
+            # build zip
+            zipBuild = {"label": "zipping built files", "gameName": game.gameName, "variant": "zip", "layout": None, "gameFileType": gamefilemanager.EnumGameFileTypeName_Debug}
+            buildList.append(zipBuild)
+        flagCleanAfter = "none"
+    if (buildMode in ["buildDraft"]):
+        # build complete list; all combinations of page size and layout
+        buildList += generateCompleteBuildList(game, False)
+        if (True):
+            # build zip
+            zipBuild = {"label": "zipping built files", "gameName": game.gameName, "variant": "zip", "layout": None, "gameFileType": gamefilemanager.EnumGameFileTypeName_DraftBuild}
+            buildList.append(zipBuild)
+        flagCleanAfter = "extra"
+        #
+    if (buildMode not in ["buildPreferred", "buildDebug", "buildDraft"]):
+        raise Exception("Build mode not understood: '{}'.".format(buildMode))
+    return [buildList, flagCleanAfter]
+
+
+def calcBuildFingerprint(game, buildMode, buildList, gameFileManager):
+    # hash of everything that goes into a build; a build with the same fingerprint as the last successful one would just make the same files again
+    fingerprintData = {
+        "textHash": game.textHash,
+        "buildMode": buildMode,
+        "buildList": buildList,
+        "storyBuildVersion": settings.JR_STORYBUILDVERSION,
+        "imageSetHash": gameFileManager.calcImageSetHash(),
+        "optionsHash": calcOptionsFilesHash(os.path.abspath(os.path.dirname(__file__)) + "/options"),
+        }
+    h = hashlib.new("sha256")
+    h.update(json.dumps(fingerprintData, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def calcOptionsFilesHash(optionsDirPath):
+    # hash of the contents of the parser options files
+    h = hashlib.new("sha256")
+    for fileName in sorted(os.listdir(optionsDirPath)):
+        filePath = optionsDirPath + "/" + fileName
+        if (os.path.isfile(filePath)):
+            h.update(fileName.encode())
+            with open(filePath, "rb") as optionsFile:
+                h.update(optionsFile.read())
+    return h.hexdigest()
+
+
+def isBuildFingerprintCurrent(game, buildMode, buildFingerprint, buildList, gameFileManager):
+    # true if the last successful build of this mode had this fingerprint and its files are still there
+    buildResults = game.getBuildResults(buildMode)
+    if (jrfuncs.getDictValueOrDefault(buildResults, "lastBuildFingerprint", "") != buildFingerprint):
+        return False
+    for build in buildList:
+        if (len(gameFileManager.buildFileListFromLocalDrivePath(build["gameFileType"]))==0):
+            return False
+    return True
+
+
+def isBuildRequestUpToDate(game, buildMode):
+    # called when an author asks for a build; true if the last build of this mode completed and nothing has changed since
+    from games.models import Game
+    from games.gamefilemanager import GameFileManager
+    buildResults = game.getBuildResults(buildMode)
+    if (jrfuncs.getDictValueOrDefault(buildResults, "queueStatus", None) != Game.GameQueueStatusEnum_Completed):
+        return False
+    gameFileManager = GameFileManager(game)
+    [buildList, flagCleanAfter] = generateBuildListForMode(game, buildMode)
+    buildFingerprint = calcBuildFingerprint(game, buildMode, buildList, gameFileManager)
+    return isBuildFingerprintCurrent(game, buildMode, buildFingerprint, buildList, gameFileManager)
+
+
+
+
 def generateCompleteBuildList(game, flagDebugIncluded):
     # loop twice, the first time just calculate buildCount
     # imports needing in function to avoid circular?
@@ -435,7 +616,7 @@ def publishGameFiles(game):
     game.copyBuildResults("published", "buildDraft", overrideResults)
 
     # save
-    game.save()
+    game.saveBuildStatus(["published"], ["publishDate"])
 
     return publishResult
 # ---------------------------------------------------------------------------
@@ -645,6 +826,15 @@ def isTaskCanceled(taskType, taskId):
         return False
     return huey.is_revoked(taskId)
 
+def isTaskWaitingInQueue(taskType, taskId):
+    # true if the task is still in the queue (or scheduled to retry), and not revoked
+    if (taskType!="huey") or (taskId is None) or (huey.is_revoked(taskId)):
+        return False
+    for queuedTask in huey.pending() + huey.scheduled():
+        if (queuedTask.id == taskId):
+            return True
+    return False
+
 def cancelPreviousQueuedTask(taskType, taskId):
     if (taskType=="huey"):
         isRevoked = huey.is_revoked(taskId)
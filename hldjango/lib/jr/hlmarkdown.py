@@ -2,6 +2,7 @@
 # mistletoe markdown to html and latex
 import mistletoe
 from mistletoe.latex_renderer import LaTeXRenderer
+from mistletoe import block_token, span_token
 
 from .pylatexrenderer import PyLaTeXRenderer
 from .jrhtmlrenderer import JrHtmlRenderer
@@ -13,15 +14,140 @@ from pylatex.utils import NoEscape
 # other python libs
 import json
 import re
+import os
+import hashlib
+import time
+from collections import OrderedDict
+
+
+# bump this whenever renderer output changes, so stale disk cache entries are never used
+markdownRendererVersion = 1
+# paragraph used to separate snippets in renderMarkdownBatch
+markdownBatchSentinel = 'HLMARKDOWNBATCHSENTINEL7f3c9a'
+
+
+
+
+class MarkdownRenderCache:
+    # content addressed cache of [text, extras] render results with LRU eviction and an entry/byte cap; optionally mirrored to disk
+    def __init__(self, maxEntries, maxBytes, diskDir):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.diskDir = diskDir
+        self.entries = OrderedDict()
+        self.totalBytes = 0
+        self.stats = {'hits': 0, 'diskHits': 0, 'misses': 0, 'evictions': 0}
+        if (diskDir is not None):
+            os.makedirs(diskDir, exist_ok=True)
+
+    def calcKey(self, keyParts):
+        return hashlib.sha1(json.dumps(keyParts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def calcEntrySize(self, text, extras):
+        return len(text) + sum(len(str(v)) for v in extras.values())
+
+    def get(self, key):
+        # returns [text, extras] or None; extras is a fresh copy the caller may modify
+        entry = self.entries.get(key)
+        if (entry is not None):
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return [entry[0], dict(entry[1])]
+        if (self.diskDir is not None):
+            filePath = self.calcDiskFilePath(key)
+            if (os.path.isfile(filePath)):
+                try:
+                    with open(filePath, 'r', encoding='utf-8') as fp:
+                        [text, extras] = json.load(fp)
+                    self.stats['diskHits'] += 1
+                    self.storeMemory(key, text, extras)
+                    return [text, dict(extras)]
+                except Exception as e:
+                    pass
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, key, text, extras, flagAllowDisk):
+        self.storeMemory(key, text, dict(extras))
+        if (self.diskDir is not None) and (flagAllowDisk):
+            filePath = self.calcDiskFilePath(key)
+            os.makedirs(os.path.dirname(filePath), exist_ok=True)
+            tempFilePath = '{}.{}.tmp'.format(filePath, os.getpid())
+            with open(tempFilePath, 'w', encoding='utf-8') as fp:
+                json.dump([text, extras], fp)
+            os.replace(tempFilePath, filePath)
+
+    def storeMemory(self, key, text, extras):
+        size = self.calcEntrySize(text, extras)
+        if (size > self.maxBytes):
+            return
+        if (key in self.entries):
+            self.totalBytes -= self.entries[key][2]
+        self.entries[key] = [text, extras, size]
+        self.entries.move_to_end(key)
+        self.totalBytes += size
+        while (len(self.entries) > self.maxEntries) or (self.totalBytes > self.maxBytes):
+            [oldKey, oldEntry] = self.entries.popitem(last=False)
+            self.totalBytes -= oldEntry[2]
+            self.stats['evictions'] += 1
+
+    def calcDiskFilePath(self, key):
+        return os.path.join(self.diskDir, key[0:2], key + '.json')
+
+    def clear(self):
+        self.entries.clear()
+        self.totalBytes = 0
+
+
 
 
 class HlMarkdown:
     def __init__(self, options, hlParserRef):
         self.options = options
         self.parserRef = hlParserRef
+        #
+        # render cache (see MarkdownRenderCache)
+        self.renderCache = None
+        if (self.options.get('renderCache', True)):
+            diskDir = self.options.get('renderCacheDir', None)
+            if (diskDir is not None):
+                diskDir = os.path.join(diskDir, 'v{}'.format(markdownRendererVersion))
+                os.makedirs(diskDir, exist_ok=True)
+            self.renderCache = MarkdownRenderCache(self.options.get('renderCacheMaxEntries', 20000), self.options.get('renderCacheMaxBytes', 64*1024*1024), diskDir)
+        #
+        # total time spent in renderMarkdown and renderMarkdownBatch (for build timings)
+        self.renderSecs = 0.0
+
 
     def renderMarkdown(self, text, renderFormat, flagSnippetVsWholeDocument):
+        timeStart = time.perf_counter()
+        try:
+            return self.renderMarkdownCached(text, renderFormat, flagSnippetVsWholeDocument)
+        finally:
+            self.renderSecs += time.perf_counter() - timeStart
+
+
+    def renderMarkdownCached(self, text, renderFormat, flagSnippetVsWholeDocument):
+        # cached front end to renderMarkdownUncached
+        if (self.renderCache is None):
+            [text, extras, usedExternalState] = self.renderMarkdownUncached(text, renderFormat, flagSnippetVsWholeDocument)
+            return [text, extras]
+        # options that change output are part of the key; cache settings are not
+        markdownOptions = {k: v for k, v in self.options.items() if (not k.startswith('renderCache'))}
+        key = self.renderCache.calcKey([text, renderFormat, flagSnippetVsWholeDocument, markdownOptions, markdownRendererVersion, mistletoe.__version__])
+        cached = self.renderCache.get(key)
+        if (cached is not None):
+            return cached
+        [outText, extras, usedExternalState] = self.renderMarkdownUncached(text, renderFormat, flagSnippetVsWholeDocument)
+        # results that depend on game files (resolved image paths) are only kept for this build, never on disk
+        self.renderCache.put(key, outText, extras, not usedExternalState)
+        return [outText, dict(extras)]
+
+
+    def renderMarkdownUncached(self, text, renderFormat, flagSnippetVsWholeDocument):
+        # returns [text, extras, usedExternalState], where usedExternalState is True if the output depended on anything other than the input text and options
         extras = {}
+        usedExternalState = False
 
         if (self.options['forceLinebreaks']):
             text = text.replace('\n','\n\n')
@@ -46,55 +172,11 @@ class HlMarkdown:
             #renderer = LaTeXRenderer()
             #text = mistletoe.markdown(text, PyLaTeXRenderer)
 
-            renderer = PyLaTeXRenderer(self.parserRef)
-            # packages
-            renderer.addPackage('fontenc', ['T1'])
-            renderer.addPackage('inputenc', ['utf8'])
-            renderer.addPackage('lmodern')
-            renderer.addPackage('textcomp')
-            renderer.addPackage('lastpage')
-            renderer.addPackage('FiraSans')
-            renderer.addPackage('librebaskerville')
-            renderer.addPackage('setspace')
-            renderer.addPackage('graphicx')
-            renderer.addPackage('amssymb')
-            # for proof qed tombstone
-            renderer.addPackage('amsthm')
-            renderer.addPackage('MnSymbol')
-            # paragraph spacing
-            renderer.addPackage('parskip')
-            # page numbers
-            renderer.addPackage('scrlayer-scrpage')
-            # table of contents font customization (mono)
-            renderer.addPackage('tocloft')
-            # multi-column support
-            renderer.addPackage('multicol')
-            # this should add automatically but in case now
-            renderer.addPackageHyperref()
-            # clock symbols
-            renderer.addPackage('tikz')
-            renderer.addPackage('clock')
-            renderer.addPackage('ifsym',['clock'])
-            renderer.addPackage('fontawesome5')
-            # ornamental horizontal rules
-            renderer.addPackage('pgfornament')
-            # color?
-            #renderer.addPackage('xcolor',['dvipsnames'])
-            # shadowbox
-            renderer.addPackage('fancybox')
-            # quoting
-            #renderer.addPackage('quoting', ['font=itshape'])
-
-            # embedded pdf
-            renderer.addPackage('pdfpages')
-
-            # fonts
-            # script https://ctan.org/pkg/aurical
-            renderer.addPackage('aurical')
-
-
-            #
-            text = renderer.render(mistletoe.Document(text))
+            # use the renderer as a context manager (like mistletoe.markdown does) so the tokens it registers globally are reset afterwards;
+            # otherwise every render appends another copy to mistletoe's token lists and each parse gets slower than the last
+            with self.makeLatexRenderer() as renderer:
+                text = renderer.render(mistletoe.Document(text))
+                usedExternalState = renderer.usedExternalState
 
             # for normal rendering 
             if (flagSnippetVsWholeDocument):
@@ -102,7 +184,172 @@ class HlMarkdown:
         else:
             raise Exception('Not understood output format for mistletoe markdown library.')
         #
-        return [text, extras]
+        return [text, extras, usedExternalState]
+
+
+    def makeLatexRenderer(self):
+        # latex renderer with our standard package list
+        renderer = PyLaTeXRenderer(self.parserRef)
+        # packages
+        renderer.addPackage('fontenc', ['T1'])
+        renderer.addPackage('inputenc', ['utf8'])
+        renderer.addPackage('lmodern')
+        renderer.addPackage('textcomp')
+        renderer.addPackage('lastpage')
+        renderer.addPackage('FiraSans')
+        renderer.addPackage('librebaskerville')
+        renderer.addPackage('setspace')
+        renderer.addPackage('graphicx')
+        renderer.addPackage('amssymb')
+        # for proof qed tombstone
+        renderer.addPackage('amsthm')
+        renderer.addPackage('MnSymbol')
+        # paragraph spacing
+        renderer.addPackage('parskip')
+        # page numbers
+        renderer.addPackage('scrlayer-scrpage')
+        # table of contents font customization (mono)
+        renderer.addPackage('tocloft')
+        # multi-column support
+        renderer.addPackage('multicol')
+        # this should add automatically but in case now
+        renderer.addPackageHyperref()
+        # clock symbols
+        renderer.addPackage('tikz')
+        renderer.addPackage('clock')
+        renderer.addPackage('ifsym',['clock'])
+        renderer.addPackage('fontawesome5')
+        # ornamental horizontal rules
+        renderer.addPackage('pgfornament')
+        # color?
+        #renderer.addPackage('xcolor',['dvipsnames'])
+        # shadowbox
+        renderer.addPackage('fancybox')
+        # quoting
+        #renderer.addPackage('quoting', ['font=itshape'])
+
+        # embedded pdf
+        renderer.addPackage('pdfpages')
+
+        # fonts
+        # script https://ctan.org/pkg/aurical
+        renderer.addPackage('aurical')
+        #
+        return renderer
+
+
+
+    def renderMarkdownBatch(self, textList, renderFormat, flagSnippetVsWholeDocument):
+        timeStart = time.perf_counter()
+        try:
+            return self.renderMarkdownBatchCached(textList, renderFormat, flagSnippetVsWholeDocument)
+        finally:
+            self.renderSecs += time.perf_counter() - timeStart
+
+
+    def renderMarkdownBatchCached(self, textList, renderFormat, flagSnippetVsWholeDocument):
+        # render a list of markdown snippets, returning a list of [text, extras] identical to calling renderMarkdown on each one
+        # snippets not already cached are parsed together in a single mistletoe pass (see renderMarkdownBatchUncached)
+        resultList = [None] * len(textList)
+        keyList = [None] * len(textList)
+        batchIndexList = []
+        markdownOptions = {k: v for k, v in self.options.items() if (not k.startswith('renderCache'))}
+        for index, text in enumerate(textList):
+            if (self.renderCache is not None):
+                keyList[index] = self.renderCache.calcKey([text, renderFormat, flagSnippetVsWholeDocument, markdownOptions, markdownRendererVersion, mistletoe.__version__])
+                cached = self.renderCache.get(keyList[index])
+                if (cached is not None):
+                    resultList[index] = cached
+                    continue
+            if (flagSnippetVsWholeDocument) and (self.isMarkdownBatchable(text)):
+                batchIndexList.append(index)
+            else:
+                resultList[index] = self.renderMarkdownUncached(text, renderFormat, flagSnippetVsWholeDocument)
+        #
+        if (len(batchIndexList)>0):
+            batchResults = self.renderMarkdownBatchUncached([textList[index] for index in batchIndexList], renderFormat)
+            for batchIndex, index in enumerate(batchIndexList):
+                if (batchResults is None):
+                    # could not split the batch cleanly, fall back to one at a time
+                    resultList[index] = self.renderMarkdownUncached(textList[index], renderFormat, flagSnippetVsWholeDocument)
+                else:
+                    resultList[index] = batchResults[batchIndex]
+        #
+        for index, result in enumerate(resultList):
+            if (len(result)==3):
+                [outText, extras, usedExternalState] = result
+                if (self.renderCache is not None):
+                    self.renderCache.put(keyList[index], outText, extras, not usedExternalState)
+                resultList[index] = [outText, dict(extras)]
+        return resultList
+
+
+    def isMarkdownBatchable(self, text):
+        # text that could affect its neighbors in a shared document is rendered on its own:
+        # link reference definitions are document wide, fences can swallow the separators, and a literal document environment would confuse the unwrap
+        for marker in ['```', '~~~', ']:', 'document}', markdownBatchSentinel]:
+            if (marker in text):
+                return False
+        return True
+
+
+    def renderMarkdownBatchUncached(self, textList, renderFormat):
+        # parse all snippets as one document, separated by sentinel paragraphs, then render the top level blocks of each snippet separately
+        # returns a list of [text, extras, usedExternalState], or None if the document did not split back into the expected pieces
+        preparedList = []
+        for text in textList:
+            if (self.options['forceLinebreaks']):
+                text = text.replace('\n','\n\n')
+            if (renderFormat=='html'):
+                text = text + '\n\n'
+            preparedList.append(text)
+        joinedText = ('\n\n' + markdownBatchSentinel + '\n\n').join(preparedList)
+
+        if (renderFormat=='html'):
+            with JrHtmlRenderer() as renderer:
+                groupList = self.splitMarkdownBatchDocument(mistletoe.Document(joinedText), len(textList))
+                if (groupList is None):
+                    return None
+                resultList = []
+                for group in groupList:
+                    inner = '\n'.join([renderer.render(child) for child in group])
+                    text = '{}\n'.format(inner) if inner else ''
+                    # kludgey bugfix needed for newlines
+                    text = text.replace('<p>\\</p>','<p>&nbsp;</p>')
+                    text = text.replace('<p>~</p>','<p>&nbsp;</p>')
+                    resultList.append([text.strip(), {}, False])
+            return resultList
+
+        elif (renderFormat=='latex'):
+            with self.makeLatexRenderer() as renderer:
+                basePackages = dict(renderer.packages)
+                groupList = self.splitMarkdownBatchDocument(mistletoe.Document(joinedText), len(textList))
+                if (groupList is None):
+                    return None
+                resultList = []
+                for group in groupList:
+                    # each snippet starts from the standard packages, so its extras match a standalone render
+                    renderer.packages = dict(basePackages)
+                    renderer.usedExternalState = False
+                    inner = ''.join([renderer.render(child) for child in group])
+                    extras = {'latexDocClassLines': renderer.render_packages().strip()}
+                    resultList.append([inner.strip(), extras, renderer.usedExternalState])
+            return resultList
+
+        raise Exception('Not understood output format for mistletoe markdown library.')
+
+
+    def splitMarkdownBatchDocument(self, document, expectedCount):
+        # split top level block tokens into groups at sentinel paragraphs
+        groupList = [[]]
+        for child in document.children:
+            if (isinstance(child, block_token.Paragraph)) and (len(child.children)==1) and (isinstance(child.children[0], span_token.RawText)) and (child.children[0].content==markdownBatchSentinel):
+                groupList.append([])
+            else:
+                groupList[-1].append(child)
+        if (len(groupList) != expectedCount) or (len(document.footnotes)>0):
+            return None
+        return groupList
 
 
     def unwrapMistletoeLatexDoc(self, text):
@@ -143,8 +390,21 @@ class HlMarkdown:
         addText += '\\let\\origcftaddtitleline\\cftaddtitleline\n'
 
         #
-        if ('latexDocClassLines' in context):
-            for line in context['latexDocClassLines']:
+        docClassLines = context['latexDocClassLines'] if ('latexDocClassLines' in context) else []
+        flagPrecompiledPreamble = renderOptions['latexPrecompiledPreamble'] if ('latexPrecompiledPreamble' in renderOptions) else False
+        if (flagPrecompiledPreamble):
+            # everything up to endofdump can be dumped into a precompiled format file (mylatexformat); hyperref does not survive dumping so it goes after
+            staticLines = [line for line in docClassLines if (line.startswith('\\usepackage')) and ('{hyperref}' not in line)]
+            lateLines = [line for line in docClassLines if (line not in staticLines)]
+            for line in staticLines:
+                addText += line + '\n'
+            context['latexStaticPreamble'] = addText
+            # when compiled with the format, mylatexformat skips everything above this line
+            addText += '\\csname endofdump\\endcsname\n'
+            for line in lateLines:
+                addText += line + '\n'
+        else:
+            for line in docClassLines:
                 addText += line + '\n'
 
 
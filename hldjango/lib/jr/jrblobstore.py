@@ -0,0 +1,114 @@
+# content addressed file store: each distinct file content is kept once, as <rootDir>/<first 2 hex chars>/<sha256>
+# files elsewhere (e.g. the build and published directories of a game) are hard links to the stored blob, so "copying" one is just making another link,
+# and identical outputs of different builds share the same blob; a blob whose only remaining link is the store's own can be released
+# blobs are made read only, since writing into one would change every file linked to it
+# a hard link shares its permissions with the blob, so the file that was ingested (e.g. a freshly built pdf in a game build directory) becomes read only too;
+# code that replaces a stored file must delete or rename over it (as the build and publish steps do), never open it for writing
+# (on windows a read only file cannot be deleted either, so there the store should be kept on a filesystem without hard links, where it copies)
+# blobs no file links to anymore are released when their game files are rebuilt (releaseBlob), and swept periodically (releaseUnusedBlobs, see hltasks)
+# on a filesystem without hard links (or with the store on another device) it falls back to plain copies
+
+from lib.jr import jrfuncs
+from lib.jr.jrfuncs import jrprint
+
+import os
+import stat
+import shutil
+import hashlib
+
+
+
+class JrBlobStore:
+    def __init__(self, rootDir):
+        self.rootDir = rootDir
+
+
+    def calcBlobPath(self, hexHash):
+        return self.rootDir + "/" + hexHash[0:2] + "/" + hexHash
+
+
+    def hashFile(self, filePath):
+        h = hashlib.new("sha256")
+        with open(filePath, "rb") as inFile:
+            while True:
+                chunk = inFile.read(1 << 20)
+                if (not chunk):
+                    break
+                h.update(chunk)
+        return h.hexdigest()
+
+
+    def isLinkedToBlob(self, filePath, hexHash):
+        # true if filePath is (a hard link to) the stored blob with this hash, so we can trust the hash without reading the file
+        blobPath = self.calcBlobPath(hexHash)
+        try:
+            return os.path.samefile(filePath, blobPath)
+        except OSError:
+            return False
+
+
+    def ingestFile(self, filePath):
+        # store the file content (if not already stored) and turn filePath into a hard link to the blob; returns the hash
+        hexHash = self.hashFile(filePath)
+        blobPath = self.calcBlobPath(hexHash)
+        jrfuncs.createDirForFullFilePathIfMissing(blobPath)
+        try:
+            if (os.path.exists(blobPath)):
+                if (not os.path.samefile(filePath, blobPath)):
+                    # same content stored before; swap our copy for a link to it
+                    self.replaceWithLink(blobPath, filePath)
+            else:
+                # the file itself becomes the blob
+                os.link(filePath, blobPath)
+                os.chmod(blobPath, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        except OSError as e:
+            jrprint("Warning: could not link '{}' into blob store ({}); leaving it as a plain file.".format(filePath, e))
+        return hexHash
+
+
+    def linkBlobTo(self, hexHash, destPath):
+        # make destPath a hard link to the blob (replacing any existing file there), falling back to a copy
+        blobPath = self.calcBlobPath(hexHash)
+        try:
+            self.replaceWithLink(blobPath, destPath)
+        except OSError:
+            shutil.copyfile(blobPath, destPath)
+
+
+    def replaceWithLink(self, blobPath, destPath):
+        # link under a temporary name then rename over the destination, so destPath is never missing or half written
+        tempPath = destPath + ".linktmp"
+        jrfuncs.deleteFilePathIfExists(tempPath)
+        os.link(blobPath, tempPath)
+        os.replace(tempPath, destPath)
+
+
+    def hasBlob(self, hexHash):
+        return os.path.exists(self.calcBlobPath(hexHash))
+
+
+    def releaseBlob(self, hexHash):
+        # delete the blob if nothing links to it anymore (only the store's own link left); returns True if it was deleted
+        blobPath = self.calcBlobPath(hexHash)
+        try:
+            if (os.stat(blobPath).st_nlink <= 1):
+                os.remove(blobPath)
+                return True
+        except OSError:
+            pass
+        return False
+
+
+    def releaseUnusedBlobs(self):
+        # sweep the whole store for blobs nothing links to (e.g. left behind by files deleted outside of releaseBlob); returns count deleted
+        deleteCount = 0
+        if (not jrfuncs.directoryExists(self.rootDir)):
+            return 0
+        for subDirEntry in os.scandir(self.rootDir):
+            if (not subDirEntry.is_dir()):
+                continue
+            for blobEntry in os.scandir(subDirEntry.path):
+                if (blobEntry.is_file()) and (blobEntry.stat().st_nlink <= 1):
+                    os.remove(blobEntry.path)
+                    deleteCount += 1
+        return deleteCount
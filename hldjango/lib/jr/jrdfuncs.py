@@ -3,11 +3,16 @@ from django.utils import timezone
 from django.contrib import messages
 from django.template.defaultfilters import slugify
 from django.core.exceptions import ValidationError
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+from django.utils.cache import get_conditional_response
 
 # python modules
 from datetime import datetime
 import re
+import os
 import uuid
+import mimetypes
 
 
 
@@ -155,3 +160,104 @@ def validateName(value):
     if (matches is None):
         raise ValidationError("Can only contain letters, numbers, spaces, underscores, hyphens")
 
+
+
+
+
+
+
+
+# file serving with range requests and conditional gets
+# offloadMode is None (we stream the file), "xsendfile" (apache mod_xsendfile, given the file path) or "xaccel" (nginx, given offloadUrlPrefix + path under offloadRootDir)
+regexRangeHeader = re.compile(r'^bytes=(\d*)-(\d*)$')
+fileServeChunkSize = 1 << 16
+
+
+def serveFileWithRanges(request, filePath, etag=None, flagAttachment=False, offloadMode=None, offloadRootDir=None, offloadUrlPrefix=None):
+    # etag should be a quoted (strong) etag when the content hash is known; otherwise a weak one is made from mtime and size
+    fileStat = os.stat(filePath)
+    fileSize = fileStat.st_size
+    lastModified = int(fileStat.st_mtime)
+    if (etag is None):
+        etag = 'W/"{:x}-{:x}"'.format(fileStat.st_mtime_ns, fileSize)
+    contentType = mimetypes.guess_type(filePath)[0] or "application/octet-stream"
+    fileName = os.path.basename(filePath)
+
+    # if-none-match / if-modified-since -> 304 (or 412 for failed if-match)
+    response = get_conditional_response(request, etag=etag, last_modified=lastModified)
+    if (response is not None):
+        return response
+
+    if (offloadMode is not None):
+        # the web server sends the bytes (and handles ranges itself)
+        response = HttpResponse(content_type=contentType)
+        if (offloadMode=="xsendfile"):
+            response["X-Sendfile"] = filePath
+        elif (offloadMode=="xaccel"):
+            relativePath = os.path.relpath(filePath, offloadRootDir).replace("\\", "/")
+            response["X-Accel-Redirect"] = offloadUrlPrefix.rstrip("/") + "/" + relativePath
+        else:
+            raise Exception("Unknown file serving offload mode '{}'.".format(offloadMode))
+    else:
+        byteRange = calcRequestByteRange(request, fileSize, etag, lastModified)
+        if (byteRange is False):
+            response = HttpResponse(status=416)
+            response["Content-Range"] = "bytes */{}".format(fileSize)
+            return response
+        if (byteRange is None):
+            response = FileResponse(open(filePath, "rb"), content_type=contentType)
+        else:
+            [rangeStart, rangeEnd] = byteRange
+            response = StreamingHttpResponse(iterateFileRange(filePath, rangeStart, rangeEnd), status=206, content_type=contentType)
+            response["Content-Range"] = "bytes {}-{}/{}".format(rangeStart, rangeEnd, fileSize)
+            response["Content-Length"] = str(rangeEnd - rangeStart + 1)
+    #
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(lastModified)
+    response["Content-Disposition"] = '{}; filename="{}"'.format("attachment" if flagAttachment else "inline", fileName)
+    return response
+
+
+def calcRequestByteRange(request, fileSize, etag, lastModified):
+    # returns None for the whole file, [start, end] (inclusive) for a single satisfiable range, or False if unsatisfiable
+    # multiple ranges are not supported; like other servers we just send the whole file for those
+    rangeHeader = request.META.get("HTTP_RANGE", None)
+    if (rangeHeader is None):
+        return None
+    # if-range: only honor the range if the client's copy is still current
+    ifRange = request.META.get("HTTP_IF_RANGE", None)
+    if (ifRange is not None):
+        if (ifRange.startswith('"') or ifRange.startswith('W/')):
+            if (ifRange != etag) or (etag.startswith("W/")):
+                return None
+        elif (parse_http_date_safe(ifRange) != lastModified):
+            return None
+    matches = regexRangeHeader.match(rangeHeader.strip())
+    if (matches is None):
+        return None
+    [startText, endText] = [matches.group(1), matches.group(2)]
+    if (startText==""):
+        # suffix range, the last N bytes
+        if (endText=="") or (int(endText)==0):
+            return False
+        rangeStart = max(0, fileSize - int(endText))
+        rangeEnd = fileSize - 1
+    else:
+        rangeStart = int(startText)
+        rangeEnd = fileSize - 1 if (endText=="") else min(int(endText), fileSize - 1)
+    if (rangeStart >= fileSize) or (rangeStart > rangeEnd):
+        return False
+    return [rangeStart, rangeEnd]
+
+
+def iterateFileRange(filePath, rangeStart, rangeEnd):
+    with open(filePath, "rb") as inFile:
+        inFile.seek(rangeStart)
+        remaining = rangeEnd - rangeStart + 1
+        while (remaining > 0):
+            chunk = inFile.read(min(fileServeChunkSize, remaining))
+            if (not chunk):
+                break
+            remaining -= len(chunk)
+            yield chunk
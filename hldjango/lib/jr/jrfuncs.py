@@ -15,6 +15,14 @@ from functools import reduce
 import random
 import json
 import math
+import atexit
+import threading
+import logging
+import collections
+import multiprocessing.util
+
+# user modules
+from lib.jr import jrzip
 
 
 
@@ -22,14 +30,37 @@ import math
 
 
 #---------------------------------------------------------------------------
+# logging backend for jrprint/jrlog
+# log lines are appended to an in memory queue and a background writer thread (JrLogWriter) writes them out in batches, so callers never wait on the log file
+# the writer sends every line to the main timestamped log file, plus any per build log files registered (see addBuildLogFile) for the thread that logged it
+# console output from jrprint stays synchronous
 LogFilePath = 'logs'
-moduleLogFile = None
 moduleErrorPrintCount = 0
+# messages below this (standard logging) level are dropped before they are formatted; logging.DEBUG shows everything including jrprintVerbose chatter, quiet mode raises it to logging.INFO
+moduleLogLevel = logging.DEBUG
+moduleLogWriter = None
+moduleLogStartLock = threading.Lock()
+# used to count printed errors for end of run reporting; its ok if its not precise
+regexLogErrorWords = re.compile(r'ERROR|EXCEPTION', re.IGNORECASE)
 
 def setLogFileDir(path):
     global LogFilePath
     LogFilePath = path
 
+def setLogLevel(level):
+    global moduleLogLevel
+    moduleLogLevel = level
+
+def getLogLevel():
+    return moduleLogLevel
+
+def setLogQuietMode(flagQuiet):
+    # quiet (production) mode suppresses the high volume progress messages of jrprintVerbose entirely
+    setLogLevel(logging.INFO if (flagQuiet) else logging.DEBUG)
+
+def isLogVerbose():
+    return (moduleLogLevel <= logging.DEBUG)
+
 def calcLogFilePath():
     global LogFilePath
 
@@ -46,19 +77,155 @@ def calcLogFilePath():
     filePath = LogFilePath + '/log_' + time.strftime('%Y%m%d_%H%M%S') + '.txt'
     return filePath
 
-def openLogFile():
-    global moduleLogFile
-    filePath = calcLogFilePath()
-    encoding = 'utf-8'
-    moduleLogFile = open(filePath, 'a+', encoding=encoding)
-    print('>LOGGING TO: {}..'.format(filePath))
-    return moduleLogFile
 
-def getOpenLogFile():
-    global moduleLogFile
-    if (not moduleLogFile):
-        moduleLogFile = openLogFile()
-    return moduleLogFile
+class JrLogWriter:
+    # background writer thread for the log
+    # the queue is a deque of [threadId, level, text]; appending to it is cheap and needs no lock, and the writer wakes up every writeInterval seconds (or sooner when the queue gets long) to write out everything queued in one go
+    def __init__(self, filePath, writeInterval=0.25, wakeQueueLength=2000):
+        self.filePath = filePath
+        self.writeInterval = writeInterval
+        self.wakeQueueLength = wakeQueueLength
+        self.queue = collections.deque()
+        self.writeLock = threading.Lock()
+        self.wakeEvent = threading.Event()
+        self.mainFile = open(filePath, 'a+', encoding='utf-8')
+        # thread id -> list of open build log files
+        self.buildFiles = {}
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name='jrLogWriter', daemon=True)
+        self.thread.start()
+
+    def add(self, level, text):
+        queue = self.queue
+        queue.append([threading.get_ident(), level, text])
+        if (len(queue) >= self.wakeQueueLength):
+            self.wakeEvent.set()
+
+    def run(self):
+        while (not self.stopping):
+            self.wakeEvent.wait(self.writeInterval)
+            self.wakeEvent.clear()
+            self.write()
+
+    def write(self):
+        # write out everything queued so far; called by the writer thread, and by flushLog from any thread
+        with self.writeLock:
+            queue = self.queue
+            mainLines = []
+            buildLines = {}
+            try:
+                while True:
+                    [threadId, level, text] = queue.popleft()
+                    mainLines.append(text)
+                    if (threadId in self.buildFiles):
+                        buildLines.setdefault(threadId, []).append(text)
+            except IndexError:
+                pass
+            if (len(mainLines)==0):
+                return
+            try:
+                self.mainFile.write('\n'.join(mainLines) + '\n')
+                self.mainFile.flush()
+                for threadId, lines in buildLines.items():
+                    for buildFile in self.buildFiles.get(threadId, []):
+                        buildFile.write('\n'.join(lines) + '\n')
+                        buildFile.flush()
+            except Exception as e:
+                incLogErrorPrintCount()
+                print('EXCEPTION1 WHILE TRYING TO PRINT TO FILE: {}'.format(e))
+
+    def stop(self):
+        self.stopping = True
+        self.wakeEvent.set()
+        self.thread.join()
+        self.write()
+
+    def addBuildFile(self, threadId, buildFile):
+        with self.writeLock:
+            self.buildFiles.setdefault(threadId, []).append(buildFile)
+
+    def removeBuildFile(self, threadId, buildFile):
+        with self.writeLock:
+            buildFileList = self.buildFiles.get(threadId, [])
+            if (buildFile in buildFileList):
+                buildFileList.remove(buildFile)
+            if (len(buildFileList)==0):
+                self.buildFiles.pop(threadId, None)
+
+
+def getLogWriter():
+    # create the log file and writer thread on first use
+    global moduleLogWriter
+    if (moduleLogWriter is not None):
+        return moduleLogWriter
+    with moduleLogStartLock:
+        if (moduleLogWriter is None):
+            filePath = calcLogFilePath()
+            moduleLogWriter = JrLogWriter(filePath)
+            print('>LOGGING TO: {}..'.format(filePath))
+    return moduleLogWriter
+
+def logText(level, text):
+    # queue one line of already formatted text for the writer thread
+    getLogWriter().add(level, text)
+
+def flushLog():
+    # write out everything logged so far, without waiting for the writer thread
+    if (moduleLogWriter is not None):
+        moduleLogWriter.write()
+
+def stopLogging():
+    # write out what is left and stop the writer thread (at exit)
+    global moduleLogWriter
+    if (moduleLogWriter is not None):
+        moduleLogWriter.stop()
+        moduleLogWriter = None
+
+def flushLogBeforeFork():
+    # so the child does not inherit (and later write out a second time) queued log lines
+    flushLog()
+
+def resetLoggingAfterFork():
+    # the writer thread does not survive a fork; the child starts its own, appending to the same log file and keeping the build log files of the thread that forked
+    global moduleLogWriter
+    if (moduleLogWriter is None):
+        return
+    filePath = moduleLogWriter.filePath
+    buildFilePaths = [buildFile.name for buildFile in moduleLogWriter.buildFiles.get(threading.get_ident(), [])]
+    moduleLogWriter = JrLogWriter(filePath)
+    for buildFilePath in buildFilePaths:
+        addBuildLogFile(buildFilePath)
+    # multiprocessing children leave via os._exit, skipping atexit, but they do run multiprocessing finalizers (which must be registered once the child process object has started)
+    multiprocessing.util.register_after_fork(moduleLogWriter, registerLogWriterFinalizer)
+
+def registerLogWriterFinalizer(logWriter):
+    multiprocessing.util.Finalize(logWriter, logWriter.write, exitpriority=0)
+
+atexit.register(stopLogging)
+if (hasattr(os, 'register_at_fork')):
+    os.register_at_fork(before=flushLogBeforeFork, after_in_child=resetLoggingAfterFork)
+
+
+def addBuildLogFile(filePath):
+    # also write everything the calling thread logs to filePath (appending), until removeBuildLogFile; returns a handle for that
+    logWriter = getLogWriter()
+    # only what is logged from here on belongs in it
+    flushLog()
+    dirPath = os.path.dirname(filePath)
+    if (dirPath!=''):
+        os.makedirs(dirPath, exist_ok=True)
+    buildFile = open(filePath, 'a', encoding='utf-8')
+    threadId = threading.get_ident()
+    logWriter.addBuildFile(threadId, buildFile)
+    return [threadId, buildFile]
+
+def removeBuildLogFile(handle):
+    [threadId, buildFile] = handle
+    # make sure everything logged so far makes it into the file first
+    flushLog()
+    if (moduleLogWriter is not None):
+        moduleLogWriter.removeBuildFile(threadId, buildFile)
+    buildFile.close()
 
 def incLogErrorPrintCount():
     global moduleErrorPrintCount
@@ -722,43 +889,37 @@ def jrprint(*args, **kwargs):
     # replacement for print function that will allow logging
     global moduleErrorPrintCount
 
-    # create log file if needed
-    logFile = getOpenLogFile()
+    # format once, the way print would
+    textLine = kwargs.get('sep', ' ').join([str(arg) for arg in args])
 
     # check for any presence of the word error (this is just for end run reporting, its ok if its not precise)
-
-    textLine = jrSprintf(args,kwargs).upper()
-    if ('ERROR' in textLine) or ('EXCEPTION' in textLine):
+    level = logging.INFO
+    if (regexLogErrorWords.search(textLine) is not None):
         moduleErrorPrintCount += 1
+        level = logging.ERROR
 
     # log
-    try:
-        print(*args, file=logFile, **kwargs)
-    except Exception as e:
-        incLogErrorPrintCount()
-        print('EXCEPTION1 WHILE TRYING TO PRINT TO FILE: {}'.format(e))
-        # invoke normal print
-        print(*args, **kwargs)
-        return
+    if (level >= moduleLogLevel):
+        logText(level, textLine)
 
     # invoke normal print
-    return print(*args, **kwargs)
+    return print(textLine, end=kwargs.get('end', '\n'), file=kwargs.get('file', None), flush=kwargs.get('flush', False))
 
 
-def jrlog(*args, **kwargs):
-    # replacement for print function that will allow logging
-    global moduleErrorPrintCount
+def jrprintVerbose(formatString, *args):
+    # like jrprint(formatString.format(*args)) for high volume progress messages (one per lead, file, etc.)
+    # in quiet mode these are dropped before anything is formatted
+    if (moduleLogLevel > logging.DEBUG):
+        return
+    jrprint(formatString.format(*args))
 
-    # create log file if needed
-    logFile = getOpenLogFile()
 
-    # log
-    try:
-        print(*args, file=logFile, **kwargs)
-    except Exception as e:
-        incLogErrorPrintCount()
-        print('EXCEPTION2 WHILE TRYING TO PRINT TO FILE: {}'.format(e))
+def jrlog(*args, **kwargs):
+    # replacement for print function that will allow logging; only writes to the log file
+    if (logging.INFO < moduleLogLevel):
         return
+    textLine = kwargs.get('sep', ' ').join([str(arg) for arg in args])
+    logText(logging.INFO, textLine)
 
 
 # see https://stackoverflow.com/questions/5309978/sprintf-like-functionality-in-python
@@ -1344,17 +1505,12 @@ def fixupUtfQuotesEtc(text):
 
 
 # ---------------------------------------------------------------------------
-def makeZipFile(generatedFileList, saveDir, fileBaseName):
+def makeZipFile(generatedFileList, saveDir, fileBaseName, workerCount=None):
+    # pdfs and images are stored as is, text files deflated in parallel (see jrzip)
     outFilePath = '{}/{}.zip'.format(saveDir, fileBaseName)
     deleteFilePathIfExists(outFilePath)
-    with zipfile.ZipFile(outFilePath, 'w') as zip:        
-        for filePath in generatedFileList:
-            filePathRelative = filePath
-            if (filePathRelative.startswith(saveDir)):
-                filePathRelative = filePathRelative[len(saveDir):]
-            else:
-                filePathRelative = os.path.baseName(filePath)
-            zip.write(filePath, compress_type=zipfile.ZIP_DEFLATED, arcname=filePathRelative)
+    entryList = [[filePath, jrzip.calcZipArcName(filePath, saveDir)] for filePath in generatedFileList]
+    jrzip.writeZipFile(outFilePath, entryList, workerCount)
     return  outFilePath
 # ---------------------------------------------------------------------------
 
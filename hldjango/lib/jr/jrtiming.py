@@ -0,0 +1,113 @@
+# lightweight nested timing spans, for seeing where a long running job (like a story build) spends its time
+# the result is a json friendly tree of {"label", "secs", "count", "children"} nodes
+#
+#   timings = JrTimingTree("build")
+#   with timings.span("renderLeads"):
+#       ...
+#   tree = timings.finish()
+
+# python imports
+import time
+import functools
+import contextlib
+
+
+
+# ---------------------------------------------------------------------------
+class JrTimingTree:
+    def __init__(self, label):
+        self.root = self.makeNode(label)
+        self.stack = [self.root]
+        self.timeStart = time.perf_counter()
+
+
+    def makeNode(self, label):
+        return {'label': label, 'secs': 0.0, 'count': 0, 'children': []}
+
+
+    def findOrAddChild(self, label):
+        # repeated spans with the same label under the same parent (e.g. one per story file) are added up into one node
+        parent = self.stack[-1]
+        for node in parent['children']:
+            if (node['label'] == label):
+                return node
+        node = self.makeNode(label)
+        parent['children'].append(node)
+        return node
+
+
+    @contextlib.contextmanager
+    def span(self, label):
+        node = self.findOrAddChild(label)
+        self.stack.append(node)
+        timeStart = time.perf_counter()
+        try:
+            yield node
+        finally:
+            node['secs'] += time.perf_counter() - timeStart
+            node['count'] += 1
+            # pop back to our parent even if an inner span was left open by an exception
+            while (len(self.stack)>1) and (self.stack.pop() is not node):
+                pass
+
+
+    def addSpan(self, label, secs, count=1):
+        # record a span that was timed elsewhere (another thread or process) under the current span
+        node = self.findOrAddChild(label)
+        node['secs'] += secs
+        node['count'] += count
+        return node
+
+
+    def addNodes(self, nodeList):
+        # graft finished nodes (e.g. from JrTimingTree.finish in a worker process) under the current span
+        for node in nodeList:
+            self.mergeNode(self.stack[-1], node)
+
+    def mergeNode(self, parent, node):
+        for existing in parent['children']:
+            if (existing['label'] == node['label']):
+                existing['secs'] += node['secs']
+                existing['count'] += node['count']
+                for child in node['children']:
+                    self.mergeNode(existing, child)
+                return
+        parent['children'].append(node)
+
+
+    def finish(self):
+        # returns the root node, with secs set to the time since the tree was created
+        self.root['secs'] = time.perf_counter() - self.timeStart
+        self.root['count'] = 1
+        return self.root
+# ---------------------------------------------------------------------------
+
+
+
+# ---------------------------------------------------------------------------
+def timedSpan(label):
+    # method decorator that runs the method inside a span of self.timings (a JrTimingTree)
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.timings.span(label):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def formatTimingTreeLines(node, totalSecs=None, depth=0, minSecs=0.0):
+    # returns a list of [depth, text] lines describing the tree, skipping spans shorter than minSecs
+    if (totalSecs is None):
+        totalSecs = node['secs']
+    text = '{}: {:.2f}s'.format(node['label'], node['secs'])
+    if (totalSecs > 0) and (depth > 0):
+        text += ' ({:.0f}%)'.format(100.0 * node['secs'] / totalSecs)
+    if (node.get('count', 1) > 1):
+        text += ' x{}'.format(node['count'])
+    lines = [[depth, text]]
+    for child in node.get('children', []):
+        if (child['secs'] >= minSecs):
+            lines += formatTimingTreeLines(child, totalSecs, depth+1, minSecs)
+    return lines
+# ---------------------------------------------------------------------------
@@ -0,0 +1,161 @@
+# streaming zip archive writer
+# picks a compression method per entry: files that are already compressed (pdfs, images, archives) are stored as is, others (text, json, dot, latex) are deflated
+# deflated entries are compressed ahead in worker threads (zlib releases the gil) and then written out in order, so the archive is one sequential stream of bytes;
+# stored entries are streamed straight from disk with a trailing data descriptor, so nothing is ever seeked or held in memory whole
+# that means the archive can be written to a file (writeZipFile) or handed chunk by chunk to something like a django StreamingHttpResponse (iterZipChunks)
+#
+# archives are limited to the classic (non zip64) format: under 65535 entries and 4GB
+
+import os
+import time
+import zlib
+import struct
+import concurrent.futures
+
+
+
+# ---------------------------------------------------------------------------
+# extensions of files already compressed, where deflating just burns cpu
+storedExtensions = ['.pdf', '.zip', '.gz', '.bz2', '.xz', '.7z', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp3', '.mp4', '.ogg', '.woff', '.woff2']
+
+zipMethodStored = 0
+zipMethodDeflated = 8
+zipMaxOffset = 0xFFFFFFFF
+zipMaxEntries = 0xFFFF
+# bit 3 = sizes and crc follow the data in a descriptor; bit 11 = names are utf-8
+zipFlagDataDescriptor = 0x08
+zipFlagUtf8 = 0x800
+zipReadChunkSize = 1 << 20
+
+
+def chooseZipMethod(fileName):
+    fileExt = os.path.splitext(fileName)[1].lower()
+    if (fileExt in storedExtensions):
+        return zipMethodStored
+    return zipMethodDeflated
+
+
+def calcZipArcName(filePath, baseDir):
+    # path inside the archive: relative to baseDir if under it, otherwise just the file name
+    if (baseDir is not None) and (filePath.startswith(baseDir)):
+        arcName = filePath[len(baseDir):]
+    else:
+        arcName = os.path.basename(filePath)
+    return arcName.replace('\\', '/').lstrip('/')
+
+
+def calcDosDateTime(timestamp):
+    # zip stores local time in ms-dos format (2 second resolution, years 1980+)
+    t = time.localtime(timestamp)
+    year = max(1980, t.tm_year)
+    dosTime = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    dosDate = ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    return [dosTime, dosDate]
+
+
+def deflateFile(filePath, deflateLevel):
+    # returns [crc, uncompressedSize, compressedBytes] (raw deflate stream, as zip wants)
+    compressor = zlib.compressobj(deflateLevel, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    parts = []
+    with open(filePath, 'rb') as inFile:
+        while True:
+            chunk = inFile.read(zipReadChunkSize)
+            if (not chunk):
+                break
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            parts.append(compressor.compress(chunk))
+    parts.append(compressor.flush())
+    return [crc, size, b''.join(parts)]
+# ---------------------------------------------------------------------------
+
+
+
+
+# ---------------------------------------------------------------------------
+def iterZipChunks(entryList, workerCount=None, deflateLevel=6):
+    # generator yielding the bytes of a zip archive of entryList, a list of [filePath, arcName]
+    # deflated entries are compressed by workerCount threads (default cpu count), at most a couple of entries per worker ahead of the writer
+    if (len(entryList) >= zipMaxEntries):
+        raise Exception("Too many files ({}) for a zip archive.".format(len(entryList)))
+    if (workerCount is None):
+        workerCount = os.cpu_count() or 1
+    workerCount = max(1, workerCount)
+    aheadCount = workerCount * 2
+    centralDirectory = []
+    offset = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workerCount) as executor:
+        futures = {}
+        submitIndex = 0
+        for entryIndex, [filePath, arcName] in enumerate(entryList):
+            # keep the workers busy on the deflated entries coming up
+            while (submitIndex < len(entryList)) and (len(futures) < aheadCount):
+                [submitFilePath, submitArcName] = entryList[submitIndex]
+                if (chooseZipMethod(submitArcName) == zipMethodDeflated):
+                    futures[submitIndex] = executor.submit(deflateFile, submitFilePath, deflateLevel)
+                submitIndex += 1
+            #
+            fileStat = os.stat(filePath)
+            [dosTime, dosDate] = calcDosDateTime(fileStat.st_mtime)
+            nameBytes = arcName.encode('utf-8')
+            headerOffset = offset
+            if (entryIndex in futures):
+                # deflated, all sizes known up front
+                [crc, size, compressedBytes] = futures.pop(entryIndex).result()
+                method = zipMethodDeflated
+                flags = zipFlagUtf8
+                compressedSize = len(compressedBytes)
+                header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, flags, method, dosTime, dosDate, crc, compressedSize, size, len(nameBytes), 0) + nameBytes
+                yield header
+                yield compressedBytes
+                offset += len(header) + compressedSize
+            else:
+                # stored, streamed from disk; crc and sizes go in a descriptor after the data
+                method = zipMethodStored
+                flags = zipFlagUtf8 | zipFlagDataDescriptor
+                header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, flags, method, dosTime, dosDate, 0, 0, 0, len(nameBytes), 0) + nameBytes
+                yield header
+                crc = 0
+                size = 0
+                with open(filePath, 'rb') as inFile:
+                    while True:
+                        chunk = inFile.read(zipReadChunkSize)
+                        if (not chunk):
+                            break
+                        crc = zlib.crc32(chunk, crc)
+                        size += len(chunk)
+                        yield chunk
+                compressedSize = size
+                descriptor = struct.pack('<IIII', 0x08074b50, crc, compressedSize, size)
+                yield descriptor
+                offset += len(header) + size + len(descriptor)
+            if (offset > zipMaxOffset):
+                raise Exception("Zip archive too large (over 4GB) at '{}'.".format(arcName))
+            externalAttributes = (fileStat.st_mode & 0xFFFF) << 16
+            centralDirectory.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 20, 20, flags, method, dosTime, dosDate, crc, compressedSize, size, len(nameBytes), 0, 0, 0, 0, externalAttributes, headerOffset) + nameBytes)
+    #
+    centralDirectoryBytes = b''.join(centralDirectory)
+    yield centralDirectoryBytes
+    yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(centralDirectory), len(centralDirectory), len(centralDirectoryBytes), offset, 0)
+
+
+def writeZipFile(outFilePath, entryList, workerCount=None, deflateLevel=6):
+    # write the archive to a temporary name then rename, so a reader never sees a half written zip
+    tempFilePath = outFilePath + '.tmp'
+    with open(tempFilePath, 'wb') as outFile:
+        for chunk in iterZipChunks(entryList, workerCount, deflateLevel):
+            outFile.write(chunk)
+    os.replace(tempFilePath, outFilePath)
+    return outFilePath
+
+
+def makeDirectoryZipEntryList(dirPath):
+    # [filePath, arcName] for each file directly in dirPath (sorted by name)
+    entryList = []
+    for dirEntry in sorted(os.scandir(dirPath), key=lambda entry: entry.name):
+        if (dirEntry.is_file()):
+            entryList.append([dirEntry.path, dirEntry.name])
+    return entryList
+# ---------------------------------------------------------------------------
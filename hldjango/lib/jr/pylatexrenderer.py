@@ -29,6 +29,8 @@ class PyLaTeXRenderer(LaTeXRenderer):
             extras (list): allows subclasses to add even more custom tokens.
         """
         self.parserRef = hlParserRef
+        # set when output depends on game state outside the markdown text (see HlMarkdown render cache)
+        self.usedExternalState = False
         #
         tokens = self._tokens_from_module(latex_token)
         self.packages = {}
@@ -426,5 +428,6 @@ class PyLaTeXRenderer(LaTeXRenderer):
 
     def safelyResolveImageSource(self, filePath):
         # throw error if we can't resolve it to a known image
+        self.usedExternalState = True
         filePathResolved = self.parserRef.safelyResolveImageSource(filePath)
         return filePathResolved